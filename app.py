@@ -1,13 +1,15 @@
 import os
-import logging
+import time
+
+_import_started = time.perf_counter()
+
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import LoginManager
 from sqlalchemy.orm import DeclarativeBase
 from werkzeug.middleware.proxy_fix import ProxyFix
-
-# Configure logging
-logging.basicConfig(level=logging.DEBUG)
+import middleware
+import logs
 
 class Base(DeclarativeBase):
     pass
@@ -15,34 +17,148 @@ class Base(DeclarativeBase):
 db = SQLAlchemy(model_class=Base)
 login_manager = LoginManager()
 
-# Create the app
-app = Flask(__name__)
-app.secret_key = os.environ.get("SESSION_SECRET")
-app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
-
-# Configure the database
-app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
-app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
-    "pool_recycle": 300,
-    "pool_pre_ping": True,
-}
-
-# Initialize extensions
-db.init_app(app)
-login_manager.init_app(app)
-login_manager.login_view = 'login'
-login_manager.login_message = 'Please log in to access this page.'
-login_manager.login_message_category = 'info'
+def _rate(value):
+    """Parse "<burst>/<seconds>": allow burst attempts, regaining one every seconds"""
+    burst, seconds = value.split("/")
+    return int(burst), 1 / float(seconds)
+
+def configure(app):
+    """Load configuration from the environment"""
+    app.secret_key = os.environ.get("SESSION_SECRET")
+
+    # Logging (logs.py): JSON lines on stderr through a background queue
+    app.config["LOG_LEVEL"] = os.environ.get("LOG_LEVEL", "INFO")
+    app.config["LOG_LEVELS"] = os.environ.get("LOG_LEVELS", "sqlalchemy=WARNING,urllib3=WARNING")
+    app.config["LOG_SAMPLE"] = os.environ.get("LOG_SAMPLE", "")  # e.g. "access=0.05"
+    app.config["LOG_FORMAT"] = os.environ.get("LOG_FORMAT", "json")  # json or text
+    app.config["LOG_FILE"] = os.environ.get("LOG_FILE")  # e.g. "/var/log/chs/app-{pid}.log"
+    app.config["LOG_FILE_MAX_BYTES"] = int(os.environ.get("LOG_FILE_MAX_BYTES", 50 * 1024 * 1024))
+    app.config["LOG_FILE_BACKUPS"] = int(os.environ.get("LOG_FILE_BACKUPS", 5))
+    app.config["LOG_QUEUE_SIZE"] = int(os.environ.get("LOG_QUEUE_SIZE", 10000))
+
+    # Configure the database
+    app.config["SQLALCHEMY_DATABASE_URI"] = os.environ.get("DATABASE_URL")
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
+        "pool_recycle": 300,
+        "pool_pre_ping": True,
+    }
+
+    # Async JSON tier (asgi.py); defaults to DATABASE_URL with the asyncpg/aiosqlite driver
+    app.config["ASYNC_DATABASE_URL"] = os.environ.get("ASYNC_DATABASE_URL")
+    app.config["ASYNC_DB_POOL_SIZE"] = int(os.environ.get("ASYNC_DB_POOL_SIZE", 20))
+    app.config["ASGI_WSGI_THREADS"] = int(os.environ.get("ASGI_WSGI_THREADS", 10))  # threads for Flask routes
+
+    # Password hashing (any werkzeug method, e.g. "scrypt:16384:8:1" or "pbkdf2:sha256:600000")
+    app.config["PASSWORD_HASH_METHOD"] = os.environ.get("PASSWORD_HASH_METHOD", "scrypt")
+    app.config["PASSWORD_HASH_THREADS"] = int(os.environ.get("PASSWORD_HASH_THREADS", 2))
+    app.config["PASSWORD_HASH_TIMEOUT"] = float(os.environ.get("PASSWORD_HASH_TIMEOUT", 10))
+    app.config["LOGIN_THROTTLE_USER"] = _rate(os.environ.get("LOGIN_THROTTLE_USER", "5/30"))
+    app.config["LOGIN_THROTTLE_IP"] = _rate(os.environ.get("LOGIN_THROTTLE_IP", "50/2"))
+
+    # Response compression and conditional GET
+    app.config["COMPRESSION_MIN_SIZE"] = int(os.environ.get("COMPRESSION_MIN_SIZE", 500))
+    app.config["COMPRESSION_LEVEL"] = int(os.environ.get("COMPRESSION_LEVEL", 6))
+
+    # Template bytecode cache and fragment caching
+    app.config["TEMPLATE_CACHE_DIR"] = os.environ.get("TEMPLATE_CACHE_DIR", os.path.join(app.instance_path, "jinja_cache"))
+
+    # Cache: memory (per worker), sqlite (shared by workers on this host) or redis
+    app.config["CACHE_BACKEND"] = os.environ.get("CACHE_BACKEND", "memory")
+    app.config["CACHE_URL"] = os.environ.get("CACHE_URL", os.path.join(app.instance_path, "cache.sqlite3"))
+    app.config["CACHE_MAX_ENTRIES"] = int(os.environ.get("CACHE_MAX_ENTRIES", 10000))
+    app.config["CACHE_DEFAULT_TTL"] = int(os.environ.get("CACHE_DEFAULT_TTL", 300))
+
+    # Background jobs (set JOBS_EAGER=1 to run jobs inline without a worker)
+    app.config["JOBS_EAGER"] = os.environ.get("JOBS_EAGER") == "1"
+    app.config["JOBS_RETRY_BASE"] = int(os.environ.get("JOBS_RETRY_BASE", 5))
+    app.config["JOBS_RETRY_MAX"] = int(os.environ.get("JOBS_RETRY_MAX", 3600))
+    app.config["JOBS_LOCK_TIMEOUT"] = int(os.environ.get("JOBS_LOCK_TIMEOUT", 1800))
+    app.config["JOBS_SCHEDULE_INTERVAL"] = int(os.environ.get("JOBS_SCHEDULE_INTERVAL", 60))
+
+    # CHW allowance payouts (set PAYOUTS_STUB=1 to use the local stub instead of IntaSend)
+    app.config["PAYOUTS_STUB"] = os.environ.get("PAYOUTS_STUB") == "1"
+    app.config["PAYOUT_CHUNK_SIZE"] = int(os.environ.get("PAYOUT_CHUNK_SIZE", 100))
+    app.config["PAYOUT_CONCURRENCY"] = int(os.environ.get("PAYOUT_CONCURRENCY", 4))
+    app.config["PAYOUT_RATE_LIMIT"] = float(os.environ.get("PAYOUT_RATE_LIMIT", 5))  # requests per second
+    app.config["ALLOWANCE_BASE"] = float(os.environ.get("ALLOWANCE_BASE", 1000))
+    app.config["ALLOWANCE_PER_PATIENT"] = float(os.environ.get("ALLOWANCE_PER_PATIENT", 50))
+    app.config["ALLOWANCE_PER_ENCOUNTER"] = float(os.environ.get("ALLOWANCE_PER_ENCOUNTER", 20))
+    app.config["ALLOWANCE_PER_ATTENDANCE"] = float(os.environ.get("ALLOWANCE_PER_ATTENDANCE", 10))
+
+    # Payment reconciliation uploads and discrepancy reports
+    app.config["RECONCILIATION_DIR"] = os.environ.get("RECONCILIATION_DIR", os.path.join(app.instance_path, "reconciliation"))
+
+    # Ward-level coverage snapshots
+    app.config["GEO_DIR"] = os.environ.get("GEO_DIR", os.path.join(app.instance_path, "geo"))
+    app.config["GEO_KEEP_DAYS"] = int(os.environ.get("GEO_KEEP_DAYS", 30))
+
+    # FHIR bulk $export output
+    app.config["FHIR_EXPORT_DIR"] = os.environ.get("FHIR_EXPORT_DIR", os.path.join(app.instance_path, "fhir_export"))
+    app.config["FHIR_EXPORT_BATCH"] = int(os.environ.get("FHIR_EXPORT_BATCH", 5000))  # rows fetched per round trip
+    app.config["FHIR_EXPORT_KEEP_DAYS"] = int(os.environ.get("FHIR_EXPORT_KEEP_DAYS", 7))
+    app.config["FHIR_MAX_COUNT"] = int(os.environ.get("FHIR_MAX_COUNT", 500))
+
+    # Screening session capture
+    app.config["SCREENING_MAX_ROWS"] = int(os.environ.get("SCREENING_MAX_ROWS", 1000))
+    # Sequence values each worker reserves per database round trip
+    app.config["IDENTIFIER_BLOCK_SIZE"] = int(os.environ.get("IDENTIFIER_BLOCK_SIZE", 100))
+
+    # Nightly risk rule evaluation
+    app.config["RISK_PROCESSES"] = int(os.environ.get("RISK_PROCESSES", 4))
+
+    # Audit log retention
+    app.config["AUDIT_ARCHIVE_DIR"] = os.environ.get("AUDIT_ARCHIVE_DIR", os.path.join(app.instance_path, "audit_archive"))
+    app.config["AUDIT_RETENTION_MONTHS"] = int(os.environ.get("AUDIT_RETENTION_MONTHS", 12))
+
+    # Hot/cold tiering: inactive patients and records older than this move to archive tables
+    app.config["ARCHIVE_AFTER_YEARS"] = float(os.environ.get("ARCHIVE_AFTER_YEARS", 3))
+    app.config["ARCHIVE_BATCH_SIZE"] = int(os.environ.get("ARCHIVE_BATCH_SIZE", 1000))
+
+def create_app():
+    """Create and configure the Flask application
+
+    Nothing here touches the database, so the app can be imported by
+    gunicorn's --preload master and by CLI commands without connecting.
+    Create or upgrade the schema with ``flask db upgrade``.
+    """
+    app = Flask(__name__)
+    configure(app)
+    logs.init_app(app)
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_proto=1, x_host=1)
+    middleware.init_app(app)
+
+    # Initialize extensions
+    db.init_app(app)
+    login_manager.init_app(app)
+    login_manager.login_view = 'login'
+    login_manager.login_message = 'Please log in to access this page.'
+    login_manager.login_message_category = 'info'
+    return app
 
 @login_manager.user_loader
 def load_user(user_id):
     from models import User
-    return User.query.get(int(user_id))
+    return db.session.get(User, int(user_id))
 
-with app.app_context():
-    # Import models to ensure tables are created
-    import models
-    db.create_all()
+# Create the app
+app = create_app()
 
-# Import routes
+# Import routes, background jobs and CLI commands
 import routes
+import jobs
+import audit
+import risk
+import payouts
+import identifiers
+import partitioning
+import caseloads
+import archive
+import reconciliation
+import geo
+import coding
+import fhir
+import rendering
+import migrations
+import benchmarks
+
+app.config["STARTUP_MS"] = (time.perf_counter() - _import_started) * 1000
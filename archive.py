@@ -0,0 +1,407 @@
+"""Cold storage for inactive patients and old records
+
+Rows move from the hot tables into ``<table>_archive`` tables with the same
+columns, an ``archived_at`` stamp and no foreign keys:
+
+- inactive and deceased patients not updated for ARCHIVE_AFTER_YEARS, with
+  everything that belongs to them, unless a payment of theirs is still
+  pending
+- health records of other inactive and deceased patients older than that,
+  with their medications and resolved risk flags, unless a coded condition
+  points at them or a flag is still open
+- completed payments of other inactive and deceased patients older than
+  that, except CHW payout rows, which batch progress still counts
+
+Active patients keep their whole history hot, since the vitals timeline,
+FHIR search and export, cohorts and risk evaluation read it from the hot
+tables. Records of a patient who is active again are moved back.
+
+Lists, searches, worklists and reports only ever read the hot tables.
+Opening an archived patient's page moves the patient and their rows back
+(restore_patient); a hot patient's page reads older records straight from
+the archive when the hot ones run out.
+"""
+import json
+import time
+import logging
+import statistics
+import threading
+from collections import defaultdict
+from datetime import datetime, timedelta
+import click
+from flask_login import current_user
+from sqlalchemy import MetaData, Table, Column, DateTime, Index, select, update, func, exists, text, inspect, or_
+from sqlalchemy.exc import IntegrityError
+from app import app, db
+from models import (Patient, HealthRecord, PatientCondition, EncounterMedication, RiskFlag,
+                    EventAttendance, AttendanceService, Payment, Job)
+from permissions import Permission, can
+from jobs import job
+
+logger = logging.getLogger(__name__)
+
+# Parents before children; archiving walks the list backwards
+ARCHIVED_MODELS = (Patient, HealthRecord, EventAttendance, Payment, PatientCondition,
+                   EncounterMedication, RiskFlag, AttendanceService)
+
+ARCHIVED_STATUSES = ('inactive', 'deceased')
+# Payments in any other state are still in flight
+SETTLED_PAYMENT_STATUSES = ('completed', 'failed', 'refunded')
+
+# Representative hot-table queries timed before and after each run
+PROBES = {
+    'active_patients': lambda: select(func.count(Patient.id)).where(Patient.status == 'active'),
+    'patient_search': lambda: select(Patient.id).where(
+        Patient.status == 'active', Patient.last_name.contains('zzq')
+    ).limit(20),
+    'health_records': lambda: select(func.count(HealthRecord.id)),
+    'completed_payments': lambda: select(func.sum(Payment.amount)).where(Payment.status == 'completed'),
+}
+
+_metadata = MetaData()
+
+class ArchiveMetrics:
+    """Per-process counts of patients restored and rows read from the archive"""
+
+    FIELDS = ('patients_restored', 'rows_read_through')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            self.counts[field] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+metrics = ArchiveMetrics()
+
+def archive_table(model):
+    """Table object for a model's archive table"""
+    name = f'{model.__tablename__}_archive'
+    if name in _metadata.tables:
+        return _metadata.tables[name]
+
+    table = Table(name, _metadata, *[
+        Column(c.name, c.type, primary_key=c.primary_key, autoincrement=False)
+        for c in model.__table__.columns
+    ], Column('archived_at', DateTime, server_default=func.now()))
+    # Restores and read-through look rows up by owner
+    for column in ('patient_id', 'attendance_id'):
+        if column in table.c:
+            Index(f'ix_{name}_{column}', table.c[column])
+    return table
+
+def create_tables():
+    from migrations import ensure_column
+    tables = [archive_table(model) for model in ARCHIVED_MODELS]
+    _metadata.create_all(db.engine, tables=tables)
+    # Columns added to a hot table since its archive table was created
+    for table in tables:
+        existing = {c['name'] for c in inspect(db.engine).get_columns(table.name)}
+        for column in table.columns:
+            if column.name not in existing:
+                ensure_column(table, column.name)
+
+def _move(source, target, condition):
+    """Copy rows matching ``condition`` (on ``source``) to ``target``, then delete them; returns the count"""
+    columns = [c.name for c in source.columns if c.name in target.c and c.name != 'archived_at']
+    db.session.execute(target.insert().from_select(columns, select(*[source.c[name] for name in columns])
+                                                   .where(condition)))
+    return db.session.execute(source.delete().where(condition)).rowcount
+
+def _patient_rows(attendance, patient_ids):
+    """(model, column, values) selecting every row of the patients, parents first
+
+    ``attendance`` is whichever event_attendance table the rows are in now.
+    """
+    attendance_ids = db.session.execute(
+        select(attendance.c.id).where(attendance.c.patient_id.in_(patient_ids))
+    ).scalars().all()
+    rows = [(Patient, 'id', patient_ids)]
+    rows += [(model, 'patient_id', patient_ids) for model in ARCHIVED_MODELS[1:-1]]
+    rows.append((AttendanceService, 'attendance_id', attendance_ids))
+    return rows
+
+def archive_patients(cutoff, batch_size):
+    """Move inactive and deceased patients untouched since ``cutoff``, with all their rows
+
+    Patients with a payment still in flight stay hot so reconciliation
+    and payouts can settle it.
+    """
+    moved = defaultdict(int)
+    last_id = 0
+    while True:
+        ids = db.session.execute(
+            select(Patient.id)
+            .where(Patient.id > last_id, Patient.status.in_(ARCHIVED_STATUSES),
+                   func.coalesce(Patient.updated_at, Patient.created_at) < cutoff,
+                   ~exists().where(Payment.patient_id == Patient.id,
+                                   Payment.status.notin_(SETTLED_PAYMENT_STATUSES)))
+            .order_by(Patient.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return moved
+        last_id = ids[-1]
+        # Children first, so no foreign key ever points at a missing row
+        for model, column, values in reversed(_patient_rows(EventAttendance.__table__, ids)):
+            hot = model.__table__
+            moved[hot.name] += _move(hot, archive_table(model), hot.c[column].in_(values))
+        db.session.commit()
+
+def archive_records(cutoff, batch_size):
+    """Move inactive and deceased patients' health records from before ``cutoff`` that nothing hot still needs"""
+    moved = defaultdict(int)
+    last_id = 0
+    while True:
+        # Kept rows are skipped by the keyset, not scanned again every batch
+        ids = db.session.execute(
+            select(HealthRecord.id)
+            .where(HealthRecord.id > last_id, HealthRecord.encounter_date < cutoff,
+                   exists().where(Patient.id == HealthRecord.patient_id, Patient.status.in_(ARCHIVED_STATUSES)),
+                   HealthRecord.id.notin_(select(PatientCondition.health_record_id)
+                                          .where(PatientCondition.health_record_id.isnot(None))),
+                   ~exists().where(RiskFlag.health_record_id == HealthRecord.id, RiskFlag.status == 'open'))
+            .order_by(HealthRecord.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return moved
+        last_id = ids[-1]
+        for model in (EncounterMedication, RiskFlag):
+            moved[model.__tablename__] += _move(model.__table__, archive_table(model),
+                                                model.health_record_id.in_(ids))
+        moved['health_record'] += _move(HealthRecord.__table__, archive_table(HealthRecord),
+                                        HealthRecord.id.in_(ids))
+        db.session.commit()
+
+def restore_active_records(batch_size):
+    """Move archived health records and payments of hot patients who are active back
+
+    Payments archived without a patient or as part of a payout batch come
+    back as well, since archive_payments no longer moves them.
+    """
+    archived = archive_table(HealthRecord)
+    moved = defaultdict(int)
+    while True:
+        ids = db.session.execute(
+            select(archived.c.id)
+            .where(exists().where(Patient.id == archived.c.patient_id, Patient.status.notin_(ARCHIVED_STATUSES)))
+            .order_by(archived.c.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            break
+        # Parents first, the reverse of archiving
+        moved['health_record'] += _move(archived, HealthRecord.__table__, archived.c.id.in_(ids))
+        for model in (EncounterMedication, RiskFlag):
+            source = archive_table(model)
+            moved[model.__tablename__] += _move(source, model.__table__, source.c.health_record_id.in_(ids))
+        db.session.commit()
+    moved['payment'] += _restore_payments(batch_size)
+    return moved
+
+def _restore_payments(batch_size):
+    """Move archived payments that archive_payments would now keep hot back; returns the count"""
+    archived = archive_table(Payment)
+    moved = 0
+    while True:
+        # Payments of archived patients stay put: their patient row is not hot
+        ids = db.session.execute(
+            select(archived.c.id)
+            .where(or_(archived.c.patient_id.is_(None),
+                       exists().where(Patient.id == archived.c.patient_id,
+                                      or_(Patient.status.notin_(ARCHIVED_STATUSES), archived.c.batch_id.isnot(None)))))
+            .order_by(archived.c.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return moved
+        moved += _move(archived, Payment.__table__, archived.c.id.in_(ids))
+        db.session.commit()
+
+def archive_payments(cutoff, batch_size):
+    """Move inactive and deceased patients' completed payments from before ``cutoff``
+
+    Payout batch rows stay hot for batch_progress.
+    """
+    moved = last_id = 0
+    while True:
+        ids = db.session.execute(
+            select(Payment.id)
+            .where(Payment.id > last_id, Payment.status == 'completed', Payment.created_at < cutoff,
+                   Payment.batch_id.is_(None),
+                   exists().where(Patient.id == Payment.patient_id, Patient.status.in_(ARCHIVED_STATUSES)))
+            .order_by(Payment.id)
+            .limit(batch_size)
+        ).scalars().all()
+        if not ids:
+            return moved
+        last_id = ids[-1]
+        moved += _move(Payment.__table__, archive_table(Payment), Payment.id.in_(ids))
+        db.session.commit()
+
+def is_archived(patient_id):
+    archived = archive_table(Patient)
+    return db.session.execute(select(exists().where(archived.c.id == patient_id))).scalar()
+
+def restore_patient(patient_id):
+    """Move an archived patient and everything archived for them back to the hot tables
+
+    Returns False if the patient is not archived. The patient's updated_at
+    is reset so the next run does not archive them again straight away.
+    """
+    if not is_archived(patient_id):
+        return False
+    try:
+        for model, column, values in _patient_rows(archive_table(EventAttendance), [patient_id]):
+            archived = archive_table(model)
+            _move(archived, model.__table__, archived.c[column].in_(values))
+        db.session.execute(update(Patient).where(Patient.id == patient_id).values(updated_at=datetime.utcnow()))
+        db.session.commit()
+    except IntegrityError:
+        # Another request restored the patient first
+        db.session.rollback()
+        return True
+    metrics.incr('patients_restored')
+    logger.info('Restored archived patient %s', patient_id)
+    return True
+
+def restore_for_viewer(patient_id):
+    """Restore an archived patient if the current user could open them; returns whether it did"""
+    archived = archive_table(Patient)
+    row = db.session.execute(select(archived.c.assigned_chw_id).where(archived.c.id == patient_id)).first()
+    if row is None:
+        return False
+    if not (can(Permission.VIEW_ALL_PATIENTS)
+            or (can(Permission.VIEW_ASSIGNED_PATIENTS) and row.assigned_chw_id == current_user.id)):
+        return False
+    return restore_patient(patient_id)
+
+def archived_rows(model, patient_id, order_by, limit):
+    """A hot patient's archived rows of ``model``, newest first by the ``order_by`` column name"""
+    if limit <= 0:
+        return []
+    archived = archive_table(model)
+    rows = db.session.execute(
+        select(archived).where(archived.c.patient_id == patient_id)
+        .order_by(archived.c[order_by].desc()).limit(limit)
+    ).all()
+    if rows:
+        metrics.incr('rows_read_through', len(rows))
+    return rows
+
+def tier_counts():
+    """{table: {'hot': rows, 'archived': rows}}"""
+    counts = {}
+    for model in ARCHIVED_MODELS:
+        archived = archive_table(model)
+        counts[model.__tablename__] = {
+            'hot': db.session.execute(select(func.count()).select_from(model.__table__)).scalar(),
+            'archived': db.session.execute(select(func.count()).select_from(archived)).scalar(),
+        }
+    return counts
+
+def table_bytes():
+    """{table: {'hot': bytes, 'archived': bytes}} including indexes (PostgreSQL only)"""
+    if db.engine.dialect.name != 'postgresql':
+        return {}
+    sizes = {}
+    for model in ARCHIVED_MODELS:
+        sizes[model.__tablename__] = {
+            tier: db.session.execute(text("SELECT pg_total_relation_size(CAST(:name AS regclass))"),
+                                     {'name': name}).scalar()
+            for tier, name in (('hot', model.__tablename__), ('archived', archive_table(model).name))
+        }
+    return sizes
+
+def probe(runs=5):
+    """Median milliseconds for each of PROBES"""
+    timings = {}
+    for name, statement in PROBES.items():
+        samples = []
+        for _ in range(runs):
+            started = time.perf_counter()
+            db.session.execute(statement()).all()
+            samples.append((time.perf_counter() - started) * 1000)
+        timings[name] = round(statistics.median(samples), 2)
+    db.session.rollback()
+    return timings
+
+@job('archive.run', max_attempts=3, every=86400)
+def run_archive(years=None, batch_size=None):
+    """Move cold rows to the archive tables; returns counts, hot table sizes and probe timings"""
+    years = years or app.config['ARCHIVE_AFTER_YEARS']
+    batch_size = batch_size or app.config['ARCHIVE_BATCH_SIZE']
+    cutoff = datetime.utcnow() - timedelta(days=round(365.25 * years))
+    create_tables()
+
+    before, timings_before = tier_counts(), probe()
+    restored = restore_active_records(batch_size)
+    moved = archive_patients(cutoff, batch_size)
+    for table, count in archive_records(cutoff, batch_size).items():
+        moved[table] += count
+    moved['payment'] += archive_payments(cutoff, batch_size)
+    after, timings_after = tier_counts(), probe()
+
+    hot = {table: {
+        'before': before[table]['hot'],
+        'after': after[table]['hot'],
+        'reduction_pct': round(100 * (1 - after[table]['hot'] / before[table]['hot']), 1) if before[table]['hot'] else 0.0
+    } for table in before}
+    result = {
+        'cutoff': cutoff.isoformat(),
+        'moved': {table: count for table, count in moved.items() if count},
+        'restored': {table: count for table, count in restored.items() if count},
+        'hot_rows': hot,
+        'probe_ms': {name: {
+            'before': timings_before[name],
+            'after': timings_after[name],
+            'speedup': round(timings_before[name] / timings_after[name], 2) if timings_after[name] else None
+        } for name in PROBES},
+        'bytes': table_bytes()
+    }
+    logger.info('Archived rows older than %s: %s', cutoff.date(), result['moved'] or 'nothing to move')
+    return result
+
+def last_run():
+    """Result of the most recent completed archive run, if any"""
+    result = db.session.execute(
+        select(Job.result).where(Job.name == 'archive.run', Job.status == 'completed')
+        .order_by(Job.finished_at.desc()).limit(1)
+    ).scalar()
+    return json.loads(result) if result else None
+
+def archive_stats():
+    return {'counts': metrics.snapshot(), 'last_run': last_run()}
+
+@app.cli.group('archive')
+def archive_cli():
+    """Hot/cold tiering for inactive patients and old records"""
+
+@archive_cli.command('run')
+@click.option('--years', type=float, help='Age after which rows are archived (default ARCHIVE_AFTER_YEARS).')
+@click.option('--batch-size', type=int, help='Rows moved per transaction (default ARCHIVE_BATCH_SIZE).')
+def run_command(years, batch_size):
+    """Move inactive patients and old records to the archive tables"""
+    click.echo(json.dumps(run_archive(years, batch_size), indent=2, default=str))
+
+@archive_cli.command('status')
+def status_command():
+    """Rows in the hot and archive tables"""
+    create_tables()
+    for table, counts in tier_counts().items():
+        click.echo(f'{table:<22} hot {counts["hot"]:>10}  archived {counts["archived"]:>10}')
+
+@archive_cli.command('restore')
+@click.argument('patient_id', type=int)
+def restore_command(patient_id):
+    """Move an archived patient back to the hot tables"""
+    if restore_patient(patient_id):
+        click.echo(f'Patient {patient_id} restored')
+    else:
+        click.echo(f'Patient {patient_id} is not archived')
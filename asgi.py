@@ -0,0 +1,128 @@
+"""ASGI entry point: async JSON endpoints in front of the Flask app
+
+Run with ``uvicorn asgi:application``. The read-mostly JSON endpoints
+below are served on the event loop with async SQLAlchemy, so a request
+waiting on the database holds no thread. Every other path falls through
+to the unchanged Flask app, which runs in a thread pool.
+"""
+import contextlib
+from a2wsgi import WSGIMiddleware
+from itsdangerous import BadSignature
+from sqlalchemy import select
+from sqlalchemy.engine import make_url
+from sqlalchemy.ext.asyncio import create_async_engine, async_sessionmaker
+from starlette.applications import Starlette
+from starlette.responses import JSONResponse
+from starlette.routing import Route, Mount
+from app import app as flask_app
+from models import User, Patient, PayoutBatch
+from permissions import Permission, role_permissions, patient_scope
+from payouts import batch_progress, batch_status_counts_query
+
+ASYNC_DRIVERS = {
+    'postgresql': 'postgresql+asyncpg',
+    'postgresql+psycopg2': 'postgresql+asyncpg',
+    'sqlite': 'sqlite+aiosqlite',
+}
+
+def async_database_url(url):
+    """The Flask database URL with its async driver; returns (url, connect_args)"""
+    url = make_url(url)
+    connect_args = {}
+    url = url.set(drivername=ASYNC_DRIVERS.get(url.drivername, url.drivername))
+    if url.drivername == 'postgresql+asyncpg' and 'sslmode' in url.query:
+        # asyncpg takes the libpq sslmode values as its ssl argument
+        connect_args['ssl'] = url.query['sslmode']
+        url = url.difference_update_query(['sslmode'])
+    return url, connect_args
+
+@contextlib.asynccontextmanager
+async def lifespan(application):
+    # One engine per worker process, created inside its event loop
+    url, connect_args = async_database_url(
+        flask_app.config['ASYNC_DATABASE_URL'] or flask_app.config['SQLALCHEMY_DATABASE_URI']
+    )
+    options = {'pool_pre_ping': True, 'pool_recycle': 300, 'connect_args': connect_args}
+    if url.get_backend_name() != 'sqlite':
+        options.update(pool_size=flask_app.config['ASYNC_DB_POOL_SIZE'], max_overflow=10)
+    engine = create_async_engine(url, **options)
+    application.state.sessions = async_sessionmaker(engine, expire_on_commit=False)
+    yield
+    await engine.dispose()
+
+_session_serializer = None
+
+def _load_session(request):
+    """Decode Flask's signed session cookie, or None"""
+    global _session_serializer
+    if _session_serializer is None:
+        _session_serializer = flask_app.session_interface.get_signing_serializer(flask_app)
+    cookie = request.cookies.get(flask_app.config['SESSION_COOKIE_NAME'])
+    if not cookie or _session_serializer is None:
+        return None
+    try:
+        return _session_serializer.loads(
+            cookie, max_age=int(flask_app.permanent_session_lifetime.total_seconds())
+        )
+    except BadSignature:
+        return None
+
+def api_view(view):
+    """Resolve the Flask-Login user from the shared session cookie and open a database session
+
+    The view is called as ``view(request, session, user, granted)``.
+    """
+    async def endpoint(request):
+        data = _load_session(request) or {}
+        if not data.get('_user_id'):
+            return JSONResponse({'error': 'Authentication required'}, status_code=401)
+        async with request.app.state.sessions() as session:
+            user = await session.get(User, int(data['_user_id']))
+            if user is None or not user.is_active:
+                return JSONResponse({'error': 'Authentication required'}, status_code=401)
+            return await view(request, session, user, role_permissions(user.role))
+    endpoint.__name__ = view.__name__
+    return endpoint
+
+@api_view
+async def api_patients_search(request, session, user, granted):
+    """Async twin of routes.api_patients_search"""
+    if Permission.MANAGE_PATIENTS not in granted:
+        return JSONResponse({'error': 'Access denied'}, status_code=403)
+
+    query = request.query_params.get('q', '')
+    if len(query) < 2:
+        return JSONResponse([])
+
+    patients = (await session.execute(
+        select(Patient)
+        .where(Patient.status == 'active', patient_scope(granted, user.id), Patient.search_clause(query))
+        .limit(10)
+    )).scalars().all()
+    return JSONResponse([{
+        'id': p.id,
+        'name': p.get_full_name(),
+        'patient_number': p.patient_number,
+        'age': p.get_age()
+    } for p in patients])
+
+@api_view
+async def api_payout_batch(request, session, user, granted):
+    """Async twin of routes.api_payout_batch, polled while a batch submits"""
+    if Permission.ADMIN not in granted:
+        return JSONResponse({'error': 'Access denied'}, status_code=403)
+
+    batch = await session.get(PayoutBatch, request.path_params['id'])
+    if batch is None:
+        return JSONResponse({'error': 'Not found'}, status_code=404)
+    statuses = dict((await session.execute(batch_status_counts_query(batch.id))).all())
+    return JSONResponse(batch_progress(batch, statuses))
+
+application = Starlette(
+    routes=[
+        Route('/api/patients/search', api_patients_search),
+        Route('/api/payouts/batches/{id:int}', api_payout_batch),
+        Mount('/', app=WSGIMiddleware(flask_app, workers=flask_app.config['ASGI_WSGI_THREADS'])),
+    ],
+    lifespan=lifespan
+)
@@ -0,0 +1,306 @@
+import re
+import json
+from datetime import datetime
+import click
+from sqlalchemy import select, update, or_, func
+from app import app, db
+from models import Patient, OutreachEvent, EventAttendance, AttendanceService
+from utils import log_audit
+from partitioning import same_county
+
+# Keep IN (...) lists well under SQLite's bound-parameter limit
+CHUNK_SIZE = 500
+
+def _chunks(values, size=CHUNK_SIZE):
+    values = list(values)
+    for start in range(0, len(values), size):
+        yield values[start:start + size]
+
+def parse_patient_numbers(raw):
+    """Split scanner or pasted input on commas, whitespace and newlines"""
+    return [number.strip().upper() for number in re.split(r'[\s,;]+', raw or '') if number.strip()]
+
+def resolve_patients(patient_ids=(), patient_numbers=()):
+    """Map submitted ids and patient numbers to existing patient ids
+
+    Returns (ids in submission order without repeats, unknown inputs).
+    """
+    found_ids = set()
+    for chunk in _chunks({int(i) for i in patient_ids}):
+        found_ids.update(db.session.execute(
+            select(Patient.id).where(Patient.id.in_(chunk))
+        ).scalars())
+
+    by_number = {}
+    for chunk in _chunks(set(patient_numbers)):
+        by_number.update(db.session.execute(
+            select(Patient.patient_number, Patient.id).where(Patient.patient_number.in_(chunk))
+        ).all())
+
+    resolved, unknown, seen = [], [], set()
+    for value in patient_ids:
+        patient_id = int(value)
+        if patient_id not in found_ids:
+            unknown.append(value)
+        elif patient_id not in seen:
+            seen.add(patient_id)
+            resolved.append(patient_id)
+    for number in patient_numbers:
+        patient_id = by_number.get(number)
+        if patient_id is None:
+            unknown.append(number)
+        elif patient_id not in seen:
+            seen.add(patient_id)
+            resolved.append(patient_id)
+    return resolved, unknown
+
+def parse_services(raw):
+    """Normalize a services entry into a list of distinct service names
+
+    Accepts a JSON list (or object keyed by service) as well as the free
+    text the forms post ("OPV, Vitamin A; deworming").
+    """
+    if not raw:
+        return []
+    if isinstance(raw, str):
+        try:
+            raw = json.loads(raw)
+        except ValueError:
+            raw = re.split(r'[,;\n]+', raw)
+    if isinstance(raw, dict):
+        raw = list(raw)
+    elif not isinstance(raw, list):
+        raw = [raw]
+    services = []
+    for value in raw:
+        name = ' '.join(str(value).split()).lower()[:100]
+        if name and name not in services:
+            services.append(name)
+    return services
+
+def _insert_services_ignoring_duplicates():
+    """INSERT ... ON CONFLICT (attendance_id, service) DO NOTHING"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(AttendanceService).on_conflict_do_nothing(
+        index_elements=['attendance_id', 'service']
+    )
+
+def reserve_seats(event_id, requested):
+    """Atomically take up to ``requested`` seats at an event; returns seats granted
+
+    The common case is a single conditional UPDATE. Only when the event
+    cannot fit the whole request is the row locked to grant what is left.
+    Seats are returned if the transaction rolls back.
+    """
+    if requested <= 0:
+        return 0
+
+    granted = db.session.execute(
+        update(OutreachEvent)
+        .where(
+            OutreachEvent.id == event_id,
+            or_(
+                OutreachEvent.max_participants.is_(None),
+                OutreachEvent.attendance_count + requested <= OutreachEvent.max_participants
+            )
+        )
+        .values(attendance_count=OutreachEvent.attendance_count + requested)
+    ).rowcount
+    if granted:
+        return requested
+
+    row = db.session.execute(
+        select(OutreachEvent.attendance_count, OutreachEvent.max_participants)
+        .where(OutreachEvent.id == event_id)
+        .with_for_update()
+    ).first()
+    if row is None:
+        raise LookupError(f'Outreach event {event_id} not found')
+
+    available = min(max(row.max_participants - row.attendance_count, 0), requested)
+    if available:
+        db.session.execute(
+            update(OutreachEvent)
+            .where(OutreachEvent.id == event_id)
+            .values(attendance_count=OutreachEvent.attendance_count + available)
+        )
+    return available
+
+def _insert_ignoring_duplicates():
+    """INSERT ... ON CONFLICT (event_id, patient_id) DO NOTHING"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    # No conflict target: once partitioned the unique index also covers county
+    return dialect_insert(EventAttendance).on_conflict_do_nothing().returning(EventAttendance.id, EventAttendance.patient_id)
+
+def record_attendances(event_id, patient_ids=(), patient_numbers=(), services='', notes='',
+                       recorded_by_id=None, audit=True):
+    """Record many patients at an outreach event in one transaction
+
+    Seats are reserved on the event's attendance_count before inserting,
+    the (event_id, patient_id) unique index rejects duplicates even under
+    concurrent writers, rows go in as one multi-row INSERT, and a single
+    audit entry summarizes the batch.
+    """
+    resolved, unknown = resolve_patients(patient_ids, patient_numbers)
+    county = db.session.execute(select(OutreachEvent.target_county).where(OutreachEvent.id == event_id)).scalar()
+
+    # Cheap indexed pre-check so known duplicates do not take seats
+    already_recorded = set()
+    for chunk in _chunks(resolved):
+        already_recorded.update(db.session.execute(
+            select(EventAttendance.patient_id).where(
+                EventAttendance.event_id == event_id,
+                same_county(EventAttendance.county, county),
+                EventAttendance.patient_id.in_(chunk)
+            )
+        ).scalars())
+    candidates = [patient_id for patient_id in resolved if patient_id not in already_recorded]
+
+    if candidates:
+        granted = reserve_seats(event_id, len(candidates))
+    elif db.session.get(OutreachEvent, event_id) is None:
+        raise LookupError(f'Outreach event {event_id} not found')
+    else:
+        granted = 0
+    accepted, over_capacity = candidates[:granted], candidates[granted:]
+
+    now = datetime.utcnow()
+    inserted = {}
+    if accepted:
+        rows = db.session.connection().execute(_insert_ignoring_duplicates(), [{
+            'event_id': event_id,
+            'patient_id': patient_id,
+            'services_received': json.dumps(services) if isinstance(services, (list, dict)) else services,
+            'notes': notes,
+            'recorded_by_id': recorded_by_id,
+            'county': county,
+            'attendance_date': now,
+            'created_at': now
+        } for patient_id in accepted])
+        inserted = {patient_id: attendance_id for attendance_id, patient_id in rows}
+        
+        service_names = parse_services(services)
+        if inserted and service_names:
+            db.session.execute(AttendanceService.__table__.insert(), [
+                {'attendance_id': attendance_id, 'event_id': event_id, 'service': service}
+                for attendance_id in inserted.values() for service in service_names
+            ])
+
+        # A concurrent writer recorded some of these first; give their seats back
+        lost = len(accepted) - len(inserted)
+        if lost:
+            db.session.execute(
+                update(OutreachEvent)
+                .where(OutreachEvent.id == event_id)
+                .values(attendance_count=OutreachEvent.attendance_count - lost)
+            )
+    db.session.commit()
+
+    result = {
+        'recorded': [patient_id for patient_id in accepted if patient_id in inserted],
+        'attendance_ids': [inserted[patient_id] for patient_id in accepted if patient_id in inserted],
+        'duplicates': [patient_id for patient_id in resolved
+                       if patient_id in already_recorded or (patient_id in accepted and patient_id not in inserted)],
+        'over_capacity': over_capacity,
+        'unknown': unknown
+    }
+    if audit and inserted:
+        event = db.session.get(OutreachEvent, event_id)
+        log_audit('event_attendance_bulk_recorded', 'outreach_event', event_id,
+                 f'{len(inserted)} attendances recorded at {event.title} '
+                 f'({len(result["duplicates"])} duplicates, {len(over_capacity)} over capacity, '
+                 f'{len(unknown)} unknown)')
+    return result
+
+def migrate_services(chunk_size=5000):
+    """Copy existing services_received text into attendance_service in id-range chunks
+
+    Safe to re-run; rows already migrated are skipped by the unique index.
+    """
+    low, high = db.session.execute(
+        select(func.min(EventAttendance.id), func.max(EventAttendance.id))
+        .where(EventAttendance.services_received.isnot(None), EventAttendance.services_received != '')
+    ).one()
+    if low is None:
+        return {'attendances': 0, 'services': 0}
+
+    attendances = services = 0
+    for start in range(low, high + 1, chunk_size):
+        rows = db.session.execute(
+            select(EventAttendance.id, EventAttendance.event_id, EventAttendance.services_received)
+            .where(EventAttendance.id >= start, EventAttendance.id < start + chunk_size,
+                   EventAttendance.services_received.isnot(None), EventAttendance.services_received != '')
+        ).all()
+        values = [
+            {'attendance_id': attendance_id, 'event_id': event_id, 'service': service}
+            for attendance_id, event_id, raw in rows for service in parse_services(raw)
+        ]
+        if values:
+            db.session.execute(_insert_services_ignoring_duplicates(), values)
+        db.session.commit()
+        attendances += len(rows)
+        services += len(values)
+    return {'attendances': attendances, 'services': services}
+
+SERVICE_GROUPINGS = ('service', 'event', 'ward')
+
+def service_counts(group_by='service', event_id=None, service=None, county=None, ward=None,
+                   start=None, end=None, where=()):
+    """Attendance counts per service, grouped by service, event or ward, in one GROUP BY
+
+    Events are filtered on their own dates and target area; ``where`` takes
+    extra clauses on OutreachEvent such as the caller's permission scope.
+    """
+    count = func.count(AttendanceService.id).label('count')
+    if group_by == 'event':
+        columns = [OutreachEvent.id, OutreachEvent.title, AttendanceService.service]
+    elif group_by == 'ward':
+        columns = [OutreachEvent.target_county, OutreachEvent.target_subcounty,
+                   OutreachEvent.target_ward, AttendanceService.service]
+    else:
+        columns = [AttendanceService.service]
+
+    query = (
+        select(*columns, count)
+        .join(OutreachEvent, OutreachEvent.id == AttendanceService.event_id)
+        .group_by(*columns)
+        .order_by(*columns[:-1], count.desc())
+    )
+    if event_id:
+        query = query.where(AttendanceService.event_id == event_id)
+    if service:
+        query = query.where(AttendanceService.service.in_(parse_services(service)))
+    if county:
+        query = query.where(func.lower(OutreachEvent.target_county) == county.strip().lower())
+    if ward:
+        query = query.where(func.lower(OutreachEvent.target_ward) == ward.strip().lower())
+    if start:
+        query = query.where(OutreachEvent.start_date >= start)
+    if end:
+        query = query.where(OutreachEvent.start_date < end)
+    for clause in where:
+        query = query.where(clause)
+
+    keys = [column.key for column in columns]
+    if group_by == 'event':
+        keys[:2] = ['event_id', 'title']
+    elif group_by == 'ward':
+        keys[:3] = ['county', 'subcounty', 'ward']
+    return [dict(zip(keys + ['count'], row)) for row in db.session.execute(query)]
+
+@app.cli.group('outreach')
+def outreach_cli():
+    """Outreach event commands"""
+
+@outreach_cli.command('migrate-services')
+@click.option('--chunk-size', default=5000, show_default=True, help='Attendances per transaction.')
+def migrate_services_command(chunk_size):
+    """Copy free-text services_received into the attendance_service table"""
+    result = migrate_services(chunk_size=chunk_size)
+    click.echo(f"Migrated {result['services']} services from {result['attendances']} attendances")
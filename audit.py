@@ -0,0 +1,297 @@
+import os
+import re
+import gzip
+import json
+import logging
+from datetime import datetime
+import click
+from sqlalchemy import MetaData, Table, Column, Index, select, text, func, inspect, and_, or_
+from sqlalchemy.schema import CreateIndex
+from app import app, db
+from models import AuditLog
+from jobs import job
+
+logger = logging.getLogger(__name__)
+
+# Monthly partitions (PostgreSQL) and rolling tables (other databases)
+# share the audit_log_YYYYMM naming scheme
+PARTITION_PATTERN = re.compile(r'^audit_log_(\d{4})(\d{2})$')
+# Rows that predate partitioning on PostgreSQL, bounded above by the month
+LEGACY_PATTERN = re.compile(r'^audit_log_before_(\d{4})(\d{2})$')
+
+_metadata = MetaData()
+
+def month_start(value):
+    return datetime(value.year, value.month, 1)
+
+def add_months(value, months):
+    index = value.year * 12 + value.month - 1 + months
+    return datetime(index // 12, index % 12 + 1, 1)
+
+def partition_name(value):
+    return f'audit_log_{value:%Y%m}'
+
+def _is_postgres():
+    return db.engine.dialect.name == 'postgresql'
+
+def audit_table(name):
+    """Table object for a partition or rolling table with AuditLog's columns"""
+    if name in _metadata.tables:
+        return _metadata.tables[name]
+
+    source = AuditLog.__table__
+    table = Table(name, _metadata, *[
+        Column(c.name, c.type, primary_key=c.primary_key) for c in source.columns
+    ])
+    for index in source.indexes:
+        Index(index.name.replace('audit_log', name, 1), *[table.c[c.name] for c in index.columns])
+    return table
+
+def is_partitioned():
+    """Whether audit_log is a PostgreSQL partitioned table"""
+    if not _is_postgres():
+        return False
+    return db.session.execute(text(
+        "SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = 'audit_log'"
+    )).first() is not None
+
+def list_partitions():
+    """Return {table_name: (start, end)} for audit partitions or rolling tables"""
+    if _is_postgres():
+        names = db.session.execute(text(
+            "SELECT c.relname FROM pg_inherits i "
+            "JOIN pg_class c ON c.oid = i.inhrelid "
+            "JOIN pg_class p ON p.oid = i.inhparent "
+            "WHERE p.relname = 'audit_log'"
+        )).scalars()
+    else:
+        names = inspect(db.engine).get_table_names()
+
+    partitions = {}
+    for name in names:
+        match = PARTITION_PATTERN.match(name)
+        if match:
+            start = datetime(int(match.group(1)), int(match.group(2)), 1)
+            partitions[name] = (start, add_months(start, 1))
+            continue
+        match = LEGACY_PATTERN.match(name)
+        if match:
+            partitions[name] = (datetime.min, datetime(int(match.group(1)), int(match.group(2)), 1))
+    return dict(sorted(partitions.items(), key=lambda item: item[1]))
+
+def partition_table():
+    """Convert audit_log into a monthly range-partitioned table (PostgreSQL)
+
+    Existing rows are not copied: the old table is attached as a single
+    partition covering everything up to the end of the current month, since
+    it is still receiving this month's rows while the conversion runs.
+    """
+    if not _is_postgres():
+        raise RuntimeError('Declarative partitioning requires PostgreSQL')
+    if is_partitioned():
+        return None
+
+    bound = add_months(month_start(datetime.utcnow()), 1)
+    legacy = f'audit_log_before_{bound:%Y%m}'
+    sequence = db.session.execute(text("SELECT pg_get_serial_sequence('audit_log', 'id')")).scalar()
+
+    statements = [
+        "LOCK TABLE audit_log IN ACCESS EXCLUSIVE MODE",
+        "UPDATE audit_log SET created_at = '1970-01-01' WHERE created_at IS NULL",
+        f"ALTER TABLE audit_log RENAME TO {legacy}",
+        f"ALTER TABLE {legacy} RENAME CONSTRAINT audit_log_pkey TO {legacy}_pkey",
+    ]
+    for index in AuditLog.__table__.indexes:
+        statements.append(f"ALTER INDEX IF EXISTS {index.name} RENAME TO {index.name.replace('audit_log', legacy, 1)}")
+    if sequence:
+        statements.append(f"ALTER SEQUENCE {sequence} OWNED BY NONE")
+    statements += [
+        f"CREATE TABLE audit_log (LIKE {legacy} INCLUDING DEFAULTS) PARTITION BY RANGE (created_at)",
+        "ALTER TABLE audit_log ALTER COLUMN created_at SET NOT NULL",
+        # Unique constraints on a partitioned table must include the partition key
+        "ALTER TABLE audit_log ADD PRIMARY KEY (id, created_at)",
+        f"ALTER TABLE {legacy} ADD CONSTRAINT {legacy}_range "
+        f"CHECK (created_at IS NOT NULL AND created_at < '{bound:%Y-%m-%d}')",
+        f"ALTER TABLE audit_log ATTACH PARTITION {legacy} FOR VALUES FROM (MINVALUE) TO ('{bound:%Y-%m-%d}')",
+    ]
+    if sequence:
+        statements.append(f"ALTER SEQUENCE {sequence} OWNED BY audit_log.id")
+
+    for statement in statements:
+        db.session.execute(text(statement))
+    # Indexes on the parent cascade to partitions; the renamed ones are reused
+    for index in AuditLog.__table__.indexes:
+        db.session.execute(CreateIndex(index, if_not_exists=True))
+    db.session.commit()
+
+    created = ensure_partitions()
+    db.session.execute(text("CREATE TABLE IF NOT EXISTS audit_log_default PARTITION OF audit_log DEFAULT"))
+    db.session.commit()
+    return [legacy] + created
+
+def ensure_partitions(months_ahead=2):
+    """Create monthly partitions for the current and upcoming months"""
+    if not is_partitioned():
+        return []
+
+    existing = list_partitions()
+    current = month_start(datetime.utcnow())
+    created = []
+    for offset in range(months_ahead + 1):
+        lower = add_months(current, offset)
+        upper = add_months(lower, 1)
+        name = partition_name(lower)
+        # The legacy partition from partition_table() covers the month of conversion
+        if name in existing or any(start < upper and end > lower for start, end in existing.values()):
+            continue
+        db.session.execute(text(
+            f"CREATE TABLE IF NOT EXISTS {name} PARTITION OF audit_log "
+            f"FOR VALUES FROM ('{lower:%Y-%m-%d}') TO ('{upper:%Y-%m-%d}')"
+        ))
+        created.append(name)
+    db.session.commit()
+    return created
+
+def rotate_hot_table(batch_size=5000):
+    """Move rows from before the current month into monthly rolling tables"""
+    boundary = month_start(datetime.utcnow())
+    oldest = db.session.query(func.min(AuditLog.created_at)).filter(
+        AuditLog.created_at < boundary
+    ).scalar()
+    if oldest is None:
+        return {}
+
+    hot = AuditLog.__table__
+    moved = {}
+    lower = month_start(oldest)
+    while lower < boundary:
+        upper = add_months(lower, 1)
+        name = partition_name(lower)
+        rolling = audit_table(name)
+        rolling.create(db.engine, checkfirst=True)
+
+        while True:
+            ids = db.session.execute(
+                select(hot.c.id)
+                .where(hot.c.created_at >= lower, hot.c.created_at < upper)
+                .order_by(hot.c.id)
+                .limit(batch_size)
+            ).scalars().all()
+            if not ids:
+                break
+            db.session.execute(rolling.insert().from_select(
+                [c.name for c in hot.columns],
+                select(*hot.columns).where(hot.c.id.in_(ids))
+            ))
+            db.session.execute(hot.delete().where(hot.c.id.in_(ids)))
+            db.session.commit()
+            moved[name] = moved.get(name, 0) + len(ids)
+        lower = upper
+    return moved
+
+def archive_partitions(retention_months=None, archive_dir=None):
+    """Write partitions older than the retention window to gzipped NDJSON and drop them"""
+    retention_months = retention_months or app.config['AUDIT_RETENTION_MONTHS']
+    archive_dir = archive_dir or app.config['AUDIT_ARCHIVE_DIR']
+    cutoff = add_months(month_start(datetime.utcnow()), -retention_months)
+    os.makedirs(archive_dir, exist_ok=True)
+
+    archived = []
+    for name, (_, end) in list_partitions().items():
+        if end > cutoff:
+            continue
+
+        table = audit_table(name)
+        path = os.path.join(archive_dir, f'{name}.ndjson.gz')
+        count = 0
+        with gzip.open(path + '.tmp', 'wt', encoding='utf-8', compresslevel=6) as fh:
+            rows = db.session.execute(
+                select(table).order_by(table.c.id).execution_options(yield_per=5000)
+            ).mappings()
+            for row in rows:
+                fh.write(json.dumps(dict(row), default=str) + '\n')
+                count += 1
+        os.replace(path + '.tmp', path)
+
+        if _is_postgres():
+            db.session.execute(text(f"ALTER TABLE audit_log DETACH PARTITION {name}"))
+        db.session.execute(text(f"DROP TABLE {name}"))
+        db.session.commit()
+        _metadata.remove(table)
+
+        logger.info('Archived %s rows from %s to %s', count, name, path)
+        archived.append({'table': name, 'rows': count, 'file': path})
+    return archived
+
+def search_audit(user_id=None, resource_type=None, resource_id=None, action=None,
+                 since=None, until=None, before=None, limit=50):
+    """Newest-first audit entries matching the filters
+
+    ``before`` is a (created_at, id) keyset cursor from the previous page.
+    """
+    tables = [AuditLog.__table__]
+    if not _is_postgres():
+        # Rolling tables are separate; only read the ones overlapping the range
+        for name, (start, end) in list_partitions().items():
+            if (since is None or end > since) and (until is None or start < until):
+                tables.append(audit_table(name))
+
+    rows = []
+    for table in tables:
+        conditions = []
+        if user_id is not None:
+            conditions.append(table.c.user_id == user_id)
+        if resource_type:
+            conditions.append(table.c.resource_type == resource_type)
+        if resource_id is not None:
+            conditions.append(table.c.resource_id == resource_id)
+        if action:
+            conditions.append(table.c.action == action)
+        if since:
+            conditions.append(table.c.created_at >= since)
+        if until:
+            conditions.append(table.c.created_at < until)
+        if before:
+            created_at, entry_id = before
+            conditions.append(or_(
+                table.c.created_at < created_at,
+                and_(table.c.created_at == created_at, table.c.id < entry_id)
+            ))
+
+        statement = select(table).where(*conditions).order_by(
+            table.c.created_at.desc(), table.c.id.desc()
+        ).limit(limit)
+        rows.extend(dict(row) for row in db.session.execute(statement).mappings())
+
+    rows.sort(key=lambda row: (row['created_at'] or datetime.min, row['id']), reverse=True)
+    return rows[:limit]
+
+@job('audit.maintain', max_attempts=3, every=86400)
+def maintain_audit_log():
+    """Roll or partition the audit log, then archive expired months"""
+    if _is_postgres():
+        result = {'created': ensure_partitions()}
+    else:
+        result = {'moved': rotate_hot_table()}
+    result['archived'] = archive_partitions()
+    return result
+
+@app.cli.group('audit')
+def audit_cli():
+    """Audit log storage commands"""
+
+@audit_cli.command('partition')
+def partition_command():
+    """Convert audit_log to monthly partitions (PostgreSQL only)"""
+    created = partition_table()
+    if created is None:
+        click.echo('audit_log is already partitioned')
+    else:
+        click.echo(f"Created partitions: {', '.join(created)}")
+
+@audit_cli.command('maintain')
+def maintain_command():
+    """Create/roll partitions and archive months past retention"""
+    result = maintain_audit_log()
+    click.echo(json.dumps(result, indent=2, default=str))
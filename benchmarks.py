@@ -0,0 +1,838 @@
+import os
+import sys
+import json
+import statistics
+import subprocess
+from datetime import datetime
+import click
+from app import app
+
+# Run in a fresh interpreter so every sample is a cold start
+_STARTUP_PROBE = """
+import json, time
+started = time.perf_counter()
+from main import app
+imported = time.perf_counter()
+response = app.test_client().get({path!r})
+finished = time.perf_counter()
+print(json.dumps({{
+    'import_ms': (imported - started) * 1000,
+    'first_request_ms': (finished - imported) * 1000,
+    'status': response.status_code
+}}))
+"""
+
+def summarize(samples):
+    """Latency summary in milliseconds"""
+    ordered = sorted(samples)
+    return {
+        'median': round(statistics.median(ordered), 2),
+        'p90': round(ordered[min(len(ordered) - 1, int(len(ordered) * 0.9))], 2),
+        'min': round(ordered[0], 2),
+        'max': round(ordered[-1], 2)
+    }
+
+def report(result, output=None):
+    """Print a benchmark result and optionally append it to a JSON-lines file"""
+    result.setdefault('at', datetime.utcnow().isoformat())
+    click.echo(json.dumps(result, indent=2))
+    if output:
+        with open(output, 'a') as fh:
+            fh.write(json.dumps(result) + '\n')
+
+@app.cli.group('bench')
+def bench_cli():
+    """Performance benchmarks"""
+
+@bench_cli.command('startup')
+@click.option('--runs', default=5, show_default=True)
+@click.option('--path', default='/login', show_default=True, help='URL of the first request.')
+@click.option('--output', type=click.Path(), help='Append the result as a JSON line for tracking over time.')
+def startup_command(runs, path, output):
+    """Time cold imports and first-request latency"""
+    samples = []
+    for _ in range(runs):
+        probe = subprocess.run(
+            [sys.executable, '-c', _STARTUP_PROBE.format(path=path)],
+            capture_output=True, text=True, cwd=app.root_path, env=os.environ
+        )
+        if probe.returncode:
+            raise click.ClickException(probe.stderr)
+        samples.append(json.loads(probe.stdout.strip().splitlines()[-1]))
+
+    report({
+        'benchmark': 'startup',
+        'runs': runs,
+        'path': path,
+        'status': samples[-1]['status'],
+        'import_ms': summarize([s['import_ms'] for s in samples]),
+        'first_request_ms': summarize([s['first_request_ms'] for s in samples])
+    }, output)
+
+@bench_cli.command('capacity')
+@click.option('--writers', default=16, show_default=True, help='Concurrent threads recording attendance.')
+@click.option('--patients', default=400, show_default=True, help='Distinct patients submitted (each twice).')
+@click.option('--capacity', default=250, show_default=True, help='max_participants for the event.')
+@click.option('--output', type=click.Path())
+def capacity_command(writers, patients, capacity, output):
+    """Concurrent attendance writers against one capacity-limited event"""
+    import time
+    import threading
+    from datetime import date
+    from sqlalchemy import func, delete
+    from app import db
+    from models import Patient, OutreachEvent, EventAttendance, User
+    from attendance import record_attendances
+
+    tag = f'BENCH{int(time.time())}'
+    organizer = User.query.first()
+    if organizer is None:
+        raise click.ClickException('Create at least one user first')
+
+    event = OutreachEvent(title=tag, event_type='screening', start_date=datetime.utcnow(),
+                          end_date=datetime.utcnow(), location='benchmark',
+                          organizer_id=organizer.id, max_participants=capacity)
+    db.session.add(event)
+    db.session.add_all([
+        Patient(patient_number=f'{tag}{i:06d}', first_name='Bench', last_name=str(i),
+                date_of_birth=date(1990, 1, 1), gender='other')
+        for i in range(patients)
+    ])
+    db.session.commit()
+    event_id = event.id
+    patient_ids = db.session.execute(
+        db.select(Patient.id).where(Patient.patient_number.like(f'{tag}%'))
+    ).scalars().all()
+
+    # Every patient is submitted twice to exercise the duplicate path
+    work = patient_ids * 2
+    lock = threading.Lock()
+    latencies, errors = [], []
+
+    def writer():
+        with app.app_context():
+            while True:
+                with lock:
+                    if not work:
+                        return
+                    patient_id = work.pop()
+                started = time.perf_counter()
+                try:
+                    record_attendances(event_id, patient_ids=[patient_id], audit=False)
+                except Exception as e:
+                    db.session.rollback()
+                    errors.append(type(e).__name__)
+                finally:
+                    db.session.remove()
+                latencies.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    threads = [threading.Thread(target=writer) for _ in range(writers)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - started
+
+    db.session.expire_all()
+    rows = db.session.execute(
+        db.select(func.count(EventAttendance.id)).where(EventAttendance.event_id == event_id)
+    ).scalar()
+    distinct = db.session.execute(
+        db.select(func.count(func.distinct(EventAttendance.patient_id))).where(EventAttendance.event_id == event_id)
+    ).scalar()
+    counter = db.session.get(OutreachEvent, event_id).attendance_count
+
+    report({
+        'benchmark': 'capacity',
+        'writers': writers,
+        'submissions': len(patient_ids) * 2,
+        'capacity': capacity,
+        'throughput_per_s': round(len(latencies) / elapsed, 1),
+        'latency_ms': summarize(latencies),
+        'errors': len(errors),
+        'attendance_rows': rows,
+        'counter': counter,
+        'correct': rows == distinct == counter == min(capacity, len(patient_ids))
+    }, output)
+
+    db.session.execute(delete(EventAttendance).where(EventAttendance.event_id == event_id))
+    db.session.execute(delete(OutreachEvent).where(OutreachEvent.id == event_id))
+    db.session.execute(delete(Patient).where(Patient.patient_number.like(f'{tag}%')))
+    db.session.commit()
+
+@bench_cli.command('reconcile')
+@click.option('--lines', default=1000000, show_default=True, help='Statement lines to generate.')
+@click.option('--payments', default=20000, show_default=True, help='Pending payments to create.')
+@click.option('--output', type=click.Path())
+def reconcile_command(lines, payments, output):
+    """Reconcile a synthetic provider statement against pending payments"""
+    import csv
+    import time
+    import tempfile
+    from sqlalchemy import insert, delete
+    from app import db
+    from models import Payment
+    from reconciliation import reconcile
+
+    tag = f'BENCH{int(time.time())}'
+    references = [f'{tag}{i:07d}' for i in range(payments)]
+    now = datetime.utcnow()
+    db.session.execute(insert(Payment), [{
+        'payment_reference': reference, 'amount': 100.0, 'currency': 'KES',
+        'payment_type': 'patient_fee', 'status': 'pending', 'created_at': now
+    } for reference in references])
+    db.session.commit()
+
+    # Half the payments settle, a few mismatch, the rest of the file is other merchants' noise
+    with tempfile.NamedTemporaryFile('w', suffix='.csv', delete=False, newline='') as fh:
+        statement_path = fh.name
+        writer = csv.writer(fh)
+        writer.writerow(['invoice_id', 'api_ref', 'state', 'value'])
+        for i in range(lines):
+            if i < payments // 2:
+                writer.writerow([f'INV{i}', references[i], 'COMPLETE', '100.0' if i % 100 else '99.0'])
+            else:
+                writer.writerow([f'INV{i}', f'OTHER{i}', 'COMPLETE', '50.0'])
+
+    started = time.perf_counter()
+    result = reconcile(statement_path, window_days=1, report_path=statement_path + '.report.csv')
+    elapsed = time.perf_counter() - started
+
+    report({
+        'benchmark': 'reconcile',
+        'lines': lines,
+        'payments': payments,
+        'seconds': round(elapsed, 2),
+        'lines_per_s': round(lines / elapsed),
+        'updated': result['updated'],
+        'discrepancies': result['discrepancies'],
+        'correct': result['updated'] == payments // 2 - len(range(0, payments // 2, 100))
+    }, output)
+
+    db.session.execute(delete(Payment).where(Payment.payment_reference.like(f'{tag}%')))
+    db.session.commit()
+    os.remove(statement_path)
+    os.remove(statement_path + '.report.csv')
+
+@bench_cli.command('permissions')
+@click.option('--iterations', default=2000, show_default=True)
+@click.option('--output', type=click.Path())
+def permissions_command(iterations, output):
+    """Per-request cost of permission resolution and patient access checks"""
+    import time
+    from flask_login import login_user
+    from app import db
+    from models import User, Patient
+    from permissions import Permission, can, permissions, can_access_patient, patient_filter
+
+    chw = User.query.filter_by(role='chw').first()
+    if chw is None:
+        raise click.ClickException('Create at least one CHW first')
+    patient = Patient.query.filter_by(assigned_chw_id=chw.id).first() or Patient.query.first()
+    if patient is None:
+        raise click.ClickException('Create at least one patient first')
+
+    def timed(check):
+        samples = []
+        for _ in range(iterations):
+            with app.test_request_context():
+                login_user(chw)
+                started = time.perf_counter()
+                check()
+                samples.append((time.perf_counter() - started) * 1000)
+        return summarize(samples)
+
+    def legacy_check():
+        loaded = db.session.get(Patient, patient.id)
+        db.session.expunge(loaded)
+        return chw.role == 'chw' and loaded.assigned_chw_id != chw.id
+
+    def resolve_many():
+        for _ in range(10):
+            can(Permission.MANAGE_PATIENTS)
+
+    report({
+        'benchmark': 'permissions',
+        'iterations': iterations,
+        'resolve_once_ms': timed(permissions),
+        'ten_checks_ms': timed(resolve_many),
+        'scoped_exists_ms': timed(lambda: can_access_patient(patient.id)),
+        'load_then_compare_ms': timed(legacy_check),
+        'scoped_count_ms': timed(lambda: Patient.query.filter(patient_filter()).count())
+    }, output)
+
+@bench_cli.command('fhir-export')
+@click.option('--patients', default=250000, show_default=True, help='Synthetic patients to create.')
+@click.option('--encounters', default=3, show_default=True, help='Encounters per patient.')
+@click.option('--output', type=click.Path())
+def fhir_export_command(patients, encounters, output):
+    """Bulk $export throughput and peak memory over synthetic patients and encounters"""
+    import time
+    import shutil
+    import resource
+    from datetime import date
+    from sqlalchemy import insert, delete, select, func
+    from app import db
+    from models import Patient, HealthRecord
+    from fhir import run_export, export_dir
+
+    tag = f'FHIRBENCH{int(time.time())}'
+    now = datetime.utcnow()
+    first_id = (db.session.execute(select(func.max(Patient.id))).scalar() or 0) + 1
+    for start in range(0, patients, 10000):
+        db.session.execute(insert(Patient), [{
+            'patient_number': f'{tag}{i:08d}', 'first_name': 'Bench', 'last_name': f'Patient {i}',
+            'date_of_birth': date(1980, 1, 1), 'gender': 'female', 'phone_number': '0700000000',
+            'county': 'kisumu', 'subcounty': 'kisumu central', 'ward': 'market milimani',
+            'status': 'active', 'created_at': now, 'updated_at': now
+        } for i in range(start, min(start + 10000, patients))])
+        db.session.execute(insert(HealthRecord), [{
+            'patient_id': first_id + i, 'encounter_date': now, 'encounter_type': 'screening',
+            'chief_complaint': 'Routine screening', 'facility_name': 'Bench Dispensary', 'created_at': now
+        } for i in range(start, min(start + 10000, patients)) for _ in range(encounters)])
+        db.session.commit()
+
+    rss_before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    started = time.perf_counter()
+    manifest = run_export(tag, ['Patient', 'Encounter'], since=now.isoformat())
+    elapsed = time.perf_counter() - started
+    rss_after = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+
+    total = sum(entry['count'] for entry in manifest['output'])
+    size = sum(os.path.getsize(os.path.join(export_dir(tag), entry['file'])) for entry in manifest['output'])
+    report({
+        'benchmark': 'fhir-export',
+        'resources': total,
+        'seconds': round(elapsed, 2),
+        'resources_per_s': round(total / elapsed),
+        'mb_written': round(size / 1e6, 1),
+        'peak_rss_growth_mb': round((rss_after - rss_before) / 1024, 1),
+        'counts': {entry['type']: entry['count'] for entry in manifest['output']}
+    }, output)
+
+    shutil.rmtree(export_dir(tag), ignore_errors=True)
+    db.session.execute(delete(HealthRecord).where(HealthRecord.patient_id >= first_id,
+                                                  HealthRecord.facility_name == 'Bench Dispensary'))
+    db.session.execute(delete(Patient).where(Patient.patient_number.like(f'{tag}%')))
+    db.session.commit()
+
+@bench_cli.command('services')
+@click.option('--attendances', default=1000000, show_default=True, help='Synthetic attendances to create.')
+@click.option('--events', default=200, show_default=True)
+@click.option('--output', type=click.Path())
+def services_command(attendances, events, output):
+    """Per-service campaign counts: SQL GROUP BY against parsing services_received in Python"""
+    import time
+    import random
+    from sqlalchemy import insert, delete, select, func
+    from app import db
+    from models import User, OutreachEvent, EventAttendance, AttendanceService
+    from attendance import parse_services, service_counts
+
+    organizer = User.query.first()
+    if organizer is None:
+        raise click.ClickException('Create at least one user first')
+    tag = f'SVCBENCH{int(time.time())}'
+    now = datetime.utcnow()
+    db.session.execute(insert(OutreachEvent), [{
+        'title': f'{tag} {i}', 'event_type': 'vaccination', 'start_date': now, 'end_date': now,
+        'location': 'bench', 'target_county': 'kisumu', 'target_ward': f'ward {i % 20}',
+        'organizer_id': organizer.id, 'attendance_count': 0
+    } for i in range(events)])
+    event_ids = db.session.execute(select(OutreachEvent.id).where(OutreachEvent.title.like(f'{tag}%'))).scalars().all()
+
+    # Patient ids are not checked by SQLite foreign keys; pairs stay unique per event
+    catalogue = ['opv', 'bcg', 'measles', 'vitamin a', 'deworming', 'pentavalent']
+    first_id = (db.session.execute(select(func.max(EventAttendance.id))).scalar() or 0) + 1
+    rng = random.Random(1)
+    for start in range(0, attendances, 20000):
+        chunk = range(start, min(start + 20000, attendances))
+        picks = {i: rng.sample(catalogue, rng.randint(1, 3)) for i in chunk}
+        db.session.execute(insert(EventAttendance), [{
+            'id': first_id + i, 'event_id': event_ids[i % events], 'patient_id': i // events + 1,
+            'services_received': ', '.join(picks[i]), 'attendance_date': now, 'created_at': now
+        } for i in chunk])
+        db.session.execute(insert(AttendanceService), [{
+            'attendance_id': first_id + i, 'event_id': event_ids[i % events], 'service': service
+        } for i in chunk for service in picks[i]])
+        db.session.commit()
+
+    started = time.perf_counter()
+    counts = {}
+    for (raw,) in db.session.execute(select(EventAttendance.services_received)
+                                     .where(EventAttendance.event_id.in_(event_ids))):
+        for service in parse_services(raw):
+            counts[service] = counts.get(service, 0) + 1
+    parse_s = time.perf_counter() - started
+
+    timings = {}
+    for group_by in ('service', 'event', 'ward'):
+        started = time.perf_counter()
+        service_counts(group_by=group_by, where=[OutreachEvent.id.in_(event_ids)])
+        timings[group_by] = round(time.perf_counter() - started, 3)
+    single = time.perf_counter()
+    service_counts(event_id=event_ids[0], service='opv')
+    single_ms = (time.perf_counter() - single) * 1000
+
+    totals = {row['service']: row['count'] for row in service_counts(where=[OutreachEvent.id.in_(event_ids)])}
+    report({
+        'benchmark': 'services',
+        'attendances': attendances,
+        'python_parse_s': round(parse_s, 2),
+        'sql_group_by_s': timings,
+        'one_event_one_service_ms': round(single_ms, 2),
+        'correct': totals == counts
+    }, output)
+
+    db.session.execute(delete(AttendanceService).where(AttendanceService.event_id.in_(event_ids)))
+    db.session.execute(delete(EventAttendance).where(EventAttendance.event_id.in_(event_ids)))
+    db.session.execute(delete(OutreachEvent).where(OutreachEvent.id.in_(event_ids)))
+    db.session.commit()
+
+async def _http_load(port, path, cookie, clients, requests_per_client):
+    """Closed-loop load: each client sends its requests one after another on fresh connections"""
+    import time
+    import asyncio
+
+    request_bytes = (
+        f'GET {path} HTTP/1.1\r\nHost: 127.0.0.1:{port}\r\nCookie: session={cookie}\r\n'
+        f'Connection: close\r\n\r\n'
+    ).encode()
+    latencies, errors = [], 0
+
+    async def client():
+        nonlocal errors
+        for _ in range(requests_per_client):
+            started = time.perf_counter()
+            try:
+                reader, writer = await asyncio.open_connection('127.0.0.1', port)
+                writer.write(request_bytes)
+                await writer.drain()
+                response = await reader.read()
+                writer.close()
+                ok = response.startswith(b'HTTP/1.1 200')
+            except OSError:
+                ok = False
+            if ok:
+                latencies.append((time.perf_counter() - started) * 1000)
+            else:
+                errors += 1
+
+    started = time.perf_counter()
+    await asyncio.gather(*(client() for _ in range(clients)))
+    elapsed = time.perf_counter() - started
+    return {
+        'requests_per_s': round(len(latencies) / elapsed, 1),
+        'errors': errors,
+        'latency_ms': summarize(latencies) if latencies else None,
+        'p99_ms': round(sorted(latencies)[int(len(latencies) * 0.99) - 1], 2) if latencies else None
+    }
+
+@bench_cli.command('async')
+@click.option('--clients', default=1000, show_default=True, help='Concurrent clients.')
+@click.option('--requests', 'requests_per_client', default=5, show_default=True, help='Requests per client.')
+@click.option('--workers', default=2, show_default=True, help='Server processes for each tier.')
+@click.option('--path', default='/api/patients/search?q=bench', show_default=True)
+@click.option('--output', type=click.Path())
+def async_command(clients, requests_per_client, workers, path, output):
+    """Sync gunicorn workers against the ASGI tier at high client concurrency"""
+    import time
+    import socket
+    import asyncio
+    import subprocess
+    from datetime import date
+    from sqlalchemy import insert, delete
+    from app import db
+    from models import User, Patient
+
+    admin = User.query.filter_by(role='admin', is_active=True).first()
+    if admin is None:
+        raise click.ClickException('Create an active admin user first')
+    tag = f'ASYNCBENCH{int(time.time())}'
+    now = datetime.utcnow()
+    db.session.execute(insert(Patient), [{
+        'patient_number': f'{tag}{i:05d}', 'first_name': 'Bench', 'last_name': f'Patient {i}',
+        'date_of_birth': date(1990, 1, 1), 'gender': 'female', 'status': 'active',
+        'created_at': now, 'updated_at': now
+    } for i in range(1000)])
+    db.session.commit()
+    cookie = app.session_interface.get_signing_serializer(app).dumps({'_user_id': str(admin.id), '_fresh': True})
+
+    tiers = {
+        'sync': [sys.executable, '-m', 'gunicorn', '--workers', str(workers), '--bind', '127.0.0.1:{port}',
+                 '--backlog', '4096', 'main:app'],
+        'async': [sys.executable, '-m', 'uvicorn', 'asgi:application', '--workers', str(workers),
+                  '--port', '{port}', '--backlog', '4096', '--log-level', 'warning', '--no-access-log'],
+    }
+    results = {}
+    try:
+        for name, command in tiers.items():
+            with socket.socket() as probe:
+                probe.bind(('127.0.0.1', 0))
+                port = probe.getsockname()[1]
+            server = subprocess.Popen([part.format(port=port) for part in command], cwd=app.root_path,
+                                      env=dict(os.environ, GUNICORN_PRELOAD='0'),
+                                      stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+            try:
+                for _ in range(100):
+                    try:
+                        socket.create_connection(('127.0.0.1', port), timeout=1).close()
+                        break
+                    except OSError:
+                        time.sleep(0.2)
+                # Warm every worker's connection pool and imports before measuring
+                asyncio.run(_http_load(port, path, cookie, workers * 10, 2))
+                results[name] = asyncio.run(_http_load(port, path, cookie, clients, requests_per_client))
+            finally:
+                server.terminate()
+                server.wait()
+    finally:
+        db.session.execute(delete(Patient).where(Patient.patient_number.like(f'{tag}%')))
+        db.session.commit()
+
+    report({
+        'benchmark': 'async',
+        'clients': clients,
+        'requests_per_client': requests_per_client,
+        'workers': workers,
+        'path': path,
+        **results
+    }, output)
+
+@bench_cli.command('identifiers')
+@click.option('--rows', default=1000000, show_default=True, help='Identifiers inserted per scheme.')
+@click.option('--batch', default=1000, show_default=True, help='Rows per INSERT and commit.')
+@click.option('--output', type=click.Path())
+def identifiers_command(rows, batch, output):
+    """Insert throughput into a unique index: uuid-suffixed numbers against block-allocated sequence ones"""
+    import time
+    import uuid
+    from sqlalchemy import MetaData, Table, Column, Integer, String, delete, select, func
+    from app import db
+    from models import IdentifierSequence
+    from identifiers import BlockAllocator, format_identifier, is_valid
+
+    # Scratch table shaped like patient.patient_number, so only the key order differs
+    table = Table(f'identifier_bench_{int(time.time())}', MetaData(),
+                  Column('id', Integer, primary_key=True),
+                  Column('reference', String(50), unique=True, nullable=False))
+    table.create(db.engine)
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    statement = dialect_insert(table).on_conflict_do_nothing(index_elements=['reference'])
+
+    def legacy():
+        return f"CHS{datetime.utcnow().strftime('%Y%m%d')}{str(uuid.uuid4())[:8].upper()}"
+
+    allocator = BlockAllocator('identifier_bench')
+    def sequenced():
+        return format_identifier('CHS', datetime.utcnow(), allocator.take()[0])
+
+    def many(generate):
+        return lambda count: [generate() for _ in range(count)]
+
+    def sequenced_bulk(count):
+        # What an import does: one patient_numbers(count) call per batch
+        today = datetime.utcnow()
+        return [format_identifier('CHS', today, value) for value in allocator.take(count)]
+
+    results = {}
+    try:
+        for scheme, generate in (('uuid_suffix', many(legacy)), ('sequence', many(sequenced)),
+                                 ('sequence_bulk', sequenced_bulk)):
+            db.session.execute(delete(table))
+            db.session.commit()
+            started = time.perf_counter()
+            for start in range(0, rows, batch):
+                db.session.execute(statement, [{'reference': reference}
+                                               for reference in generate(min(batch, rows - start))])
+                db.session.commit()
+            elapsed = time.perf_counter() - started
+            stored = db.session.execute(select(func.count()).select_from(table)).scalar()
+            results[scheme] = {
+                'seconds': round(elapsed, 2),
+                'rows_per_s': round(rows / elapsed),
+                # Rows dropped by ON CONFLICT, i.e. IntegrityErrors without it
+                'collisions': rows - stored
+            }
+        sample = sequenced()
+    finally:
+        db.session.rollback()
+        table.drop(db.engine)
+        db.session.execute(delete(IdentifierSequence).where(IdentifierSequence.name == 'identifier_bench'))
+        db.session.commit()
+
+    report({
+        'benchmark': 'identifiers',
+        'rows': rows,
+        'batch': batch,
+        'schemes': results,
+        'speedup': round(results['uuid_suffix']['seconds'] / results['sequence']['seconds'], 2),
+        'sample': sample,
+        'sample_valid': is_valid(sample)
+    }, output)
+
+@bench_cli.command('logging')
+@click.option('--requests', 'count', default=500, show_default=True, help='Requests per configuration per round.')
+@click.option('--rounds', default=5, show_default=True, help='Configurations alternate each round; medians are reported.')
+@click.option('--path', default='/patients', show_default=True)
+@click.option('--output', type=click.Path())
+def logging_command(count, rounds, path, output):
+    """Per-request logging cost at INFO: the queued JSON pipeline against the old global DEBUG setup"""
+    import time
+    import logging
+    import threading
+    from datetime import date
+    from sqlalchemy import insert, delete
+    from app import db
+    from models import User, Patient
+    import logs
+
+    class CountingSink:
+        """Stands in for stderr so terminal speed does not skew the result"""
+        lines = 0
+
+        def write(self, text):
+            self.lines += text.count('\n')
+
+        def flush(self):
+            pass
+
+    admin = User.query.filter_by(role='admin').first()
+    if admin is None:
+        raise click.ClickException('Create an admin user first')
+    tag = f'LOGBENCH{int(time.time())}'
+    now = datetime.utcnow()
+    db.session.execute(insert(Patient), [{
+        'patient_number': f'{tag}{i:04d}', 'first_name': 'Bench', 'last_name': f'Patient {i}',
+        'date_of_birth': date(1980, 1, 1), 'gender': 'female', 'county': 'kisumu',
+        'status': 'active', 'created_at': now, 'updated_at': now
+    } for i in range(50)])
+    db.session.commit()
+
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = str(admin.id)
+        session['_fresh'] = True
+
+    def legacy(sink):
+        # What app.py used to do: basicConfig(level=DEBUG), SQLAlchemy and all
+        logging.basicConfig(level=logging.DEBUG, stream=sink, force=True)
+        for name in logging.root.manager.loggerDict:
+            logging.getLogger(name).setLevel(logging.NOTSET)
+        logs.access_logger.disabled = True
+
+    def pipeline(sink):
+        logs.access_logger.disabled = False
+        return logs.configure(level='INFO', levels=app.config['LOG_LEVELS'], fmt='json', stream=sink)
+
+    def silent(sink):
+        logging.basicConfig(level=logging.CRITICAL, stream=sink, force=True)
+        logs.access_logger.disabled = True
+
+    def measure(setup):
+        sink = CountingSink()
+        handler = setup(sink)
+        for _ in range(50):
+            client.get(path)
+        if handler:
+            handler.flush()
+        sink.lines = 0
+        started = time.perf_counter()
+        for _ in range(count):
+            client.get(path)
+        request_s = time.perf_counter() - started
+        if handler:
+            # Include the listener's formatting and writing in the total
+            handler.flush()
+        total_s = time.perf_counter() - started
+        return {
+            'us_per_request': round(total_s / count * 1e6),
+            'request_path_us': round(request_s / count * 1e6),
+            'lines_per_request': round(sink.lines / count, 1)
+        }
+
+    samples = {}
+    try:
+        for _ in range(rounds):
+            for name, setup in (('off', silent), ('legacy_debug', legacy), ('queued_json_info', pipeline)):
+                # A fresh thread has no app context from the CLI, so each request
+                # gets its own context and database session as under gunicorn
+                worker = threading.Thread(target=lambda: samples.setdefault(name, []).append(measure(setup)))
+                worker.start()
+                worker.join()
+    finally:
+        logs.access_logger.disabled = False
+        logs.configure_from(app.config)
+        db.session.execute(delete(Patient).where(Patient.patient_number.like(f'{tag}%')))
+        db.session.commit()
+
+    results = {
+        name: {field: statistics.median(run[field] for run in runs) for field in runs[0]}
+        for name, runs in samples.items()
+    }
+    for name in ('legacy_debug', 'queued_json_info'):
+        results[name]['overhead_us'] = results[name]['us_per_request'] - results['off']['us_per_request']
+    report({'benchmark': 'logging', 'path': path, 'requests': count * rounds, **results}, output)
+
+@bench_cli.command('caseloads')
+@click.option('--patients', default=300000, show_default=True)
+@click.option('--chws', default=1000, show_default=True)
+@click.option('--wards', default=200, show_default=True, help='Wards across 20 subcounties; some are left without a CHW.')
+@click.option('--output', type=click.Path())
+def caseloads_command(patients, chws, wards, output):
+    """Time a full balancing run (assignment and rebalancing) over a synthetic county"""
+    import time
+    import random
+    from datetime import date
+    from sqlalchemy import insert, delete, select, func
+    from app import db
+    from models import User, Patient
+    from caseloads import plan, apply
+
+    county = f'bench-{int(time.time())}'
+    rng = random.Random(7)
+    ward_names = [(f'sub-{n % 20}', f'ward-{n}') for n in range(wards)]
+    # Every seventh ward has no CHW, so its patients fall back to the subcounty
+    staffed = [ward for n, ward in enumerate(ward_names) if n % 7]
+
+    started = time.perf_counter()
+    db.session.execute(insert(User), [{
+        'username': f'{county}-chw-{n}', 'email': f'{county}-chw-{n}@example.com', 'password_hash': '-',
+        'first_name': 'Bench', 'last_name': str(n), 'role': 'chw', 'county': county,
+        'subcounty': staffed[n % len(staffed)][0], 'ward': staffed[n % len(staffed)][1], 'is_active': True
+    } for n in range(chws)])
+    chw_wards = {}
+    for chw_id, ward in db.session.execute(select(User.id, User.ward).where(User.county == county)):
+        chw_wards.setdefault(ward, []).append(chw_id)
+
+    rows = []
+    for n in range(patients):
+        subcounty, ward = ward_names[n % len(ward_names)]
+        # A third unassigned, the rest piled onto the first CHW of the ward
+        owner = chw_wards[ward][0] if ward in chw_wards and n % 3 else None
+        rows.append({
+            'patient_number': f'{county}-{n}', 'first_name': 'Bench', 'last_name': str(n),
+            'date_of_birth': date(1990, 1, 1), 'gender': rng.choice(('male', 'female')),
+            'county': county, 'subcounty': subcounty, 'ward': ward, 'status': 'active',
+            'assigned_chw_id': owner
+        })
+    for start in range(0, patients, 10000):
+        db.session.execute(insert(Patient), rows[start:start + 10000])
+    db.session.commit()
+    seeded = time.perf_counter() - started
+
+    try:
+        started = time.perf_counter()
+        moves, summary = plan(county, rebalance=True)
+        planned = time.perf_counter() - started
+        started = time.perf_counter()
+        applied = apply(moves)
+        applied_s = time.perf_counter() - started
+
+        loads = [count for (count,) in db.session.execute(
+            select(func.count(Patient.id)).where(Patient.county == county, Patient.assigned_chw_id.isnot(None))
+            .group_by(Patient.assigned_chw_id)
+        )]
+        left = db.session.execute(
+            select(func.count(Patient.id)).where(Patient.county == county, Patient.assigned_chw_id.is_(None))
+        ).scalar()
+    finally:
+        db.session.rollback()
+        db.session.execute(delete(Patient).where(Patient.county == county))
+        db.session.execute(delete(User).where(User.county == county))
+        db.session.commit()
+
+    report({
+        'benchmark': 'caseloads',
+        'patients': patients,
+        'chws': chws,
+        'wards': wards,
+        'seed_seconds': round(seeded, 2),
+        'plan_seconds': round(planned, 2),
+        'apply_seconds': round(applied_s, 2),
+        'moves': len(moves),
+        'applied': applied,
+        'ward_match': summary['ward_match'],
+        'subcounty_match': summary['subcounty_match'],
+        'rebalanced': summary['rebalanced'],
+        'unassigned_after': left,
+        'load_min': min(loads, default=0),
+        'load_max': max(loads, default=0)
+    }, output)
+
+@bench_cli.command('archive')
+@click.option('--patients', default=200000, show_default=True)
+@click.option('--records', default=3, show_default=True, help='Health records per patient.')
+@click.option('--inactive', default=0.4, show_default=True, help='Share of patients inactive or deceased for years.')
+@click.option('--old', default=0.5, show_default=True, help='Share of records and payments older than the cutoff.')
+@click.option('--output', type=click.Path())
+def archive_command(patients, records, inactive, old, output):
+    """Hot table size and query times before and after an archive run (needs an empty patient table)"""
+    import time
+    import random
+    from datetime import date, timedelta
+    from sqlalchemy import insert, delete, select, func
+    from app import db
+    from models import Patient, HealthRecord, Payment
+    import archive
+
+    if db.session.execute(select(func.count(Patient.id))).scalar():
+        raise click.ClickException('Run against a scratch database: the archive run would move real patients')
+
+    rng = random.Random(11)
+    now = datetime.utcnow()
+    long_ago = now - timedelta(days=round(365.25 * (app.config['ARCHIVE_AFTER_YEARS'] + 1)))
+    tag = f'archive-bench-{int(time.time())}'
+    started = time.perf_counter()
+    rows = []
+    for n in range(patients):
+        cold = rng.random() < inactive
+        rows.append({
+            'patient_number': f'{tag}-{n}', 'first_name': 'Bench', 'last_name': f'Patient{n}',
+            'date_of_birth': date(1990, 1, 1), 'gender': 'female', 'county': 'nairobi',
+            'status': rng.choice(('inactive', 'deceased')) if cold else 'active',
+            'created_at': long_ago if cold else now, 'updated_at': long_ago if cold else now
+        })
+    for start in range(0, patients, 10000):
+        db.session.execute(insert(Patient), rows[start:start + 10000])
+    ids = db.session.execute(select(Patient.id).where(Patient.patient_number.like(f'{tag}-%'))).scalars().all()
+
+    def when():
+        return long_ago if rng.random() < old else now
+
+    children = [{'patient_id': patient_id, 'encounter_type': 'home_visit', 'encounter_date': when(),
+                 'county': 'nairobi', 'chief_complaint': 'Cough'} for patient_id in ids for _ in range(records)]
+    for start in range(0, len(children), 10000):
+        db.session.execute(insert(HealthRecord), children[start:start + 10000])
+    payments = [{'payment_reference': f'{tag}-{patient_id}', 'amount': 100.0, 'payment_type': 'patient_fee',
+                 'status': 'completed', 'patient_id': patient_id, 'created_at': when()} for patient_id in ids]
+    for start in range(0, len(payments), 10000):
+        db.session.execute(insert(Payment), payments[start:start + 10000])
+    db.session.commit()
+    seeded = time.perf_counter() - started
+
+    try:
+        started = time.perf_counter()
+        result = archive.run_archive()
+        elapsed = time.perf_counter() - started
+    finally:
+        db.session.rollback()
+        for model in reversed(archive.ARCHIVED_MODELS):
+            for table in (model.__table__, archive.archive_table(model)):
+                db.session.execute(delete(table))
+        db.session.commit()
+
+    report({
+        'benchmark': 'archive',
+        'patients': patients,
+        'records_per_patient': records,
+        'seed_seconds': round(seeded, 2),
+        'run_seconds': round(elapsed, 2),
+        'moved': result['moved'],
+        'hot_rows': {table: counts for table, counts in result['hot_rows'].items() if counts['before']},
+        'probe_ms': result['probe_ms']
+    }, output)
@@ -0,0 +1,428 @@
+import os
+import json
+import time
+import uuid
+import pickle
+import sqlite3
+import threading
+from collections import OrderedDict
+import click
+from app import app
+
+try:
+    import redis
+except ImportError:  # Optional: only needed for CACHE_BACKEND=redis
+    redis = None
+
+_MISSING = object()
+
+class CacheMetrics:
+    """Hit/miss/eviction counters shared by every backend"""
+
+    FIELDS = ('hits', 'misses', 'sets', 'evictions', 'invalidations', 'waits')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            self.counts[field] += amount
+
+    def snapshot(self):
+        with self._lock:
+            counts = dict(self.counts)
+        lookups = counts['hits'] + counts['misses']
+        counts['hit_rate'] = round(counts['hits'] / lookups, 3) if lookups else None
+        return counts
+
+class MemoryBackend:
+    """In-process LRU with per-entry TTL; each worker has its own copy"""
+
+    def __init__(self, max_entries=10000, metrics=None):
+        self.max_entries = max_entries
+        self.metrics = metrics or CacheMetrics()
+        self._entries = OrderedDict()  # key -> (expires, value, tags)
+        self._tags = {}  # tag -> set of keys
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                return _MISSING
+            if entry[0] < time.time():
+                self._remove(key)
+                return _MISSING
+            self._entries.move_to_end(key)
+            return entry[1]
+
+    def set(self, key, value, ttl, tags=()):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+            self._entries[key] = (time.time() + ttl, value, tuple(tags))
+            for tag in tags:
+                self._tags.setdefault(tag, set()).add(key)
+            while len(self._entries) > self.max_entries:
+                self._remove(next(iter(self._entries)))
+                self.metrics.incr('evictions')
+
+    def _remove(self, key):
+        _, _, tags = self._entries.pop(key)
+        for tag in tags:
+            keys = self._tags.get(tag)
+            if keys is not None:
+                keys.discard(key)
+                if not keys:
+                    del self._tags[tag]
+
+    def delete(self, key):
+        with self._lock:
+            if key in self._entries:
+                self._remove(key)
+
+    def invalidate_tags(self, tags):
+        with self._lock:
+            keys = set()
+            for tag in tags:
+                keys |= self._tags.get(tag, set())
+            for key in keys:
+                if key in self._entries:
+                    self._remove(key)
+            return len(keys)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self._tags.clear()
+
+    def acquire_lock(self, key, timeout):
+        # Threads in this process already serialize on Cache's per-key lock
+        return 'local'
+
+    def release_lock(self, key, token):
+        pass
+
+    def size(self):
+        return len(self._entries)
+
+class SQLiteBackend:
+    """File-backed cache shared by every worker process on the host
+
+    WAL mode lets readers proceed while one worker writes. Each thread
+    (and each forked process) opens its own connection.
+    """
+
+    SCHEMA = """
+        CREATE TABLE IF NOT EXISTS cache_entry (key TEXT PRIMARY KEY, value BLOB, expires REAL);
+        CREATE INDEX IF NOT EXISTS ix_cache_entry_expires ON cache_entry (expires);
+        CREATE TABLE IF NOT EXISTS cache_tag (tag TEXT, key TEXT, PRIMARY KEY (tag, key)) WITHOUT ROWID;
+        CREATE INDEX IF NOT EXISTS ix_cache_tag_key ON cache_tag (key);
+        CREATE TABLE IF NOT EXISTS cache_lock (key TEXT PRIMARY KEY, token TEXT, expires REAL);
+    """
+
+    def __init__(self, path, max_entries=100000, metrics=None):
+        self.path = path
+        self.max_entries = max_entries
+        self.metrics = metrics or CacheMetrics()
+        self._local = threading.local()
+        self._writes = 0
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        conn = self._connection()
+        # Lock rows are short-lived, so a file from before owner tokens
+        # just gets a new lock table
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(cache_lock)')]
+        if columns and 'token' not in columns:
+            conn.execute('DROP TABLE cache_lock')
+        conn.executescript(self.SCHEMA)
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None or self._local.pid != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+            conn.execute('PRAGMA journal_mode=WAL')
+            conn.execute('PRAGMA synchronous=NORMAL')
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def get(self, key):
+        row = self._connection().execute(
+            'SELECT value FROM cache_entry WHERE key = ? AND expires >= ?', (key, time.time())
+        ).fetchone()
+        return _MISSING if row is None else pickle.loads(row[0])
+
+    def set(self, key, value, ttl, tags=()):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('INSERT OR REPLACE INTO cache_entry (key, value, expires) VALUES (?, ?, ?)',
+                         (key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), time.time() + ttl))
+            conn.execute('DELETE FROM cache_tag WHERE key = ?', (key,))
+            conn.executemany('INSERT OR IGNORE INTO cache_tag (tag, key) VALUES (?, ?)', [(tag, key) for tag in tags])
+        self._writes += 1
+        if self._writes % 100 == 0:
+            self.prune()
+
+    def prune(self):
+        """Drop expired entries, then the soonest-expiring ones beyond max_entries"""
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            expired = conn.execute('DELETE FROM cache_entry WHERE expires < ?', (time.time(),)).rowcount
+            (count,) = conn.execute('SELECT COUNT(*) FROM cache_entry').fetchone()
+            evicted = 0
+            if count > self.max_entries:
+                evicted = conn.execute(
+                    'DELETE FROM cache_entry WHERE key IN (SELECT key FROM cache_entry ORDER BY expires LIMIT ?)',
+                    (count - self.max_entries,)
+                ).rowcount
+            conn.execute('DELETE FROM cache_tag WHERE key NOT IN (SELECT key FROM cache_entry)')
+            conn.execute('DELETE FROM cache_lock WHERE expires < ?', (time.time(),))
+        self.metrics.incr('evictions', expired + evicted)
+
+    def delete(self, key):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_entry WHERE key = ?', (key,))
+            conn.execute('DELETE FROM cache_tag WHERE key = ?', (key,))
+
+    def invalidate_tags(self, tags):
+        conn = self._connection()
+        placeholders = ','.join('?' * len(tags))
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            removed = conn.execute(
+                f'DELETE FROM cache_entry WHERE key IN (SELECT key FROM cache_tag WHERE tag IN ({placeholders}))',
+                tuple(tags)
+            ).rowcount
+            conn.execute(f'DELETE FROM cache_tag WHERE tag IN ({placeholders})', tuple(tags))
+        return removed
+
+    def clear(self):
+        conn = self._connection()
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            for table in ('cache_entry', 'cache_tag', 'cache_lock'):
+                conn.execute(f'DELETE FROM {table}')
+
+    def acquire_lock(self, key, timeout):
+        conn = self._connection()
+        now = time.time()
+        token = uuid.uuid4().hex
+        with conn:
+            conn.execute('BEGIN IMMEDIATE')
+            conn.execute('DELETE FROM cache_lock WHERE key = ? AND expires < ?', (key, now))
+            inserted = conn.execute('INSERT OR IGNORE INTO cache_lock (key, token, expires) VALUES (?, ?, ?)',
+                                    (key, token, now + timeout)).rowcount == 1
+        return token if inserted else None
+
+    def release_lock(self, key, token):
+        self._connection().execute('DELETE FROM cache_lock WHERE key = ? AND token = ?', (key, token))
+
+    def size(self):
+        return self._connection().execute('SELECT COUNT(*) FROM cache_entry').fetchone()[0]
+
+class RedisBackend:
+    """Redis (or any Redis-compatible server) shared across hosts"""
+
+    # Tag sets must outlive their longest-lived key, so a write only ever
+    # lengthens the set's TTL. EXPIRE ... GT is not used: it never applies
+    # to a set SADD has just created, which has no TTL yet.
+    EXTEND_TTL = """
+        local ttl = redis.call('TTL', KEYS[1])
+        if ttl < tonumber(ARGV[1]) then
+            redis.call('EXPIRE', KEYS[1], ARGV[1])
+        end
+    """
+    # Only the owner may drop a fill lock; once it has expired and been
+    # taken by another filler, the late owner's release is a no-op
+    RELEASE_LOCK = """
+        if redis.call('GET', KEYS[1]) == ARGV[1] then
+            return redis.call('DEL', KEYS[1])
+        end
+        return 0
+    """
+
+    def __init__(self, url=None, prefix='chs:', metrics=None, client=None):
+        if client is None:
+            if redis is None:
+                raise RuntimeError('CACHE_BACKEND=redis requires the redis package')
+            client = redis.Redis.from_url(url)
+        self.client = client
+        self.prefix = prefix
+        self.metrics = metrics or CacheMetrics()
+        self._extend_ttl = self.client.register_script(self.EXTEND_TTL)
+        self._release_lock = self.client.register_script(self.RELEASE_LOCK)
+
+    def get(self, key):
+        value = self.client.get(self.prefix + key)
+        return _MISSING if value is None else pickle.loads(value)
+
+    def set(self, key, value, ttl, tags=()):
+        pipe = self.client.pipeline()
+        pipe.set(self.prefix + key, pickle.dumps(value, pickle.HIGHEST_PROTOCOL), px=int(ttl * 1000))
+        for tag in tags:
+            pipe.sadd(f'{self.prefix}tag:{tag}', key)
+            self._extend_ttl(keys=[f'{self.prefix}tag:{tag}'], args=[int(ttl) + 60], client=pipe)
+        pipe.execute()
+
+    def delete(self, key):
+        self.client.delete(self.prefix + key)
+
+    def invalidate_tags(self, tags):
+        removed = 0
+        for tag in tags:
+            tag_key = f'{self.prefix}tag:{tag}'
+            keys = self.client.smembers(tag_key)
+            if keys:
+                removed += self.client.delete(*[self.prefix + k.decode() for k in keys])
+            self.client.delete(tag_key)
+        return removed
+
+    def clear(self):
+        for key in self.client.scan_iter(f'{self.prefix}*'):
+            self.client.delete(key)
+
+    def acquire_lock(self, key, timeout):
+        token = uuid.uuid4().hex
+        if self.client.set(f'{self.prefix}lock:{key}', token, nx=True, px=int(timeout * 1000)):
+            return token
+        return None
+
+    def release_lock(self, key, token):
+        self._release_lock(keys=[f'{self.prefix}lock:{key}'], args=[token])
+
+    def size(self):
+        return None
+
+class Cache:
+    """Cache API over a backend, with tag invalidation and single-flight fills
+
+    ``get_or_set`` lets only one caller (per process, and per host or
+    cluster for shared backends) compute a missing value; the others wait
+    for it rather than stampeding the database.
+    """
+
+    def __init__(self, backend, default_ttl=300, lock_timeout=30):
+        self.backend = backend
+        self.metrics = backend.metrics
+        self.default_ttl = default_ttl
+        self.lock_timeout = lock_timeout
+        self._key_locks = {}
+        self._key_locks_guard = threading.Lock()
+
+    def get(self, key, default=None):
+        value = self.backend.get(key)
+        if value is _MISSING:
+            self.metrics.incr('misses')
+            return default
+        self.metrics.incr('hits')
+        return value
+
+    def set(self, key, value, ttl=None, tags=()):
+        self.backend.set(key, value, ttl or self.default_ttl, tags)
+        self.metrics.incr('sets')
+
+    def delete(self, key):
+        self.backend.delete(key)
+
+    def invalidate(self, *tags):
+        """Drop every entry stored with any of the tags, e.g. ``invalidate('patient:123')``"""
+        if not tags:
+            return 0
+        removed = self.backend.invalidate_tags(tags)
+        self.metrics.incr('invalidations', removed)
+        return removed
+
+    def clear(self):
+        self.backend.clear()
+
+    def _key_lock(self, key):
+        with self._key_locks_guard:
+            entry = self._key_locks.setdefault(key, [threading.Lock(), 0])
+            entry[1] += 1
+            return entry
+
+    def _release_key_lock(self, key, entry):
+        with self._key_locks_guard:
+            entry[1] -= 1
+            if not entry[1]:
+                del self._key_locks[key]
+
+    def get_or_set(self, key, producer, ttl=None, tags=()):
+        """Return the cached value, computing it with ``producer()`` at most once at a time"""
+        value = self.backend.get(key)
+        if value is not _MISSING:
+            self.metrics.incr('hits')
+            return value
+        self.metrics.incr('misses')
+
+        entry = self._key_lock(key)
+        try:
+            with entry[0]:
+                # Another thread may have filled it while we waited
+                value = self.backend.get(key)
+                if value is not _MISSING:
+                    self.metrics.incr('waits')
+                    return value
+
+                deadline = time.monotonic() + self.lock_timeout
+                token = self.backend.acquire_lock(key, self.lock_timeout)
+                while not token:
+                    # Another process is computing it
+                    self.metrics.incr('waits')
+                    time.sleep(0.05)
+                    value = self.backend.get(key)
+                    if value is not _MISSING:
+                        return value
+                    if time.monotonic() > deadline:
+                        # Compute it anyway, but leave the holder's lock alone
+                        break
+                    token = self.backend.acquire_lock(key, self.lock_timeout)
+                try:
+                    value = producer()
+                    self.set(key, value, ttl, tags)
+                    return value
+                finally:
+                    if token:
+                        self.backend.release_lock(key, token)
+        finally:
+            self._release_key_lock(key, entry)
+
+    def stats(self):
+        return dict(self.metrics.snapshot(), backend=type(self.backend).__name__, entries=self.backend.size())
+
+def create_cache(config):
+    """Build the cache configured by CACHE_BACKEND (memory, sqlite or redis)"""
+    kind = config.get('CACHE_BACKEND', 'memory')
+    max_entries = config.get('CACHE_MAX_ENTRIES', 10000)
+    if kind == 'sqlite':
+        backend = SQLiteBackend(config['CACHE_URL'], max_entries=max_entries)
+    elif kind == 'redis':
+        backend = RedisBackend(config['CACHE_URL'])
+    else:
+        backend = MemoryBackend(max_entries=max_entries)
+    return Cache(backend, default_ttl=config.get('CACHE_DEFAULT_TTL', 300))
+
+cache = create_cache(app.config)
+
+@app.cli.group('cache')
+def cache_cli():
+    """Cache commands"""
+
+@cache_cli.command('stats')
+def stats_command():
+    """Show cache size and this process's counters"""
+    click.echo(json.dumps(cache.stats(), indent=2))
+
+@cache_cli.command('clear')
+@click.option('--tag', 'tags', multiple=True, help='Only drop entries with this tag.')
+def clear_command(tags):
+    """Drop cached entries"""
+    if tags:
+        click.echo(f'Invalidated {cache.invalidate(*tags)} entries')
+    else:
+        cache.clear()
+        click.echo('Cache cleared')
@@ -0,0 +1,280 @@
+"""CHW caseload reporting and balancing
+
+Caseloads are counted in SQL. A balancing plan gives each patient without
+an active CHW to the least-loaded active CHW of the same ward, or of the
+same subcounty when nobody covers the ward; patients never move across
+subcounties. With ``rebalance``, CHWs above their ward's fair share also
+hand patients from that ward to colleagues below it. Plans are applied as
+chunked UPDATEs guarded on the previous assignment, so a patient someone
+reassigned in the meantime is left alone.
+"""
+import heapq
+import math
+from collections import defaultdict
+from datetime import datetime
+import click
+from sqlalchemy import select, update, func, or_, exists, bindparam
+from app import app, db
+from models import User, Patient
+from utils import log_audit
+
+CHUNK_SIZE = 5000
+
+def _key(*values):
+    return tuple((value or '').strip().lower() for value in values)
+
+def _active_chws():
+    query = select(User.id, User.first_name, User.last_name, User.county, User.subcounty, User.ward).where(
+        User.role == 'chw', User.is_active.is_(True)
+    )
+    return {row.id: row for row in db.session.execute(query)}
+
+def _without_active_chw():
+    """Unassigned, or assigned to someone who is no longer an active CHW"""
+    return or_(
+        Patient.assigned_chw_id.is_(None),
+        ~exists().where(User.id == Patient.assigned_chw_id, User.role == 'chw', User.is_active.is_(True))
+    )
+
+def caseload_report(county=None):
+    """Active patients per CHW broken down by patient ward, plus patients without an active CHW"""
+    ward = (Patient.county, Patient.subcounty, Patient.ward)
+    query = (
+        select(Patient.assigned_chw_id, *ward, func.count(Patient.id))
+        .where(Patient.status == 'active')
+        .group_by(Patient.assigned_chw_id, *ward)
+    )
+    if county:
+        query = query.where(Patient.county == county)
+
+    chws = _active_chws()
+    entries = {}
+
+    def entry_for(chw):
+        if chw.id not in entries:
+            entries[chw.id] = {
+                'chw_id': chw.id,
+                'name': f'{chw.first_name} {chw.last_name}',
+                'county': chw.county, 'subcounty': chw.subcounty, 'ward': chw.ward,
+                'patients': 0,
+                'wards': []
+            }
+        return entries[chw.id]
+
+    # CHWs with no patients yet are listed too
+    for chw in chws.values():
+        if not county or chw.county == county:
+            entry_for(chw)
+
+    uncovered = defaultdict(int)
+    for chw_id, patient_county, subcounty, patient_ward, count in db.session.execute(query):
+        if chw_id not in chws:
+            uncovered[(patient_county, subcounty, patient_ward)] += count
+            continue
+        entry = entry_for(chws[chw_id])
+        entry['patients'] += count
+        entry['wards'].append({
+            'county': patient_county, 'subcounty': subcounty, 'ward': patient_ward, 'patients': count,
+            'home_ward': _key(patient_county, subcounty, patient_ward) == _key(entry['county'], entry['subcounty'], entry['ward'])
+        })
+
+    loads = [entry['patients'] for entry in entries.values()]
+    return {
+        'chws': sorted(entries.values(), key=lambda entry: -entry['patients']),
+        'without_chw': [{'county': key[0], 'subcounty': key[1], 'ward': key[2], 'patients': count}
+                        for key, count in sorted(uncovered.items(), key=lambda item: -item[1])],
+        'summary': {
+            'chws': len(loads),
+            'assigned': sum(loads),
+            'without_chw': sum(uncovered.values()),
+            'min': min(loads, default=0),
+            'max': max(loads, default=0),
+            'mean': round(sum(loads) / len(loads), 1) if loads else 0
+        }
+    }
+
+class _Pool:
+    """Least-loaded-first choice among CHWs sharing a ward or subcounty
+
+    Loads only grow while a plan is built, so a heap entry whose load is
+    out of date is pushed back with the current one.
+    """
+
+    def __init__(self, chw_ids, loads):
+        self.loads = loads
+        self.heap = [(loads[chw_id], chw_id) for chw_id in chw_ids]
+        heapq.heapify(self.heap)
+
+    def take(self):
+        while True:
+            load, chw_id = heapq.heappop(self.heap)
+            if load == self.loads[chw_id]:
+                self.loads[chw_id] += 1
+                heapq.heappush(self.heap, (load + 1, chw_id))
+                return chw_id
+            heapq.heappush(self.heap, (self.loads[chw_id], chw_id))
+
+def plan(county=None, rebalance=False, tolerance=0):
+    """Proposed reassignments; returns (moves, summary)
+
+    ``moves`` is a list of (patient_id, from_chw_id, to_chw_id). Patients
+    without an active CHW go to their ward's least-loaded CHW, else their
+    subcounty's. With ``rebalance``, a CHW holding more than the ward's
+    fair share plus ``tolerance`` gives the surplus of that ward's
+    patients to CHWs of the ward below the fair share.
+    """
+    chws = _active_chws()
+    loads = dict.fromkeys(chws, 0)
+    for chw_id, count in db.session.execute(
+        select(Patient.assigned_chw_id, func.count(Patient.id))
+        .where(Patient.status == 'active', Patient.assigned_chw_id.isnot(None))
+        .group_by(Patient.assigned_chw_id)
+    ):
+        if chw_id in loads:
+            loads[chw_id] = count
+    before = dict(loads)
+
+    by_ward, by_subcounty = defaultdict(list), defaultdict(list)
+    for chw in chws.values():
+        key = _key(chw.county, chw.subcounty, chw.ward)
+        by_ward[key].append(chw.id)
+        by_subcounty[key[:2]].append(chw.id)
+    ward_pools, subcounty_pools = {}, {}
+
+    query = (
+        select(Patient.id, Patient.county, Patient.subcounty, Patient.ward, Patient.assigned_chw_id)
+        .where(Patient.status == 'active', _without_active_chw())
+        .order_by(Patient.id)
+    )
+    if county:
+        query = query.where(Patient.county == county)
+
+    moves = []
+    counts = {'ward_match': 0, 'subcounty_match': 0, 'unmatched': 0, 'rebalanced': 0}
+    for patient_id, patient_county, subcounty, ward, current in db.session.execute(query):
+        key = _key(patient_county, subcounty, ward)
+        # Blank wards and subcounties match nothing
+        if key[2] and key in by_ward:
+            if key not in ward_pools:
+                ward_pools[key] = _Pool(by_ward[key], loads)
+            pool, level = ward_pools[key], 'ward_match'
+        elif key[1] and key[:2] in by_subcounty:
+            if key[:2] not in subcounty_pools:
+                subcounty_pools[key[:2]] = _Pool(by_subcounty[key[:2]], loads)
+            pool, level = subcounty_pools[key[:2]], 'subcounty_match'
+        else:
+            counts['unmatched'] += 1
+            continue
+        moves.append((patient_id, current, pool.take()))
+        counts[level] += 1
+
+    if rebalance:
+        moves += _rebalance(by_ward, loads, county, tolerance)
+        counts['rebalanced'] = len(moves) - counts['ward_match'] - counts['subcounty_match']
+
+    changed = {chw_id: {'before': before[chw_id], 'after': loads[chw_id]}
+               for chw_id in loads if loads[chw_id] != before[chw_id]}
+    return moves, dict(counts, moves=len(moves), chws=changed)
+
+def _rebalance(by_ward, loads, county, tolerance):
+    """Moves from CHWs above their ward's fair share to ward colleagues below it"""
+    surplus, receivers = {}, {}
+    for key, chw_ids in by_ward.items():
+        if not key[2] or len(chw_ids) < 2 or (county and key[0] != county.strip().lower()):
+            continue
+        share = math.ceil(sum(loads[chw_id] for chw_id in chw_ids) / len(chw_ids))
+        for chw_id in chw_ids:
+            if loads[chw_id] > share + tolerance:
+                surplus[chw_id] = (key, loads[chw_id] - share)
+        receivers[key] = [chw_id for chw_id in chw_ids if loads[chw_id] < share], share
+    if not surplus:
+        return []
+
+    # One pass over the donors' patients, newest first, keeping those in the donor's ward
+    donated = defaultdict(list)
+    donors = list(surplus)
+    for start in range(0, len(donors), CHUNK_SIZE):
+        for patient_id, chw_id, patient_county, subcounty, ward in db.session.execute(
+            select(Patient.id, Patient.assigned_chw_id, Patient.county, Patient.subcounty, Patient.ward)
+            .where(Patient.status == 'active', Patient.assigned_chw_id.in_(donors[start:start + CHUNK_SIZE]))
+            .order_by(Patient.assigned_chw_id, Patient.id.desc())
+        ):
+            key, excess = surplus[chw_id]
+            if len(donated[chw_id]) < excess and _key(patient_county, subcounty, ward) == key:
+                donated[chw_id].append(patient_id)
+
+    moves = []
+    for chw_id, patient_ids in donated.items():
+        key = surplus[chw_id][0]
+        targets, share = receivers[key]
+        for patient_id in patient_ids:
+            targets = [target for target in targets if loads[target] < share]
+            if not targets:
+                break
+            target = min(targets, key=lambda target: (loads[target], target))
+            moves.append((patient_id, chw_id, target))
+            loads[chw_id] -= 1
+            loads[target] += 1
+        receivers[key] = targets, share
+    return moves
+
+def apply(moves, chunk_size=CHUNK_SIZE):
+    """Write planned moves as chunked executemany UPDATEs; returns how many patients were reassigned
+
+    Each row is guarded on the planned previous CHW, so a patient someone
+    reassigned since the plan was made is skipped.
+    """
+    statement = (
+        update(Patient.__table__)
+        .where(Patient.id == bindparam('patient_id'),
+               Patient.assigned_chw_id.is_not_distinct_from(bindparam('current')))
+        .values(assigned_chw_id=bindparam('target'), updated_at=datetime.utcnow())
+    )
+    # Primary key order keeps each chunk on neighbouring pages
+    ordered = sorted(moves)
+    applied = 0
+    for start in range(0, len(ordered), chunk_size):
+        applied += db.session.execute(statement, [
+            {'patient_id': patient_id, 'current': current, 'target': target}
+            for patient_id, current, target in ordered[start:start + chunk_size]
+        ]).rowcount
+        db.session.commit()
+    return applied
+
+def balance(county=None, rebalance=False, tolerance=0, dry_run=False):
+    """Plan and apply a balancing run with one audit entry; returns the plan summary"""
+    moves, summary = plan(county, rebalance, tolerance)
+    summary['applied'] = 0 if dry_run else apply(moves)
+    summary['dry_run'] = dry_run
+    if summary['applied']:
+        log_audit('caseloads_balanced', 'caseload', None,
+                  f'{summary["applied"]} patients reassigned{" in " + county if county else ""}: '
+                  f'{summary["ward_match"]} by ward, {summary["subcounty_match"]} by subcounty, '
+                  f'{summary["rebalanced"]} rebalanced; {summary["unmatched"]} left without a CHW '
+                  f'in their ward or subcounty; {len(summary["chws"])} CHWs affected')
+    return summary
+
+@app.cli.group('caseloads')
+def caseloads_cli():
+    """CHW caseload reports and balancing"""
+
+@caseloads_cli.command('report')
+@click.option('--county')
+def report_command(county):
+    """Print caseload per CHW and patients without an active CHW"""
+    result = caseload_report(county)
+    for entry in result['chws']:
+        click.echo(f'{entry["chw_id"]:>6} {entry["name"]:<30} {entry["ward"] or "-":<25} {entry["patients"]:>7}')
+    click.echo(f'Without an active CHW: {result["summary"]["without_chw"]}')
+
+@caseloads_cli.command('balance')
+@click.option('--county')
+@click.option('--rebalance', is_flag=True, help='Also move patients from overloaded CHWs.')
+@click.option('--tolerance', default=0, show_default=True, help='Patients above the fair share allowed before moving.')
+@click.option('--dry-run', is_flag=True, help='Only print the plan.')
+def balance_command(county, rebalance, tolerance, dry_run):
+    """Assign patients without an active CHW and optionally even out caseloads"""
+    summary = balance(county, rebalance, tolerance, dry_run)
+    click.echo(f'{summary["moves"]} moves planned, {summary["applied"]} applied: '
+               f'{summary["ward_match"]} by ward, {summary["subcounty_match"]} by subcounty, '
+               f'{summary["rebalanced"]} rebalanced, {summary["unmatched"]} unmatched')
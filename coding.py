@@ -0,0 +1,333 @@
+import re
+import importlib
+import multiprocessing
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+import click
+from sqlalchemy import select, delete, func, and_
+from app import app, db
+from models import Patient, HealthRecord, ClinicalCode, PatientCondition, EncounterMedication
+from jobs import job
+
+CHUNK_SIZE = 5000
+
+# (kind, code): (display, synonyms matched as whole words in free text). Upper-case
+# synonyms are abbreviations that are also ordinary words or names ("Dr. Sam",
+# "et al", "hearing aids") and only match in upper case.
+CODES = {
+    ('condition', 'I10'): ('Essential hypertension', ['hypertension', 'hypertensive', 'htn', 'high blood pressure']),
+    ('condition', 'E11'): ('Type 2 diabetes mellitus', ['type 2 diabetes', 't2dm', 'diabetes', 'diabetic', 'DM']),
+    ('condition', 'E10'): ('Type 1 diabetes mellitus', ['type 1 diabetes', 't1dm']),
+    ('condition', 'J45'): ('Asthma', ['asthma', 'asthmatic']),
+    ('condition', 'B20'): ('HIV disease', ['hiv', 'plhiv', 'AIDS']),
+    ('condition', 'A15'): ('Pulmonary tuberculosis', ['tuberculosis', 'TB', 'ptb']),
+    ('condition', 'B54'): ('Malaria', ['malaria']),
+    ('condition', 'J18'): ('Pneumonia', ['pneumonia']),
+    ('condition', 'G40'): ('Epilepsy', ['epilepsy', 'epileptic', 'seizure disorder']),
+    ('condition', 'I50'): ('Heart failure', ['heart failure', 'chf', 'ccf']),
+    ('condition', 'N18'): ('Chronic kidney disease', ['chronic kidney disease', 'ckd']),
+    ('condition', 'D57'): ('Sickle cell disease', ['sickle cell', 'scd']),
+    ('condition', 'E66'): ('Obesity', ['obesity', 'obese']),
+    ('condition', 'E43'): ('Severe malnutrition', ['severe malnutrition', 'SAM', 'kwashiorkor', 'marasmus']),
+    ('condition', 'A09'): ('Gastroenteritis', ['gastroenteritis', 'diarrhoea', 'diarrhea']),
+    ('condition', 'J06'): ('Upper respiratory tract infection', ['urti', 'upper respiratory tract infection', 'common cold']),
+    ('condition', 'N39'): ('Urinary tract infection', ['uti', 'urinary tract infection']),
+    ('condition', 'O24'): ('Diabetes in pregnancy', ['gestational diabetes', 'gdm']),
+    ('condition', 'O14'): ('Pre-eclampsia', ['pre-eclampsia', 'preeclampsia']),
+    ('allergy', 'PEN'): ('Penicillin allergy', ['penicillin', 'penicillins', 'amoxicillin', 'ampicillin']),
+    ('allergy', 'SUL'): ('Sulfonamide allergy', ['sulfa', 'sulpha', 'sulfonamide', 'sulfonamides', 'septrin', 'cotrimoxazole']),
+    ('allergy', 'NSA'): ('NSAID allergy', ['nsaid', 'nsaids', 'aspirin', 'ibuprofen', 'diclofenac']),
+    ('allergy', 'LAT'): ('Latex allergy', ['latex']),
+    ('allergy', 'NUT'): ('Peanut allergy', ['peanut', 'peanuts', 'groundnut', 'groundnuts']),
+    ('allergy', 'EGG'): ('Egg allergy', ['eggs', 'egg allergy', 'egg protein', 'allergic to egg']),
+    ('allergy', 'SEA'): ('Seafood allergy', ['shellfish', 'seafood', 'fish allergy', 'allergic to fish']),
+    ('medication', 'C08CA01'): ('Amlodipine', ['amlodipine', 'norvasc']),
+    ('medication', 'C08CA05'): ('Nifedipine', ['nifedipine']),
+    ('medication', 'C09AA02'): ('Enalapril', ['enalapril']),
+    ('medication', 'C09AA03'): ('Lisinopril', ['lisinopril']),
+    ('medication', 'C03AA03'): ('Hydrochlorothiazide', ['hydrochlorothiazide', 'hctz']),
+    ('medication', 'C07AB03'): ('Atenolol', ['atenolol']),
+    ('medication', 'C09CA01'): ('Losartan', ['losartan']),
+    ('medication', 'A10BA02'): ('Metformin', ['metformin', 'glucophage']),
+    ('medication', 'A10BB01'): ('Glibenclamide', ['glibenclamide']),
+    ('medication', 'A10AB01'): ('Insulin (human)', ['insulin', 'actrapid', 'mixtard']),
+    ('medication', 'R03AC02'): ('Salbutamol', ['salbutamol', 'ventolin']),
+    ('medication', 'P01BF01'): ('Artemether/lumefantrine', ['artemether', 'lumefantrine', 'coartem', 'AL']),
+    ('medication', 'N02BE01'): ('Paracetamol', ['paracetamol', 'panadol', 'acetaminophen']),
+    ('medication', 'J01CA04'): ('Amoxicillin', ['amoxicillin', 'amoxil']),
+    ('medication', 'M01AE01'): ('Ibuprofen', ['ibuprofen', 'brufen']),
+    ('medication', 'J01EE01'): ('Cotrimoxazole', ['cotrimoxazole', 'septrin']),
+    ('medication', 'J05AR27'): ('Tenofovir/lamivudine/dolutegravir', ['tld', 'dolutegravir', 'tenofovir']),
+    ('medication', 'J04AC01'): ('Isoniazid', ['isoniazid', 'inh', 'ipt']),
+    ('medication', 'A07CA'): ('Oral rehydration salts', ['ORS', 'oral rehydration']),
+    ('medication', 'A12CB01'): ('Zinc', ['zinc']),
+    ('medication', 'B03AD'): ('Iron and folic acid', ['ifas', 'ferrous', 'folic acid']),
+}
+
+# Which code kind each free-text column is coded against
+SOURCES = {
+    'allergies': 'allergy',
+    'chronic_conditions': 'condition',
+    'diagnosis': 'condition',
+    'medications_prescribed': 'medication',
+}
+
+# Negation cues (NegEx-style). A cue before a term negates it when the term is
+# in the same clause and within NEGATION_WINDOW words; a cue after one
+# negates it when at most three words, and no comma, separate them.
+PRE_NEGATION = ['no', 'not', 'nil', 'denies', 'denied', 'deny', 'without', 'negative for',
+                'no history of', 'no known', 'ruled out', 'rules out', 'free of', 'absence of', 'never had']
+POST_NEGATION = ['negative', 'neg', '-ve', 'ruled out', 'excluded', 'not detected', 'unlikely']
+NEGATION_WINDOW = 6
+
+def _words(words):
+    return '|'.join(re.escape(word) for word in sorted(words, key=len, reverse=True))
+
+PRE_NEGATION_PATTERN = re.compile(rf'(?<![\w-])(?:{_words(PRE_NEGATION)})(?![\w-])', re.IGNORECASE)
+POST_NEGATION_PATTERN = re.compile(
+    rf'(?:\s+[\w/]+){{0,3}}?\s+(?:{_words(POST_NEGATION)})(?![\w-])', re.IGNORECASE
+)
+# Clause boundaries end a negation's scope
+CLAUSE_END = re.compile(r'[.;:\n]|(?<![\w-])(?:but|however|although|though|except|apart from|aside from|yet)(?![\w-])',
+                        re.IGNORECASE)
+WORD = re.compile(r'\w+')
+
+def _compile_matchers():
+    """One alternation regex per kind; longest synonyms first so phrases win over words"""
+    matchers = {}
+    for kind in {kind for kind, _ in CODES}:
+        synonyms = {}
+        for (code_kind, code), (_, words) in CODES.items():
+            if code_kind == kind:
+                for word in words:
+                    synonyms[word if word.isupper() else word.lower()] = code
+        pattern = '|'.join(
+            re.escape(word) if word.isupper() else f'(?i:{re.escape(word)})'
+            for word in sorted(synonyms, key=len, reverse=True)
+        )
+        matchers[kind] = (re.compile(rf'(?<![\w-])(?:{pattern})(?![\w-])'), synonyms)
+    return matchers
+
+MATCHERS = _compile_matchers()
+
+def _negated(text, start, end):
+    """Whether the mention at text[start:end] falls in a negation's scope"""
+    clause_start = 0
+    for boundary in CLAUSE_END.finditer(text, 0, start):
+        clause_start = boundary.end()
+    for cue in PRE_NEGATION_PATTERN.finditer(text, clause_start, start):
+        if len(WORD.findall(text, cue.end(), start)) < NEGATION_WINDOW:
+            return True
+    boundary = CLAUSE_END.search(text, end)
+    tail = text[end:boundary.start() if boundary else len(text)].split(',', 1)[0]
+    return POST_NEGATION_PATTERN.match(tail) is not None
+
+def extract_codes(kind, text):
+    """Codes of the given kind mentioned in free text, in order of first mention
+
+    Negated mentions ("no history of diabetes", "HIV negative") are skipped.
+    """
+    if not text:
+        return []
+    pattern, synonyms = MATCHERS[kind]
+    codes = []
+    for match in pattern.finditer(text):
+        word = match.group(0)
+        code = synonyms.get(word) or synonyms[word.lower()]
+        if code not in codes and not _negated(text, match.start(), match.end()):
+            codes.append(code)
+    return codes
+
+def seed_codes():
+    """Insert any CODES entries missing from clinical_code; returns the number added"""
+    existing = set(db.session.execute(select(ClinicalCode.kind, ClinicalCode.code)).tuples())
+    missing = [
+        ClinicalCode(kind=kind, code=code, display=display)
+        for (kind, code), (display, _) in CODES.items() if (kind, code) not in existing
+    ]
+    db.session.add_all(missing)
+    db.session.commit()
+    _code_ids.clear()
+    return len(missing)
+
+_code_ids = {}
+
+def code_ids():
+    """{(kind, code): id}, loaded once per process"""
+    if not _code_ids:
+        _code_ids.update({
+            (kind, code): code_id
+            for code_id, kind, code in db.session.execute(select(ClinicalCode.id, ClinicalCode.kind, ClinicalCode.code))
+        })
+    return _code_ids
+
+def resolve_code(kind, term):
+    """Code id for a code ("I10") or any synonym ("hypertension"), or None"""
+    ids = code_ids()
+    if (kind, term.upper()) in ids:
+        return ids[(kind, term.upper())]
+    # Search terms are bare names, so abbreviations match in any case
+    codes = extract_codes(kind, term.upper())
+    return ids.get((kind, codes[0])) if codes else None
+
+def _insert_ignoring_duplicates(model):
+    """INSERT ... ON CONFLICT DO NOTHING against the model's unique index"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(model).on_conflict_do_nothing()
+
+def _condition_rows(patient_id, texts, health_record_id=None):
+    ids = code_ids()
+    now = datetime.utcnow()
+    return [
+        {'patient_id': patient_id, 'code_id': ids[(SOURCES[source], code)], 'source': source,
+         'health_record_id': health_record_id, 'created_at': now}
+        for source, text in texts.items()
+        for code in extract_codes(SOURCES[source], text)
+        if (SOURCES[source], code) in ids
+    ]
+
+def _medication_rows(record_id, patient_id, text):
+    ids = code_ids()
+    now = datetime.utcnow()
+    return [
+        {'health_record_id': record_id, 'patient_id': patient_id, 'code_id': ids[('medication', code)],
+         'created_at': now}
+        for code in extract_codes('medication', text) if ('medication', code) in ids
+    ]
+
+def _store(condition_rows, medication_rows):
+    if condition_rows:
+        db.session.execute(_insert_ignoring_duplicates(PatientCondition), condition_rows)
+    if medication_rows:
+        db.session.execute(_insert_ignoring_duplicates(EncounterMedication), medication_rows)
+
+def code_patient(patient):
+    """Re-code a patient's allergies and chronic conditions after a create or edit"""
+    db.session.execute(delete(PatientCondition).where(
+        PatientCondition.patient_id == patient.id,
+        PatientCondition.source.in_(['allergies', 'chronic_conditions'])
+    ))
+    _store(_condition_rows(patient.id, {
+        'allergies': patient.allergies,
+        'chronic_conditions': patient.chronic_conditions
+    }), [])
+    db.session.commit()
+
+def code_health_record(record):
+    """Code a new encounter's diagnosis and prescriptions"""
+    _store(
+        _condition_rows(record.patient_id, {'diagnosis': record.diagnosis}, record.id),
+        _medication_rows(record.id, record.patient_id, record.medications_prescribed)
+    )
+    db.session.commit()
+
+def _backfill_range(table, id_range):
+    """Process-pool entry point: code one id range of patients or health records"""
+    with app.app_context():
+        try:
+            low, high = id_range
+            if table == 'patient':
+                rows = db.session.execute(
+                    select(Patient.id, Patient.allergies, Patient.chronic_conditions)
+                    .where(Patient.id >= low, Patient.id < high)
+                ).all()
+                conditions = [row for patient_id, allergies, chronic in rows
+                              for row in _condition_rows(patient_id, {'allergies': allergies,
+                                                                      'chronic_conditions': chronic})]
+                medications = []
+                db.session.execute(delete(PatientCondition).where(
+                    PatientCondition.patient_id >= low, PatientCondition.patient_id < high,
+                    PatientCondition.source.in_(['allergies', 'chronic_conditions'])
+                ))
+            else:
+                rows = db.session.execute(
+                    select(HealthRecord.id, HealthRecord.patient_id, HealthRecord.diagnosis,
+                           HealthRecord.medications_prescribed)
+                    .where(HealthRecord.id >= low, HealthRecord.id < high)
+                    .order_by(HealthRecord.id)
+                ).all()
+                conditions, medications = [], []
+                for record_id, patient_id, diagnosis, prescribed in rows:
+                    conditions.extend(_condition_rows(patient_id, {'diagnosis': diagnosis}, record_id))
+                    medications.extend(_medication_rows(record_id, patient_id, prescribed))
+                db.session.execute(delete(PatientCondition).where(
+                    PatientCondition.health_record_id >= low, PatientCondition.health_record_id < high,
+                    PatientCondition.source == 'diagnosis'
+                ))
+                db.session.execute(delete(EncounterMedication).where(
+                    EncounterMedication.health_record_id >= low, EncounterMedication.health_record_id < high
+                ))
+            _store(conditions, medications)
+            db.session.commit()
+            return len(rows), len(conditions), len(medications)
+        finally:
+            db.session.remove()
+
+def backfill(processes=4, chunk_size=CHUNK_SIZE):
+    """Code all existing free text in id-range chunks across worker processes
+
+    Safe to re-run: each chunk replaces the codes previously derived from
+    its rows, so a CODES or negation change also drops stale matches.
+    """
+    seed_codes()
+    work = []
+    for table, model in (('patient', Patient), ('health_record', HealthRecord)):
+        low, high = db.session.execute(select(func.min(model.id), func.max(model.id))).one()
+        if low is not None:
+            work.extend((table, (start, start + chunk_size)) for start in range(low, high + 1, chunk_size))
+    db.session.remove()
+
+    tables, ranges = [t for t, _ in work], [r for _, r in work]
+    if processes <= 1:
+        results = list(map(_backfill_range, tables, ranges))
+    else:
+        # Spawn, not fork, as in risk.evaluate_all: the job worker is threaded
+        # and holds a log listener and connection pool a fork would inherit
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=importlib.import_module, initargs=('main',)) as pool:
+            results = list(pool.map(_backfill_range, tables, ranges))
+    return {
+        'chunks': len(results),
+        'rows': sum(r[0] for r in results),
+        'conditions': sum(r[1] for r in results),
+        'medications': sum(r[2] for r in results),
+    }
+
+def cohort_query(conditions=(), medications=(), allergies=(), county=None):
+    """SELECT of patient ids having every given condition/medication/allergy, as indexed joins"""
+    query = select(Patient.id)
+    for index, code_id in enumerate(conditions):
+        link = db.aliased(PatientCondition, name=f'condition_{index}')
+        query = query.join(link, and_(link.patient_id == Patient.id, link.code_id == code_id,
+                                      link.source != 'allergies'))
+    for index, code_id in enumerate(allergies):
+        link = db.aliased(PatientCondition, name=f'allergy_{index}')
+        query = query.join(link, and_(link.patient_id == Patient.id, link.code_id == code_id,
+                                      link.source == 'allergies'))
+    for index, code_id in enumerate(medications):
+        link = db.aliased(EncounterMedication, name=f'medication_{index}')
+        query = query.join(link, and_(link.patient_id == Patient.id, link.code_id == code_id))
+    if county:
+        query = query.where(Patient.county == county.strip().lower())
+    return query.distinct()
+
+@job('coding.backfill', max_attempts=1)
+def backfill_job(processes=4, chunk_size=CHUNK_SIZE):
+    """Code existing free text after a deploy or a CODES dictionary change"""
+    return backfill(processes=processes, chunk_size=chunk_size)
+
+@app.cli.group('coding')
+def coding_cli():
+    """Clinical coding commands"""
+
+@coding_cli.command('backfill')
+@click.option('--processes', default=4, show_default=True, help='Worker processes.')
+@click.option('--chunk-size', default=CHUNK_SIZE, show_default=True, help='Rows per chunk.')
+def backfill_command(processes, chunk_size):
+    """Seed the code table and code existing allergies, conditions, diagnoses and medications"""
+    result = backfill(processes=processes, chunk_size=chunk_size)
+    click.echo(f"Coded {result['rows']} rows in {result['chunks']} chunks: "
+               f"{result['conditions']} conditions/allergies, {result['medications']} medications")
@@ -0,0 +1,307 @@
+import os
+import json
+import time
+import shutil
+import logging
+from datetime import datetime, timezone
+from json.encoder import encode_basestring as _str
+import click
+from sqlalchemy import select, tuple_
+from app import app, db
+from models import Patient, HealthRecord, Payment
+from jobs import job
+
+logger = logging.getLogger(__name__)
+
+FHIR_MIMETYPE = 'application/fhir+json'
+
+# Serializers write compact JSON text straight from a row of plain column
+# values: constant parts are literal fragments and only the values are
+# escaped, several times faster than building dicts for json.dumps. Empty
+# elements are left out, as FHIR JSON must not contain nulls.
+
+def _instant(value):
+    return '"%sZ"' % value.isoformat(timespec='seconds')
+
+def _reference(kind, id):
+    return '{"reference":"%s/%d"}' % (kind, id)
+
+_GENDERS = {gender: ',"gender":"%s"' % gender for gender in ('male', 'female', 'other')}
+
+PATIENT_COLUMNS = (
+    Patient.id, Patient.patient_number, Patient.national_id, Patient.nhif_number,
+    Patient.first_name, Patient.last_name, Patient.date_of_birth, Patient.gender,
+    Patient.phone_number, Patient.email, Patient.county, Patient.subcounty, Patient.ward,
+    Patient.village, Patient.address_line, Patient.assigned_chw_id, Patient.status, Patient.updated_at
+)
+
+def patient_resource(row):
+    (id, patient_number, national_id, nhif_number, first_name, last_name, date_of_birth, gender,
+     phone_number, email, county, subcounty, ward, village, address_line, chw_id, status, updated_at) = row
+    parts = ['{"resourceType":"Patient","id":"%d"' % id]
+    if updated_at:
+        parts.append(',"meta":{"lastUpdated":%s}' % _instant(updated_at))
+
+    identifiers = ['{"system":"urn:chs:patient-number","value":%s}' % _str(patient_number)]
+    if national_id:
+        identifiers.append('{"system":"urn:ke:national-id","value":%s}' % _str(national_id))
+    if nhif_number:
+        identifiers.append('{"system":"urn:ke:nhif","value":%s}' % _str(nhif_number))
+    parts.append(',"identifier":[%s]' % ','.join(identifiers))
+
+    parts.append(',"active":true' if status == 'active' else ',"active":false')
+    if status == 'deceased':
+        parts.append(',"deceasedBoolean":true')
+    parts.append(',"name":[{"family":%s,"given":[%s]}]' % (_str(last_name), _str(first_name)))
+
+    telecom = []
+    if phone_number:
+        telecom.append('{"system":"phone","value":%s}' % _str(phone_number))
+    if email:
+        telecom.append('{"system":"email","value":%s}' % _str(email))
+    if telecom:
+        parts.append(',"telecom":[%s]' % ','.join(telecom))
+
+    parts.append(_GENDERS.get(gender, ',"gender":"unknown"'))
+    if date_of_birth:
+        parts.append(',"birthDate":"%s"' % date_of_birth.isoformat())
+
+    # Kenyan addresses: county -> state, subcounty -> district, ward -> city
+    address = []
+    lines = [_str(line) for line in (village, address_line) if line]
+    if lines:
+        address.append('"line":[%s]' % ','.join(lines))
+    for key, value in (('city', ward), ('district', subcounty), ('state', county)):
+        if value:
+            address.append('"%s":%s' % (key, _str(value)))
+    address.append('"country":"KE"')
+    parts.append(',"address":[{%s}]' % ','.join(address))
+
+    if chw_id:
+        parts.append(',"generalPractitioner":[%s]' % _reference('Practitioner', chw_id))
+    parts.append('}')
+    return ''.join(parts)
+
+ENCOUNTER_COLUMNS = (
+    HealthRecord.id, HealthRecord.patient_id, HealthRecord.encounter_date, HealthRecord.encounter_type,
+    HealthRecord.chief_complaint, HealthRecord.provider_id, HealthRecord.facility_name,
+    HealthRecord.created_at
+)
+
+_AMBULATORY = ',"status":"finished","class":{"system":"http://terminology.hl7.org/CodeSystem/v3-ActCode","code":"AMB"}'
+
+def encounter_resource(row):
+    id, patient_id, encounter_date, encounter_type, chief_complaint, provider_id, facility_name, created_at = row
+    parts = ['{"resourceType":"Encounter","id":"%d"' % id]
+    if created_at:
+        parts.append(',"meta":{"lastUpdated":%s}' % _instant(created_at))
+    parts.append(_AMBULATORY)
+    parts.append(',"type":[{"text":%s}]' % _str(encounter_type))
+    parts.append(',"subject":%s' % _reference('Patient', patient_id))
+    if provider_id:
+        parts.append(',"participant":[{"individual":%s}]' % _reference('Practitioner', provider_id))
+    parts.append(',"period":{"start":%s}' % _instant(encounter_date))
+    if chief_complaint:
+        parts.append(',"reasonCode":[{"text":%s}]' % _str(chief_complaint))
+    if facility_name:
+        parts.append(',"serviceProvider":{"display":%s}' % _str(facility_name))
+    parts.append('}')
+    return ''.join(parts)
+
+PAYMENT_COLUMNS = (
+    Payment.id, Payment.payment_reference, Payment.intasend_ref, Payment.amount, Payment.currency,
+    Payment.payment_type, Payment.status, Payment.patient_id, Payment.paid_by_id,
+    Payment.received_by_id, Payment.created_at, Payment.completed_at, Payment.updated_at
+)
+
+_PAID = ',"paymentStatus":{"coding":[{"system":"http://terminology.hl7.org/CodeSystem/paymentstatus","code":"paid"}]}'
+
+def payment_notice_resource(row):
+    (id, payment_reference, intasend_ref, amount, currency, payment_type, status, patient_id,
+     paid_by_id, received_by_id, created_at, completed_at, updated_at) = row
+    parts = ['{"resourceType":"PaymentNotice","id":"%d"' % id]
+    if updated_at or created_at:
+        parts.append(',"meta":{"lastUpdated":%s}' % _instant(updated_at or completed_at or created_at))
+    parts.append(',"identifier":[{"system":"urn:chs:payment-reference","value":%s}]' % _str(payment_reference))
+    parts.append(',"status":"cancelled"' if status in ('failed', 'refunded') else ',"status":"active"')
+    if created_at:
+        parts.append(',"created":%s' % _instant(created_at))
+    if paid_by_id:
+        parts.append(',"provider":%s' % _reference('Practitioner', paid_by_id))
+    if received_by_id:
+        parts.append(',"payee":%s' % _reference('Practitioner', received_by_id))
+    if intasend_ref:
+        parts.append(',"payment":{"identifier":{"system":"urn:intasend:ref","value":%s}}' % _str(intasend_ref))
+    if completed_at:
+        parts.append(',"paymentDate":"%s"' % completed_at.date().isoformat())
+    if status == 'completed':
+        parts.append(_PAID)
+    parts.append(',"amount":{"value":%r,"currency":%s}' % (float(amount), _str(currency or 'KES')))
+    extensions = ['{"url":"urn:chs:payment-type","valueCode":%s}' % _str(payment_type)]
+    if patient_id:
+        extensions.append('{"url":"urn:chs:patient","valueReference":%s}' % _reference('Patient', patient_id))
+    parts.append(',"extension":[%s]}' % ','.join(extensions))
+    return ''.join(parts)
+
+class ResourceType:
+    """How one FHIR resource type maps onto a table
+
+    ``since_column`` backs ``_since`` and keyset paging together with the
+    primary key, so every page is a range scan on a (since_column, id) index.
+    """
+
+    def __init__(self, name, model, columns, serialize, since_column):
+        self.name = name
+        self.model = model
+        self.columns = columns
+        self.serialize = serialize
+        self.since_column = since_column
+
+    def query(self, since=None, after=None):
+        query = select(*self.columns)
+        if since:
+            query = query.where(self.since_column >= since)
+        if after:
+            query = query.where(tuple_(self.since_column, self.model.id) > after)
+        return query.order_by(self.since_column, self.model.id)
+
+RESOURCE_TYPES = {
+    'Patient': ResourceType('Patient', Patient, PATIENT_COLUMNS, patient_resource, Patient.updated_at),
+    'Encounter': ResourceType('Encounter', HealthRecord, ENCOUNTER_COLUMNS, encounter_resource, HealthRecord.created_at),
+    'PaymentNotice': ResourceType('PaymentNotice', Payment, PAYMENT_COLUMNS, payment_notice_resource, Payment.updated_at),
+}
+
+def parse_instant(value):
+    """FHIR instant/date ("2024-01-31", "2024-01-31T08:00:00Z") as naive UTC, as stored"""
+    parsed = datetime.fromisoformat(value.strip().replace('Z', '+00:00'))
+    if parsed.tzinfo:
+        parsed = parsed.astimezone(timezone.utc).replace(tzinfo=None)
+    return parsed
+
+def encode_cursor(row):
+    """Opaque next-page token from the last row's (since column, id)"""
+    since_value = row[-1]
+    return f"{since_value.isoformat() if since_value else ''}~{row[0]}"
+
+def decode_cursor(token):
+    since_value, _, id = token.partition('~')
+    return (datetime.fromisoformat(since_value) if since_value else None, int(id))
+
+def search(resource_type, where=(), since=None, cursor=None, count=50):
+    """One page of resources: returns ([(id, resource JSON)], next cursor or None)"""
+    query = resource_type.query(since=since, after=decode_cursor(cursor) if cursor else None)
+    query = query.add_columns(resource_type.since_column)
+    for clause in where:
+        query = query.where(clause)
+    rows = db.session.execute(query.limit(count)).all()
+    entries = [(row[0], resource_type.serialize(row[:-1])) for row in rows]
+    next_cursor = encode_cursor(rows[-1]) if len(rows) == count else None
+    return entries, next_cursor
+
+def bundle(entries, resource_url, self_url, next_url=None):
+    """Searchset Bundle JSON around already-serialized resources
+
+    ``resource_url`` is the absolute URL of the resource type on this
+    server (".../fhir/Patient"); each entry's fullUrl is it plus the id.
+    """
+    links = ['{"relation":"self","url":%s}' % _str(self_url)]
+    if next_url:
+        links.append('{"relation":"next","url":%s}' % _str(next_url))
+    base = resource_url.rstrip('/')
+    entry = ','.join('{"fullUrl":%s,"resource":%s}' % (_str(f'{base}/{id}'), resource)
+                     for id, resource in entries)
+    return '{"resourceType":"Bundle","type":"searchset","link":[%s]%s}' % (
+        ','.join(links), ',"entry":[%s]' % entry if entries else '')
+
+def fhir_response(body, status=200):
+    return app.response_class(body, status=status, mimetype=FHIR_MIMETYPE)
+
+def operation_outcome(message, status, code='invalid'):
+    return fhir_response(json.dumps({
+        'resourceType': 'OperationOutcome',
+        'issue': [{'severity': 'error', 'code': code, 'diagnostics': message}]
+    }, separators=(',', ':')), status)
+
+def export_dir(export_id):
+    return os.path.join(app.config['FHIR_EXPORT_DIR'], export_id)
+
+def export_resources(resource_type, path, since=None, batch_size=5000):
+    """Stream one resource type to an NDJSON file and return the number written
+
+    Rows come through a server-side cursor (stream_results) in fixed-size
+    partitions, so memory stays flat however large the table is.
+    """
+    count = 0
+    tmp_path = path + '.part'
+    with db.engine.connect() as conn, open(tmp_path, 'w', encoding='utf-8') as fh:
+        result = conn.execution_options(stream_results=True, max_row_buffer=batch_size).execute(
+            resource_type.query(since=since)
+        )
+        serialize = resource_type.serialize
+        for rows in result.partitions(batch_size):
+            fh.write('\n'.join(serialize(row) for row in rows))
+            fh.write('\n')
+            count += len(rows)
+    os.replace(tmp_path, path)
+    return count
+
+def run_export(export_id, types, since=None):
+    """Write one NDJSON file per resource type and return the manifest"""
+    since = datetime.fromisoformat(since) if since else None
+    directory = export_dir(export_id)
+    os.makedirs(directory, exist_ok=True)
+    started = datetime.utcnow()
+    output = []
+    for name in types:
+        path = os.path.join(directory, f'{name}.ndjson')
+        count = export_resources(RESOURCE_TYPES[name], path, since=since,
+                                 batch_size=app.config['FHIR_EXPORT_BATCH'])
+        output.append({'type': name, 'file': os.path.basename(path), 'count': count})
+        logger.info('FHIR export %s: %d %s resources', export_id, count, name)
+    return {
+        'export_id': export_id,
+        'transactionTime': started.isoformat(timespec='seconds') + 'Z',
+        'since': since and since.isoformat(),
+        'output': output,
+        'seconds': round((datetime.utcnow() - started).total_seconds(), 2)
+    }
+
+def prune_exports(keep_days=None):
+    """Remove export directories older than FHIR_EXPORT_KEEP_DAYS"""
+    keep_days = app.config['FHIR_EXPORT_KEEP_DAYS'] if keep_days is None else keep_days
+    root = app.config['FHIR_EXPORT_DIR']
+    if not os.path.isdir(root):
+        return 0
+    cutoff = time.time() - keep_days * 86400
+    removed = 0
+    for name in os.listdir(root):
+        path = os.path.join(root, name)
+        if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+    return removed
+
+@job('fhir.export', max_attempts=2)
+def export_job(export_id, types, since=None):
+    """Bulk $export in the background"""
+    return run_export(export_id, types, since=since)
+
+@job('fhir.prune_exports', max_attempts=1, every=86400)
+def prune_exports_job():
+    return {'removed': prune_exports()}
+
+@app.cli.group('fhir')
+def fhir_cli():
+    """FHIR bulk data commands"""
+
+@fhir_cli.command('export')
+@click.option('--type', 'types', multiple=True, type=click.Choice(list(RESOURCE_TYPES)),
+              help='Resource types to export (default: all).')
+@click.option('--since', help='Only resources changed at or after this ISO timestamp.')
+@click.option('--id', 'export_id', default=None, help='Output directory name under FHIR_EXPORT_DIR.')
+def export_command(types, since, export_id):
+    """Write NDJSON files per resource type without going through the job queue"""
+    export_id = export_id or datetime.utcnow().strftime('cli-%Y%m%d%H%M%S')
+    manifest = run_export(export_id, list(types or RESOURCE_TYPES), since=since)
+    for entry in manifest['output']:
+        click.echo(f"{entry['count']} {entry['type']} -> {os.path.join(export_dir(export_id), entry['file'])}")
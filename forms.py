@@ -191,6 +191,12 @@ class HealthRecordForm(FlaskForm):
     follow_up_date = DateField('Follow-up Date', validators=[Optional()], widget=DateInput())
     facility_name = StringField('Facility Name', validators=[Optional(), Length(max=200)])
 
+class ScreeningSessionForm(FlaskForm):
+    """Session-wide fields for grid entry; per-patient vitals are validated in screening.py"""
+    encounter_type = SelectField('Encounter Type', choices=HealthRecordForm.encounter_type.kwargs['choices'],
+                                 default='screening', validators=[DataRequired()])
+    facility_name = StringField('Facility Name', validators=[Optional(), Length(max=200)])
+
 class OutreachEventForm(FlaskForm):
     title = StringField('Event Title', validators=[DataRequired(), Length(max=200)])
     description = TextAreaField('Description', validators=[Optional()])
@@ -0,0 +1,216 @@
+import os
+import glob
+import threading
+from datetime import date
+import click
+from sqlalchemy import select, func
+from app import app, db
+from models import User, Patient, HealthRecord, OutreachEvent, EventAttendance
+from jobs import job
+
+# Per-ward counters stored in each snapshot, in column order
+COUNTERS = ('patients', 'chws', 'encounters', 'events', 'attendances')
+# Incrementally counted tables and their high-water marks
+WATERMARKS = ('health_record', 'outreach_event', 'event_attendance')
+
+def _ward_key(county, subcounty, ward):
+    return tuple((value or '').strip().lower() for value in (county, subcounty, ward))
+
+def snapshot_path(day):
+    return os.path.join(app.config['GEO_DIR'], f'ward_metrics-{day:%Y%m%d}.npz')
+
+def latest_snapshot_path():
+    paths = sorted(glob.glob(os.path.join(app.config['GEO_DIR'], 'ward_metrics-*.npz')))
+    return paths[-1] if paths else None
+
+def load_snapshot(path):
+    """Read a snapshot into ({ward key: [counters]}, {table: watermark})"""
+    import numpy as np
+
+    with np.load(path) as data:
+        keys = zip(data['county'].tolist(), data['subcounty'].tolist(), data['ward'].tolist())
+        counts = data['counts'].tolist()
+        wards = {key: row for key, row in zip(keys, counts)}
+        watermarks = dict(zip(WATERMARKS, data['watermarks'].tolist()))
+    return wards, watermarks
+
+def write_snapshot(path, wards, watermarks):
+    """Store wards as columns: three string arrays and an int matrix of COUNTERS"""
+    import numpy as np
+
+    keys = sorted(wards)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = os.path.join(os.path.dirname(path), f'.{os.path.basename(path)}.tmp.npz')
+    np.savez_compressed(
+        tmp_path,
+        county=np.array([k[0] for k in keys], dtype=str),
+        subcounty=np.array([k[1] for k in keys], dtype=str),
+        ward=np.array([k[2] for k in keys], dtype=str),
+        counts=np.array([wards[k] for k in keys], dtype=np.int64).reshape(len(keys), len(COUNTERS)),
+        watermarks=np.array([watermarks[name] for name in WATERMARKS], dtype=np.int64)
+    )
+    # Readers never see a half-written file
+    os.replace(tmp_path, path)
+
+def _add(wards, rows, counter):
+    column = COUNTERS.index(counter)
+    for county, subcounty, ward, count in rows:
+        wards.setdefault(_ward_key(county, subcounty, ward), [0] * len(COUNTERS))[column] += count
+
+def _max_id(model):
+    return db.session.execute(select(func.coalesce(func.max(model.id), 0))).scalar()
+
+def refresh(full=False):
+    """Bring today's snapshot up to date and return a summary
+
+    Patients and CHWs are recounted each time (they move between wards
+    and change status). Encounters, events and attendances only grow, so
+    just the rows added since the previous snapshot's watermarks are
+    grouped and added on. ``full`` recounts everything.
+
+    The watermarks are ids, and on PostgreSQL an id is taken before its
+    transaction commits, so a row committed after a higher one was counted
+    falls below the watermark and is missed. Only today's snapshot is
+    built on incrementally: the first refresh of each day recounts in full,
+    which bounds how long such a row stays uncounted.
+    """
+    previous = None if full else latest_snapshot_path()
+    if previous != snapshot_path(date.today()):
+        previous = None
+    if previous:
+        wards, watermarks = load_snapshot(previous)
+    else:
+        wards, watermarks = {}, dict.fromkeys(WATERMARKS, 0)
+
+    # Current populations replace the stored ones
+    for row in wards.values():
+        row[COUNTERS.index('patients')] = row[COUNTERS.index('chws')] = 0
+    _add(wards, db.session.execute(
+        select(Patient.county, Patient.subcounty, Patient.ward, func.count(Patient.id))
+        .where(Patient.status == 'active')
+        .group_by(Patient.county, Patient.subcounty, Patient.ward)
+    ).all(), 'patients')
+    _add(wards, db.session.execute(
+        select(User.county, User.subcounty, User.ward, func.count(User.id))
+        .where(User.role == 'chw', User.is_active.is_(True))
+        .group_by(User.county, User.subcounty, User.ward)
+    ).all(), 'chws')
+
+    # Bound each delta so rows inserted meanwhile are picked up next time
+    high = {
+        'health_record': _max_id(HealthRecord),
+        'outreach_event': _max_id(OutreachEvent),
+        'event_attendance': _max_id(EventAttendance),
+    }
+    _add(wards, db.session.execute(
+        select(Patient.county, Patient.subcounty, Patient.ward, func.count(HealthRecord.id))
+        .join(Patient, Patient.id == HealthRecord.patient_id)
+        .where(HealthRecord.id > watermarks['health_record'], HealthRecord.id <= high['health_record'])
+        .group_by(Patient.county, Patient.subcounty, Patient.ward)
+    ).all(), 'encounters')
+    _add(wards, db.session.execute(
+        select(OutreachEvent.target_county, OutreachEvent.target_subcounty, OutreachEvent.target_ward,
+               func.count(OutreachEvent.id))
+        .where(OutreachEvent.id > watermarks['outreach_event'], OutreachEvent.id <= high['outreach_event'])
+        .group_by(OutreachEvent.target_county, OutreachEvent.target_subcounty, OutreachEvent.target_ward)
+    ).all(), 'events')
+    _add(wards, db.session.execute(
+        select(OutreachEvent.target_county, OutreachEvent.target_subcounty, OutreachEvent.target_ward,
+               func.count(EventAttendance.id))
+        .join(OutreachEvent, OutreachEvent.id == EventAttendance.event_id)
+        .where(EventAttendance.id > watermarks['event_attendance'], EventAttendance.id <= high['event_attendance'])
+        .group_by(OutreachEvent.target_county, OutreachEvent.target_subcounty, OutreachEvent.target_ward)
+    ).all(), 'attendances')
+
+    path = snapshot_path(date.today())
+    write_snapshot(path, wards, high)
+
+    # One file per day; keep a window of history
+    for old in sorted(glob.glob(os.path.join(app.config['GEO_DIR'], 'ward_metrics-*.npz')))[:-app.config['GEO_KEEP_DAYS']]:
+        os.remove(old)
+    return {
+        'snapshot': path,
+        'incremental_from': previous,
+        'wards': len(wards),
+        'rows_scanned': {name: high[name] - watermarks[name] for name in WATERMARKS}
+    }
+
+class SnapshotReader:
+    """Latest snapshot held in memory as numpy columns, reloaded when a newer file appears"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = None  # (path, mtime, columns)
+
+    def columns(self):
+        path = latest_snapshot_path()
+        if path is None:
+            return None, None
+        mtime = os.path.getmtime(path)
+        with self._lock:
+            if self._loaded is None or self._loaded[:2] != (path, mtime):
+                import numpy as np
+                with np.load(path) as data:
+                    columns = {name: data[name] for name in ('county', 'subcounty', 'ward', 'counts')}
+                self._loaded = (path, mtime, columns)
+            return f'{os.path.basename(path)}:{mtime}', self._loaded[2]
+
+_reader = SnapshotReader()
+
+def _ratio(numerator, denominator):
+    import numpy as np
+    with np.errstate(divide='ignore', invalid='ignore'):
+        ratio = np.where(denominator > 0, numerator / np.maximum(denominator, 1), np.nan)
+    return [None if np.isnan(value) else round(float(value), 2) for value in ratio]
+
+def county_slice(county):
+    """Ward metrics for one county as parallel arrays; returns (version, data) or (None, None)"""
+    version, columns = _reader.columns()
+    if columns is None:
+        return None, None
+    mask = columns['county'] == county.strip().lower()
+    counts = columns['counts'][mask]
+    by_name = {name: counts[:, i] for i, name in enumerate(COUNTERS)}
+    data = {
+        'county': county.strip().lower(),
+        'subcounty': columns['subcounty'][mask].tolist(),
+        'ward': columns['ward'][mask].tolist(),
+        **{name: values.tolist() for name, values in by_name.items()},
+        'patients_per_chw': _ratio(by_name['patients'], by_name['chws']),
+        'encounters_per_patient': _ratio(by_name['encounters'], by_name['patients']),
+        'attendances_per_patient': _ratio(by_name['attendances'], by_name['patients']),
+    }
+    return version, data
+
+def county_totals():
+    """Per-county sums for the map overview; returns (version, data) or (None, None)"""
+    import numpy as np
+
+    version, columns = _reader.columns()
+    if columns is None:
+        return None, None
+    counties, index = np.unique(columns['county'], return_inverse=True)
+    totals = np.zeros((len(counties), len(COUNTERS)), dtype=np.int64)
+    np.add.at(totals, index, columns['counts'])
+    return version, {
+        'county': counties.tolist(),
+        **{name: totals[:, i].tolist() for i, name in enumerate(COUNTERS)},
+        'patients_per_chw': _ratio(totals[:, COUNTERS.index('patients')], totals[:, COUNTERS.index('chws')]),
+    }
+
+@job('geo.refresh', max_attempts=3, every=3600)
+def refresh_job():
+    """Hourly refresh of the ward metrics snapshot, recounted in full once a day"""
+    return refresh()
+
+@app.cli.group('geo')
+def geo_cli():
+    """Geographic coverage commands"""
+
+@geo_cli.command('refresh')
+@click.option('--full', is_flag=True, help='Recount everything instead of adding new rows.')
+def refresh_command(full):
+    """Update today's ward metrics snapshot"""
+    result = refresh(full=full)
+    click.echo(f"{result['wards']} wards written to {result['snapshot']} "
+               f"(scanned {sum(result['rows_scanned'].values())} new rows)")
@@ -0,0 +1,25 @@
+# Gunicorn reads this file from the working directory automatically
+import os
+
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:5000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 2))
+
+# Import the app once in the master and fork workers from it, so each
+# worker starts with modules and compiled templates already loaded.
+# Set GUNICORN_PRELOAD=0 when using --reload.
+preload_app = os.environ.get('GUNICORN_PRELOAD', '1') == '1'
+
+def when_ready(server):
+    if not preload_app:
+        return
+    from app import app
+    from rendering import compile_templates
+    with app.app_context():
+        compile_templates()
+    server.log.info('Startup took %.0fms; templates compiled before fork', app.config['STARTUP_MS'])
+
+def post_fork(server, worker):
+    # Never share pooled database connections across processes
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
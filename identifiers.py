@@ -0,0 +1,161 @@
+"""Time-ordered, collision-free identifiers for patients and payments
+
+An identifier is ``<prefix><YYYYMMDD><sequence><check digit>``, e.g.
+``CHS20260101000012345`` + Luhn digit. Each sequence has its own prefix,
+so a payment reference can never pass for a patient number. The sequence comes from the
+identifier_sequence table; each worker process reserves a block of values
+with one UPDATE and hands them out from memory, so new rows append to the
+end of the unique indexes instead of landing on random pages. Values left
+in a block when a worker exits are skipped, never reused.
+"""
+import os
+import threading
+from datetime import datetime
+import click
+from sqlalchemy import update
+from app import app, db
+from models import IdentifierSequence
+
+# Sequence name -> prefix; prefixes must differ. Payment references issued
+# before PAY also used CHS and stay valid as they are.
+SEQUENCES = {
+    'patient_number': 'CHS',
+    'payment_reference': 'PAY',
+}
+
+SEQUENCE_DIGITS = 8
+
+# Luhn's doubled digit, with the digits of two-digit results summed
+_DOUBLED = {str(d): (2 * d) % 10 + (2 * d) // 10 for d in range(10)}
+
+def check_digit(digits):
+    """Luhn check digit for a string of digits; catches any single mistyped
+    digit and most swapped neighbours"""
+    reverse = digits[::-1]
+    total = sum(_DOUBLED[char] for char in reverse[0::2]) + sum(map(int, reverse[1::2]))
+    return str(-total % 10)
+
+def format_identifier(prefix, day, value):
+    digits = f'{day:%Y%m%d}{value:0{SEQUENCE_DIGITS}d}'
+    return f'{prefix}{digits}{check_digit(digits)}'
+
+def sequence_of(identifier):
+    """Name of the sequence whose current format the identifier has, or None"""
+    identifier = str(identifier or '').strip().upper()
+    for name, prefix in SEQUENCES.items():
+        digits = identifier[len(prefix):]
+        # Legacy suffixes are 8 hex characters (or 12 for old batch references),
+        # so only 17-19 digit tails are in the current format
+        if identifier.startswith(prefix) and digits.isdigit() and 8 + SEQUENCE_DIGITS < len(digits) < 20:
+            return name
+    return None
+
+def is_valid(identifier):
+    """True/False for identifiers in the current format, None for legacy
+    uuid-suffixed ones, which carry no check digit"""
+    sequence = sequence_of(identifier)
+    if sequence is None:
+        return None
+    digits = str(identifier).strip().upper()[len(SEQUENCES[sequence]):]
+    return check_digit(digits[:-1]) == digits[-1]
+
+def _insert_sequence_ignoring_duplicates():
+    """INSERT ... ON CONFLICT (name) DO NOTHING"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(IdentifierSequence).on_conflict_do_nothing(index_elements=['name'])
+
+def seed_sequences():
+    """Create a counter row for every entry in SEQUENCES"""
+    db.session.execute(_insert_sequence_ignoring_duplicates(),
+                       [{'name': name, 'next_value': 1} for name in SEQUENCES])
+    db.session.commit()
+
+def reserve(name, size):
+    """Take ``size`` consecutive values from a sequence; returns (first, end)
+
+    Runs on its own connection and commits immediately, so the values are
+    reserved even if the caller's transaction rolls back. On SQLite call it
+    before the caller's session has pending writes, or it waits on the
+    session's own write lock.
+    """
+    statement = (
+        update(IdentifierSequence)
+        .where(IdentifierSequence.name == name)
+        .values(next_value=IdentifierSequence.next_value + size)
+        .returning(IdentifierSequence.next_value)
+    )
+    with db.engine.begin() as conn:
+        end = conn.execute(statement).scalar()
+        if end is None:
+            conn.execute(_insert_sequence_ignoring_duplicates(), {'name': name, 'next_value': 1})
+            end = conn.execute(statement).scalar()
+    return end - size, end
+
+class BlockAllocator:
+    """Hands out one sequence's values from blocks reserved per worker process"""
+
+    def __init__(self, name, block_size=None):
+        self.name = name
+        self.block_size = block_size
+        self._lock = threading.Lock()
+        self._pid = None
+        self._next = self._end = 0
+
+    def take(self, count=1):
+        """``count`` unused values, ascending"""
+        size = self.block_size or app.config['IDENTIFIER_BLOCK_SIZE']
+        with self._lock:
+            if self._pid != os.getpid():
+                # A forked worker must not hand out its parent's block
+                self._pid = os.getpid()
+                self._next = self._end = 0
+            values = list(range(self._next, min(self._end, self._next + count)))
+            self._next += len(values)
+            missing = count - len(values)
+            if missing >= size:
+                # Large imports get a range of their own
+                first, end = reserve(self.name, missing)
+                values.extend(range(first, end))
+            elif missing:
+                self._next, self._end = reserve(self.name, size)
+                values.extend(range(self._next, self._next + missing))
+                self._next += missing
+            return values
+
+_allocators = {name: BlockAllocator(name) for name in SEQUENCES}
+
+def generate(name, count=1):
+    """``count`` new identifiers from the named sequence"""
+    today = datetime.utcnow()
+    return [format_identifier(SEQUENCES[name], today, value) for value in _allocators[name].take(count)]
+
+def next_patient_number():
+    return generate('patient_number')[0]
+
+def patient_numbers(count):
+    """Patient numbers for a bulk import, reserved in one round trip"""
+    return generate('patient_number', count)
+
+def next_payment_reference():
+    return generate('payment_reference')[0]
+
+def payment_references(count):
+    return generate('payment_reference', count)
+
+@app.cli.group('identifiers')
+def identifiers_cli():
+    """Patient number and payment reference sequences"""
+
+@identifiers_cli.command('check')
+@click.argument('identifier')
+def check_command(identifier):
+    """Verify the check digit of a patient number or payment reference"""
+    valid = is_valid(identifier)
+    if valid is None:
+        click.echo(f'{identifier}: legacy format, no check digit')
+    else:
+        kind = sequence_of(identifier).replace('_', ' ')
+        click.echo(f'{identifier}: {"valid" if valid else "check digit mismatch"} ({kind})')
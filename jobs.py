@@ -0,0 +1,315 @@
+import os
+import json
+import time
+import random
+import signal
+import socket
+import logging
+import threading
+import traceback
+import multiprocessing
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import update, func
+from app import app, db
+from models import Job
+
+logger = logging.getLogger(__name__)
+
+# Registered tasks: name -> {'func', 'max_attempts', 'priority', 'every'}
+_registry = {}
+
+def job(name, max_attempts=5, priority=0, every=None):
+    """Decorator to register a function as a background task
+
+    Tasks with ``every`` (seconds) are also enqueued periodically by the
+    worker, so they must be safe to run twice.
+    """
+    def decorator(f):
+        _registry[name] = {'func': f, 'max_attempts': max_attempts, 'priority': priority, 'every': every}
+        f.delay = lambda **kwargs: enqueue(name, **kwargs)
+        return f
+    return decorator
+
+def enqueue(name, priority=None, delay=0, **kwargs):
+    """Queue a registered task and return the Job row"""
+    if name not in _registry:
+        raise KeyError(f'Unknown job: {name}')
+
+    spec = _registry[name]
+    queued_job = Job(
+        name=name,
+        payload=json.dumps(kwargs, default=str),
+        priority=spec['priority'] if priority is None else priority,
+        max_attempts=spec['max_attempts'],
+        run_at=datetime.utcnow() + timedelta(seconds=delay)
+    )
+    db.session.add(queued_job)
+    db.session.commit()
+
+    # Run in the calling process (development and tests without a worker)
+    if app.config.get('JOBS_EAGER'):
+        queued_job.status = 'running'
+        queued_job.attempts += 1
+        queued_job.started_at = datetime.utcnow()
+        db.session.commit()
+        run_job(queued_job)
+
+    return queued_job
+
+def retry_delay(attempts):
+    """Exponential backoff with jitter, in seconds"""
+    base = app.config.get('JOBS_RETRY_BASE', 5)
+    ceiling = app.config.get('JOBS_RETRY_MAX', 3600)
+    delay = min(base * (2 ** max(attempts - 1, 0)), ceiling)
+    return delay + random.uniform(0, delay * 0.1)
+
+def _due_jobs_query(now):
+    return Job.query.filter(
+        Job.status == 'queued',
+        Job.run_at <= now
+    ).order_by(Job.priority.desc(), Job.run_at, Job.id)
+
+def claim_next(worker_id):
+    """Claim the next due job for this worker, or return None"""
+    now = datetime.utcnow()
+
+    if db.engine.dialect.name == 'postgresql':
+        # Competing workers skip rows another transaction has locked
+        claimed = _due_jobs_query(now).with_for_update(skip_locked=True).first()
+        if claimed is None:
+            db.session.rollback()
+            return None
+        claimed.status = 'running'
+        claimed.attempts += 1
+        claimed.locked_by = worker_id
+        claimed.locked_at = now
+        claimed.started_at = now
+        db.session.commit()
+        return claimed
+
+    # SQLite fallback: no row locks, so claim with a conditional UPDATE
+    # and try the next candidate if another worker won the race
+    for _ in range(5):
+        candidate_id = _due_jobs_query(now).with_entities(Job.id).limit(1).scalar()
+        if candidate_id is None:
+            db.session.rollback()
+            return None
+        won = db.session.execute(
+            update(Job)
+            .where(Job.id == candidate_id, Job.status == 'queued')
+            .values(status='running', attempts=Job.attempts + 1, locked_by=worker_id,
+                    locked_at=now, started_at=now)
+        ).rowcount
+        db.session.commit()
+        if won:
+            return db.session.get(Job, candidate_id)
+    return None
+
+def run_job(claimed):
+    """Execute a claimed job and record its outcome"""
+    job_id = claimed.id
+    name = claimed.name
+    payload = json.loads(claimed.payload or '{}')
+    started = time.perf_counter()
+
+    try:
+        if name not in _registry:
+            raise KeyError(f'Unknown job: {name}')
+        func = _registry[name]['func']
+        result = func(**payload)
+        status, error = 'completed', None
+    except Exception:
+        db.session.rollback()
+        result, status, error = None, 'failed', traceback.format_exc()
+
+    finished = db.session.get(Job, job_id)
+    finished.duration_ms = (time.perf_counter() - started) * 1000
+    finished.finished_at = datetime.utcnow()
+    finished.locked_by = None
+    finished.locked_at = None
+
+    if status == 'completed':
+        finished.status = 'completed'
+        finished.result = json.dumps(result, default=str) if result is not None else None
+        finished.last_error = None
+    elif finished.attempts < finished.max_attempts:
+        finished.status = 'queued'
+        finished.run_at = datetime.utcnow() + timedelta(seconds=retry_delay(finished.attempts))
+        finished.last_error = error
+        logger.warning('Job %s (%s) failed, retry %s/%s', job_id, name,
+                       finished.attempts, finished.max_attempts)
+    else:
+        finished.status = 'failed'
+        finished.last_error = error
+        logger.error('Job %s (%s) failed permanently:\n%s', job_id, name, error)
+
+    db.session.commit()
+    return finished
+
+def requeue_stale(timeout=None):
+    """Return jobs locked by crashed workers to the queue"""
+    timeout = timeout or app.config.get('JOBS_LOCK_TIMEOUT', 1800)
+    cutoff = datetime.utcnow() - timedelta(seconds=timeout)
+    count = db.session.execute(
+        update(Job)
+        .where(Job.status == 'running', Job.locked_at < cutoff)
+        .values(status='queued', locked_by=None, locked_at=None, run_at=datetime.utcnow())
+    ).rowcount
+    db.session.commit()
+    return count
+
+def schedule_recurring():
+    """Enqueue recurring tasks whose interval has elapsed"""
+    now = datetime.utcnow()
+    scheduled = []
+    for name, spec in _registry.items():
+        if not spec['every']:
+            continue
+        pending = db.session.query(Job.id).filter(
+            Job.name == name,
+            Job.status.in_(['queued', 'running'])
+        ).first()
+        if pending:
+            continue
+        last_finished = db.session.query(func.max(Job.finished_at)).filter(
+            Job.name == name,
+            Job.status == 'completed'
+        ).scalar()
+        if last_finished is None or last_finished <= now - timedelta(seconds=spec['every']):
+            enqueue(name)
+            scheduled.append(name)
+    db.session.commit()
+    return scheduled
+
+def job_stats():
+    """Per-task counts and timing metrics"""
+    rows = db.session.query(
+        Job.name,
+        Job.status,
+        func.count(Job.id),
+        func.avg(Job.duration_ms),
+        func.max(Job.duration_ms)
+    ).group_by(Job.name, Job.status).all()
+
+    stats = {}
+    for name, status, count, avg_ms, max_ms in rows:
+        entry = stats.setdefault(name, {})
+        entry[status] = {
+            'count': count,
+            'avg_ms': round(avg_ms, 2) if avg_ms is not None else None,
+            'max_ms': round(max_ms, 2) if max_ms is not None else None
+        }
+    return stats
+
+class Worker:
+    """Polls the queue from a pool of threads in the current process"""
+
+    def __init__(self, threads=4, poll_interval=1.0):
+        self.threads = threads
+        self.poll_interval = poll_interval
+        self.stop_event = threading.Event()
+        self.prefix = f'{socket.gethostname()}:{os.getpid()}'
+
+    def _loop(self, index):
+        worker_id = f'{self.prefix}:{index}'
+        while not self.stop_event.is_set():
+            with app.app_context():
+                try:
+                    claimed = claim_next(worker_id)
+                    if claimed is not None:
+                        run_job(claimed)
+                        continue
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Worker %s error', worker_id)
+                finally:
+                    db.session.remove()
+            self.stop_event.wait(self.poll_interval)
+
+    def _schedule_loop(self):
+        while not self.stop_event.is_set():
+            with app.app_context():
+                try:
+                    schedule_recurring()
+                except Exception:
+                    db.session.rollback()
+                    logger.exception('Recurring job scheduling failed')
+                finally:
+                    db.session.remove()
+            self.stop_event.wait(app.config.get('JOBS_SCHEDULE_INTERVAL', 60))
+
+    def run(self, schedule=True):
+        with app.app_context():
+            requeued = requeue_stale()
+            if requeued:
+                logger.info('Requeued %s stale jobs', requeued)
+
+        pool = [threading.Thread(target=self._loop, args=(i,), daemon=True) for i in range(self.threads)]
+        if schedule:
+            pool.append(threading.Thread(target=self._schedule_loop, daemon=True))
+        for thread in pool:
+            thread.start()
+        try:
+            while any(thread.is_alive() for thread in pool):
+                for thread in pool:
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            self.stop_event.set()
+
+def _run_worker_process(threads, poll_interval, schedule=True):
+    with app.app_context():
+        # Connections inherited from the parent must not be shared after fork
+        db.engine.dispose(close=False)
+    worker = Worker(threads=threads, poll_interval=poll_interval)
+    signal.signal(signal.SIGTERM, lambda *_: worker.stop_event.set())
+    worker.run(schedule=schedule)
+
+@app.cli.group('jobs')
+def jobs_cli():
+    """Background job queue commands"""
+
+@jobs_cli.command('worker')
+@click.option('--threads', default=4, show_default=True, help='Worker threads per process.')
+@click.option('--processes', default=1, show_default=True, help='Worker processes.')
+@click.option('--poll-interval', default=1.0, show_default=True, help='Seconds to wait when the queue is empty.')
+def worker_command(threads, processes, poll_interval):
+    """Run queued jobs until interrupted"""
+    click.echo(f'Starting {processes} process(es) x {threads} thread(s)')
+    if processes <= 1:
+        _run_worker_process(threads, poll_interval)
+        return
+
+    # Only the first process enqueues recurring tasks
+    children = [
+        multiprocessing.Process(target=_run_worker_process, args=(threads, poll_interval, i == 0))
+        for i in range(processes)
+    ]
+    for child in children:
+        child.start()
+    try:
+        for child in children:
+            child.join()
+    except KeyboardInterrupt:
+        for child in children:
+            child.terminate()
+
+@jobs_cli.command('stats')
+def stats_command():
+    """Show job counts and timing per task"""
+    for name, statuses in sorted(job_stats().items()):
+        for status, entry in sorted(statuses.items()):
+            click.echo(f"{name:40} {status:10} {entry['count']:8} "
+                       f"avg={entry['avg_ms']}ms max={entry['max_ms']}ms")
+
+@jobs_cli.command('purge')
+@click.option('--older-than-days', default=30, show_default=True)
+def purge_command(older_than_days):
+    """Delete finished jobs older than the given age"""
+    cutoff = datetime.utcnow() - timedelta(days=older_than_days)
+    count = Job.query.filter(
+        Job.status.in_(['completed', 'failed']),
+        Job.finished_at < cutoff
+    ).delete(synchronize_session=False)
+    db.session.commit()
+    click.echo(f'Purged {count} jobs')
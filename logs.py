@@ -0,0 +1,255 @@
+"""Structured, non-blocking logging
+
+Modules keep using ``logging.getLogger(__name__)``. The root logger has a
+single queue handler. It stamps each record with the request id, user id
+and route of the request that logged it, then puts the record on an
+in-memory queue. A listener thread formats and writes the records, so a
+request never waits on stderr or disk. When the queue is full, records are
+dropped and counted rather than blocking.
+
+Settings (see app.configure):
+
+    LOG_LEVEL    root level, INFO by default
+    LOG_LEVELS   per-logger levels, e.g. "sqlalchemy=WARNING,payouts=DEBUG"
+    LOG_SAMPLE   fraction of records below WARNING to keep, e.g. "access=0.05"
+    LOG_FORMAT   json or text
+    LOG_FILE     rotating file sink; "{pid}" gives each worker its own file
+"""
+import os
+import sys
+import json
+import time
+import uuid
+import queue
+import random
+import atexit
+import logging
+import threading
+import logging.handlers
+from datetime import datetime, timezone
+from flask import g, request, has_request_context
+
+access_logger = logging.getLogger('access')
+
+# Attributes every LogRecord has; anything else was passed with extra=
+_STANDARD_ATTRS = set(vars(logging.LogRecord('', 0, '', 0, '', (), None))) | {
+    'message', 'asctime', 'request_id', 'user_id', 'route', 'sample_rate'
+}
+_CONTEXT_ATTRS = ('request_id', 'user_id', 'route', 'sample_rate')
+
+def parse_pairs(value, convert):
+    """"name=value,name=value" -> {name: convert(value)}"""
+    pairs = {}
+    for item in (value or '').split(','):
+        if '=' in item:
+            name, raw = item.split('=', 1)
+            pairs[name.strip()] = convert(raw.strip())
+    return pairs
+
+def _level(value):
+    return logging.getLevelName(value.upper()) if not value.isdigit() else int(value)
+
+class LogMetrics:
+    """Counts of records queued, dropped on a full queue, and skipped by sampling"""
+
+    FIELDS = ('queued', 'dropped', 'sampled_out')
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counts = dict.fromkeys(self.FIELDS, 0)
+
+    def incr(self, field, amount=1):
+        with self._lock:
+            self.counts[field] += amount
+
+    def snapshot(self):
+        with self._lock:
+            return dict(self.counts)
+
+class JsonFormatter(logging.Formatter):
+    """One JSON object per line; fields passed with extra= are included"""
+
+    def format(self, record):
+        entry = {
+            'ts': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        for name in _CONTEXT_ATTRS:
+            value = getattr(record, name, None)
+            if value is not None:
+                entry[name] = value
+        for name, value in record.__dict__.items():
+            if name not in _STANDARD_ATTRS:
+                entry[name] = value
+        if record.exc_info:
+            entry['exc'] = self.formatException(record.exc_info)
+        if record.stack_info:
+            entry['stack'] = self.formatStack(record.stack_info)
+        return json.dumps(entry, default=str)
+
+class TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__('%(asctime)s %(levelname)s %(name)s [%(request_id)s] %(message)s')
+
+    def format(self, record):
+        if getattr(record, 'request_id', None) is None:
+            record.request_id = '-'
+        return super().format(record)
+
+FORMATTERS = {'json': JsonFormatter, 'text': TextFormatter}
+
+class ContextQueueHandler(logging.handlers.QueueHandler):
+    """Root handler: samples, stamps request context and enqueues without blocking
+
+    The listener thread and its sinks are created on first use in each
+    process, because threads do not survive gunicorn's fork.
+    """
+
+    def __init__(self, make_sinks, sample_rates=None, queue_size=10000):
+        super().__init__(None)
+        self.make_sinks = make_sinks
+        self.sample_rates = sample_rates or {}
+        self.queue_size = queue_size
+        self.metrics = LogMetrics()
+        self.listener = None
+        self._rates = {}
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _sample_rate(self, name):
+        """Rate configured for the logger or its nearest ancestor"""
+        rate = self._rates.get(name)
+        if rate is None:
+            parts = name.split('.')
+            rate = next((self.sample_rates['.'.join(parts[:i])] for i in range(len(parts), 0, -1)
+                         if '.'.join(parts[:i]) in self.sample_rates), 1.0)
+            self._rates[name] = rate
+        return rate
+
+    def _start(self):
+        with self._start_lock:
+            if self._pid == os.getpid():
+                return
+            self.queue = queue.Queue(self.queue_size)
+            self.listener = logging.handlers.QueueListener(self.queue, *self.make_sinks(),
+                                                           respect_handler_level=True)
+            self.listener.start()
+            self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Message arguments and request context belong to the calling thread
+        record.msg = record.getMessage()
+        record.args = None
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            # Only a user Flask-Login already loaded; logging must not query
+            record.user_id = getattr(g.get('_login_user'), 'id', None)
+            record.route = request.url_rule.rule if request.url_rule else request.path
+        return record
+
+    def emit(self, record):
+        if record.levelno < logging.WARNING:
+            rate = self._sample_rate(record.name)
+            if rate < 1.0:
+                if random.random() >= rate:
+                    self.metrics.incr('sampled_out')
+                    return
+                record.sample_rate = rate
+        if self._pid != os.getpid():
+            self._start()
+        try:
+            self.queue.put_nowait(self.prepare(record))
+            self.metrics.incr('queued')
+        except queue.Full:
+            self.metrics.incr('dropped')
+        except Exception:
+            self.handleError(record)
+
+    def flush(self):
+        """Wait until the listener has written everything queued so far"""
+        if self._pid == os.getpid():
+            self.queue.join()
+
+    def close(self):
+        if self._pid == os.getpid() and self.listener is not None:
+            self.listener.stop()
+            for sink in self.listener.handlers:
+                sink.close()
+        self._pid = None
+        super().close()
+
+def configure(level='INFO', levels='', sample='', fmt='json', filename=None,
+              max_bytes=50 * 1024 * 1024, backups=5, queue_size=10000, stream=None):
+    """Install the queue handler on the root logger, replacing earlier handlers; returns it"""
+    formatter = FORMATTERS[fmt]()
+
+    def make_sinks():
+        console = logging.StreamHandler(stream or sys.stderr)
+        console.setFormatter(formatter)
+        sinks = [console]
+        if filename:
+            path = filename.format(pid=os.getpid())
+            os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+            rotating = logging.handlers.RotatingFileHandler(path, maxBytes=max_bytes, backupCount=backups,
+                                                            delay=True)
+            rotating.setFormatter(formatter)
+            sinks.append(rotating)
+        return sinks
+
+    root = logging.getLogger()
+    for old in root.handlers[:]:
+        root.removeHandler(old)
+        old.close()
+    handler = ContextQueueHandler(make_sinks, parse_pairs(sample, float), queue_size)
+    root.addHandler(handler)
+    root.setLevel(_level(level))
+    for name, logger_level in parse_pairs(levels, _level).items():
+        logging.getLogger(name).setLevel(logger_level)
+    return handler
+
+_handler = None
+
+def log_stats():
+    return _handler.metrics.snapshot() if _handler else {}
+
+def configure_from(config):
+    """(Re)apply the LOG_* settings"""
+    global _handler
+    _handler = configure(
+        level=config['LOG_LEVEL'], levels=config['LOG_LEVELS'], sample=config['LOG_SAMPLE'],
+        fmt=config['LOG_FORMAT'], filename=config['LOG_FILE'], max_bytes=config['LOG_FILE_MAX_BYTES'],
+        backups=config['LOG_FILE_BACKUPS'], queue_size=config['LOG_QUEUE_SIZE']
+    )
+    return _handler
+
+def shutdown():
+    """Write out whatever is still queued"""
+    if _handler is not None:
+        _handler.close()
+
+def init_app(app):
+    """Configure logging from app.config and log one access record per request"""
+    configure_from(app.config)
+    atexit.register(shutdown)
+
+    from flask.logging import default_handler
+    app.logger.removeHandler(default_handler)
+
+    @app.before_request
+    def start_request_log():
+        # Keep a caller's id (load balancer, mobile client) so logs can be joined up
+        incoming = request.headers.get('X-Request-ID', '')
+        g.request_id = incoming if 0 < len(incoming) <= 64 and incoming.isprintable() else uuid.uuid4().hex
+        g.request_started = time.perf_counter()
+
+    @app.after_request
+    def finish_request_log(response):
+        response.headers['X-Request-ID'] = g.get('request_id', '')
+        if access_logger.isEnabledFor(logging.INFO):
+            access_logger.info('%s %s %s', request.method, request.path, response.status_code, extra={
+                'status': response.status_code,
+                'duration_ms': round((time.perf_counter() - g.get('request_started', time.perf_counter())) * 1000, 2),
+            })
+        return response
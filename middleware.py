@@ -0,0 +1,190 @@
+import gzip
+import hashlib
+import threading
+from flask import request, g, session, make_response
+from flask_login import current_user
+from werkzeug.datastructures import Headers
+
+try:
+    import brotli
+except ImportError:  # Optional: gzip is used when brotli is unavailable
+    brotli = None
+
+COMPRESSIBLE_TYPES = {
+    'text/html', 'text/css', 'text/plain', 'text/javascript', 'text/csv',
+    'application/javascript', 'application/json', 'application/fhir+json',
+    'application/xml', 'image/svg+xml',
+}
+
+class CompressionMiddleware:
+    """WSGI middleware that gzip/brotli-encodes buffered text responses
+
+    Views can override the defaults with the ``compression`` decorator.
+    Streaming responses (no Content-Length) pass through untouched.
+    """
+
+    def __init__(self, app, min_size=500, level=6):
+        self.app = app
+        self.min_size = min_size
+        self.level = level
+        self.metrics = CompressionMetrics()
+
+    def _choose_encoding(self, accept_encoding):
+        accepted = {part.split(';')[0].strip() for part in accept_encoding.lower().split(',')}
+        if brotli is not None and 'br' in accepted:
+            return 'br'
+        if 'gzip' in accepted:
+            return 'gzip'
+        return None
+
+    def __call__(self, environ, start_response):
+        encoding = self._choose_encoding(environ.get('HTTP_ACCEPT_ENCODING', ''))
+        if encoding is None or environ.get('REQUEST_METHOD') == 'HEAD':
+            return self.app(environ, start_response)
+
+        captured = {}
+
+        def capture(status, headers, exc_info=None):
+            captured['status'] = status
+            captured['headers'] = headers
+            captured['exc_info'] = exc_info
+            return _write_unsupported
+
+        app_iter = self.app(environ, capture)
+        headers = Headers(captured['headers'])
+        options = environ.get('chs.compression', {})
+        endpoint = environ.get('chs.endpoint') or 'unknown'
+        min_size = options.get('min_size', self.min_size)
+
+        content_type = (headers.get('Content-Type') or '').split(';')[0].strip()
+        length = headers.get('Content-Length', type=int)
+        compressible = (
+            options.get('enabled', True)
+            and captured['status'].startswith('200')
+            and 'Content-Encoding' not in headers
+            and 'no-transform' not in headers.get('Cache-Control', '')
+            and content_type in COMPRESSIBLE_TYPES
+            and length is not None
+            and length >= min_size
+        )
+        if not compressible:
+            start_response(captured['status'], captured['headers'], captured['exc_info'])
+            return app_iter
+
+        try:
+            body = b''.join(app_iter)
+        finally:
+            if hasattr(app_iter, 'close'):
+                app_iter.close()
+
+        level = options.get('level', self.level)
+        if encoding == 'br':
+            compressed = brotli.compress(body, quality=min(level, 11))
+        else:
+            compressed = gzip.compress(body, compresslevel=level, mtime=0)
+        self.metrics.record(endpoint, len(body), len(compressed))
+
+        headers['Content-Encoding'] = encoding
+        headers['Content-Length'] = str(len(compressed))
+        vary = headers.get('Vary')
+        headers['Vary'] = f'{vary}, Accept-Encoding' if vary else 'Accept-Encoding'
+        # The encoded body is a different representation of the resource
+        etag = headers.get('ETag')
+        if etag and not etag.startswith('W/'):
+            headers['ETag'] = f'W/{etag}'
+
+        start_response(captured['status'], headers.to_wsgi_list(), captured['exc_info'])
+        return [compressed]
+
+def _write_unsupported(data):
+    raise RuntimeError('CompressionMiddleware does not support the WSGI write() callable')
+
+class CompressionMetrics:
+    """Per-endpoint counts of compressed responses and bytes saved"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.endpoints = {}
+
+    def record(self, endpoint, original, compressed):
+        with self._lock:
+            entry = self.endpoints.setdefault(endpoint, {'responses': 0, 'bytes_in': 0, 'bytes_out': 0})
+            entry['responses'] += 1
+            entry['bytes_in'] += original
+            entry['bytes_out'] += compressed
+
+    def snapshot(self):
+        with self._lock:
+            return {
+                endpoint: dict(entry, bytes_saved=entry['bytes_in'] - entry['bytes_out'])
+                for endpoint, entry in self.endpoints.items()
+            }
+
+def compression(enabled=True, min_size=None, level=None):
+    """Decorator to configure response compression for a view"""
+    options = {'enabled': enabled}
+    if min_size is not None:
+        options['min_size'] = min_size
+    if level is not None:
+        options['level'] = level
+
+    def decorator(f):
+        f.compression_options = options
+        return f
+    return decorator
+
+def data_version_etag(*versions):
+    """Weak ETag value for a page built from the given data versions"""
+    parts = [request.full_path, current_user.get_id()] + [repr(v) for v in versions]
+    return hashlib.sha1('|'.join(str(p) for p in parts).encode('utf-8')).hexdigest()[:20]
+
+def not_modified(*versions, last_modified=None):
+    """Return a 304 response if the client's copy is current, otherwise None
+
+    Call before rendering with whatever identifies the data on the page
+    (e.g. max updated_at, row ids and statuses). The ETag is attached to
+    the rendered response by the after_request hook.
+    """
+    # Rendering would consume pending flash messages, so always render then
+    if session.get('_flashes'):
+        return None
+
+    etag = data_version_etag(*versions)
+    g.etag = etag
+    g.last_modified = last_modified
+
+    if request.if_none_match.contains_weak(etag):
+        response = make_response('', 304)
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+    return None
+
+def init_app(app):
+    """Wrap the WSGI app and register conditional GET hooks"""
+    app.wsgi_app = CompressionMiddleware(
+        app.wsgi_app,
+        min_size=app.config.get('COMPRESSION_MIN_SIZE', 500),
+        level=app.config.get('COMPRESSION_LEVEL', 6)
+    )
+
+    @app.before_request
+    def expose_route_options():
+        request.environ['chs.endpoint'] = request.endpoint
+        view = app.view_functions.get(request.endpoint)
+        options = getattr(view, 'compression_options', None)
+        if options:
+            request.environ['chs.compression'] = options
+
+    @app.after_request
+    def attach_validators(response):
+        etag = g.get('etag')
+        if etag and response.status_code == 200:
+            response.set_etag(etag, weak=True)
+            if g.get('last_modified'):
+                response.last_modified = g.last_modified
+            # Private pages: browsers may keep them but must revalidate
+            response.headers['Cache-Control'] = 'private, no-cache'
+        return response
+
+    return app.wsgi_app
@@ -0,0 +1,143 @@
+import logging
+import click
+from sqlalchemy import inspect, text
+from app import app, db
+
+logger = logging.getLogger(__name__)
+
+def ensure_indexes(model):
+    """Create any indexes declared on the model that are missing"""
+    for index in model.__table__.indexes:
+        index.create(db.engine, checkfirst=True)
+
+def has_index(table_name, index_name):
+    return any(i['name'] == index_name for i in inspect(db.engine).get_indexes(table_name))
+
+def ensure_column(model, column_name):
+    """Add a column declared on the model (or Table) if the table predates it
+
+    Returns True when the column was added, so callers can backfill it.
+    """
+    table = getattr(model, '__table__', model)
+    existing = {c['name'] for c in inspect(db.engine).get_columns(table.name)}
+    if column_name in existing:
+        return False
+
+    column = table.columns[column_name]
+    ddl = f'ALTER TABLE "{table.name}" ADD COLUMN "{column_name}" {column.type.compile(dialect=db.engine.dialect)}'
+    if column.server_default is not None:
+        ddl += f' DEFAULT {column.server_default.arg}'
+        if not column.nullable:
+            ddl += ' NOT NULL'
+    with db.engine.begin() as conn:
+        conn.execute(text(ddl))
+    return True
+
+def merge_duplicate_attendances():
+    """Fold repeated (event, patient) attendances into the earliest one; returns [(merged_id, kept_id)]
+
+    Services and notes of the merged rows are carried over to the kept row
+    before the duplicates are deleted, so nothing recorded is lost.
+    """
+    from attendance import parse_services
+
+    with db.engine.begin() as conn:
+        duplicates = conn.execute(text(
+            "SELECT a.id, k.keep_id FROM event_attendance a JOIN "
+            "(SELECT event_id, patient_id, MIN(id) AS keep_id FROM event_attendance "
+            "GROUP BY event_id, patient_id HAVING COUNT(*) > 1) k "
+            "ON a.event_id = k.event_id AND a.patient_id = k.patient_id "
+            "WHERE a.id <> k.keep_id ORDER BY a.id"
+        )).all()
+        for duplicate, keep in duplicates:
+            kept = conn.execute(text("SELECT services_received, notes FROM event_attendance WHERE id = :id"),
+                                {'id': keep}).one()
+            extra = conn.execute(text("SELECT services_received, notes FROM event_attendance WHERE id = :id"),
+                                 {'id': duplicate}).one()
+            services = parse_services(kept.services_received)
+            added = [service for service in parse_services(extra.services_received) if service not in services]
+            notes = kept.notes
+            if extra.notes and extra.notes not in (notes or ''):
+                notes = f'{notes}\n{extra.notes}' if notes else extra.notes
+            conn.execute(text("UPDATE event_attendance SET services_received = :services, notes = :notes WHERE id = :id"), {
+                'services': ', '.join(services + added) if added else kept.services_received,
+                'notes': notes, 'id': keep
+            })
+            # Structured services move across unless the kept row already has them
+            conn.execute(text(
+                "UPDATE attendance_service SET attendance_id = :keep WHERE attendance_id = :duplicate "
+                "AND service NOT IN (SELECT service FROM attendance_service WHERE attendance_id = :keep)"
+            ), {'keep': keep, 'duplicate': duplicate})
+            conn.execute(text("DELETE FROM attendance_service WHERE attendance_id = :duplicate"), {'duplicate': duplicate})
+            conn.execute(text("DELETE FROM event_attendance WHERE id = :duplicate"), {'duplicate': duplicate})
+        if duplicates:
+            conn.execute(text(
+                "UPDATE outreach_event SET attendance_count = "
+                "(SELECT COUNT(*) FROM event_attendance WHERE event_attendance.event_id = outreach_event.id)"
+            ))
+    return [tuple(row) for row in duplicates]
+
+def upgrade():
+    """Bring an existing database up to date with models.py"""
+    import models
+
+    # New tables; create_all() leaves existing tables untouched
+    db.create_all()
+
+    ensure_indexes(models.AuditLog)
+    ensure_indexes(models.Patient)
+    ensure_indexes(models.HealthRecord)
+
+    # County partition keys on child tables (see partitioning.py)
+    added = [ensure_column(models.HealthRecord, 'county'), ensure_column(models.EventAttendance, 'county')]
+    if any(added):
+        from partitioning import backfill_counties
+        backfill_counties()
+
+    # Bulk CHW allowance payouts
+    ensure_column(models.Payment, 'batch_id')
+    # FHIR PaymentNotice pages on updated_at; completion was the last change before it existed
+    if ensure_column(models.Payment, 'updated_at'):
+        with db.engine.begin() as conn:
+            conn.execute(text("UPDATE payment SET updated_at = COALESCE(completed_at, created_at)"))
+    ensure_indexes(models.Payment)
+
+    # Outreach capacity: seat counter and one attendance per patient per event
+    if ensure_column(models.OutreachEvent, 'attendance_count'):
+        with db.engine.begin() as conn:
+            conn.execute(text(
+                "UPDATE outreach_event SET attendance_count = "
+                "(SELECT COUNT(*) FROM event_attendance WHERE event_attendance.event_id = outreach_event.id)"
+            ))
+    if not has_index('event_attendance', 'uq_event_attendance_event_patient'):
+        merged = merge_duplicate_attendances()
+        if merged:
+            logger.warning('Merged %s duplicate event attendances into the earliest one per event and patient: %s',
+                           len(merged), ', '.join(f'{dup}->{keep}' for dup, keep in merged))
+        ensure_indexes(models.EventAttendance)
+
+    # Structured services for attendances recorded before attendance_service existed
+    if not db.session.execute(text("SELECT 1 FROM attendance_service LIMIT 1")).first():
+        from attendance import migrate_services
+        migrate_services()
+
+    # Clinical code dictionary for the coded condition/medication tables
+    from coding import seed_codes
+    seed_codes()
+
+    from identifiers import seed_sequences
+    seed_sequences()
+
+    # Cold tier for inactive patients and old records
+    from archive import create_tables
+    create_tables()
+
+@app.cli.group('db')
+def db_cli():
+    """Database schema commands"""
+
+@db_cli.command('upgrade')
+def upgrade_command():
+    """Create missing tables and apply schema changes"""
+    upgrade()
+    click.echo('Database schema is up to date')
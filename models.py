@@ -1,7 +1,7 @@
 from datetime import datetime
 from app import db
 from flask_login import UserMixin
-from werkzeug.security import generate_password_hash, check_password_hash
+from passwords import hash_password, verify_password, needs_rehash
 
 class User(UserMixin, db.Model):
     """User model with role-based access control"""
@@ -29,10 +29,15 @@ class User(UserMixin, db.Model):
     payments_received = db.relationship('Payment', foreign_keys='Payment.received_by_id', backref='receiver', lazy=True)
 
     def set_password(self, password):
-        self.password_hash = generate_password_hash(password)
+        self.password_hash = hash_password(password)
 
     def check_password(self, password):
-        return check_password_hash(self.password_hash, password)
+        """Verify the password, upgrading the stored hash if the hashing settings changed"""
+        if not verify_password(self.password_hash, password):
+            return False
+        if needs_rehash(self.password_hash):
+            self.password_hash = hash_password(password)
+        return True
 
     def get_full_name(self):
         return f"{self.first_name} {self.last_name}"
@@ -87,9 +92,24 @@ class Patient(db.Model):
     payments = db.relationship('Payment', backref='patient', lazy=True)
     event_attendances = db.relationship('EventAttendance', backref='patient', lazy=True)
 
+    # CHW scoping and access checks are answered from this index alone
+    __table_args__ = (
+        db.Index('ix_patient_chw', 'assigned_chw_id', 'id'),
+        db.Index('ix_patient_updated', 'updated_at', 'id'),  # FHIR _since paging
+    )
+
     def get_full_name(self):
         return f"{self.first_name} {self.last_name}"
 
+    @staticmethod
+    def search_clause(term):
+        """Quick-search match on name or patient number"""
+        return (
+            Patient.first_name.contains(term) |
+            Patient.last_name.contains(term) |
+            Patient.patient_number.contains(term)
+        )
+
     def get_age(self):
         from datetime import date
         today = date.today()
@@ -121,7 +141,78 @@ class HealthRecord(db.Model):
     provider_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     facility_name = db.Column(db.String(200))
     
+    county = db.Column(db.String(100))  # the patient's county; partition key, see partitioning.py
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    __table_args__ = (
+        db.Index('ix_health_record_patient_date', 'patient_id', 'encounter_date'),
+        db.Index('ix_health_record_created', 'created_at', 'id'),  # FHIR _since paging
+    )
+
+class ClinicalCode(db.Model):
+    """Coded concept for conditions, allergies and medications (seeded from coding.CODES)"""
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)  # condition, allergy, medication
+    code = db.Column(db.String(20), nullable=False)  # ICD-10 for conditions, ATC for medications
+    display = db.Column(db.String(200), nullable=False)
+    
+    __table_args__ = (
+        db.Index('uq_clinical_code_kind_code', 'kind', 'code', unique=True),
+    )
+
+class PatientCondition(db.Model):
+    """Coded allergy, chronic condition or diagnosis extracted from a patient's free text"""
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    code_id = db.Column(db.Integer, db.ForeignKey('clinical_code.id'), nullable=False)
+    source = db.Column(db.String(20), nullable=False)  # allergies, chronic_conditions, diagnosis
+    health_record_id = db.Column(db.Integer, db.ForeignKey('health_record.id'))  # first encounter, for diagnoses
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    code = db.relationship('ClinicalCode')
+    
+    # Cohort queries start from the code; patient pages start from the patient
+    __table_args__ = (
+        db.Index('uq_patient_condition', 'patient_id', 'source', 'code_id', unique=True),
+        db.Index('ix_patient_condition_code', 'code_id', 'patient_id'),
+    )
+
+class EncounterMedication(db.Model):
+    """Coded medication extracted from an encounter's prescriptions"""
+    id = db.Column(db.Integer, primary_key=True)
+    health_record_id = db.Column(db.Integer, db.ForeignKey('health_record.id'), nullable=False)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)  # denormalized for cohort joins
+    code_id = db.Column(db.Integer, db.ForeignKey('clinical_code.id'), nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    code = db.relationship('ClinicalCode')
+    
+    __table_args__ = (
+        db.Index('uq_encounter_medication', 'health_record_id', 'code_id', unique=True),
+        db.Index('ix_encounter_medication_code', 'code_id', 'patient_id'),
+    )
+
+class RiskFlag(db.Model):
+    """Dangerous reading or missed follow-up raised by the risk rules"""
+    id = db.Column(db.Integer, primary_key=True)
+    patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
+    health_record_id = db.Column(db.Integer, db.ForeignKey('health_record.id'), nullable=False)
+    rule = db.Column(db.String(50), nullable=False)  # name of the rule in risk.RULES
+    severity = db.Column(db.String(20), nullable=False)  # critical, high, medium
+    value = db.Column(db.Float)  # the reading that triggered the rule
+    message = db.Column(db.String(200))
+    status = db.Column(db.String(20), nullable=False, default='open')  # open, resolved
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    resolved_at = db.Column(db.DateTime)
+    
+    patient = db.relationship('Patient', backref='risk_flags')
+    
+    # One flag per rule per record; worklists read open flags by severity or patient
+    __table_args__ = (
+        db.Index('uq_risk_flag_record_rule', 'health_record_id', 'rule', unique=True),
+        db.Index('ix_risk_flag_worklist', 'status', 'severity', 'id'),
+        db.Index('ix_risk_flag_patient_status', 'patient_id', 'status'),
+    )
 
 class OutreachEvent(db.Model):
     """Community outreach events and campaigns"""
@@ -142,6 +233,7 @@ class OutreachEvent(db.Model):
     
     # Capacity and targeting
     max_participants = db.Column(db.Integer)
+    attendance_count = db.Column(db.Integer, nullable=False, default=0, server_default='0')  # seats taken; see attendance.reserve_seats
     target_age_min = db.Column(db.Integer)
     target_age_max = db.Column(db.Integer)
     target_gender = db.Column(db.String(10))  # male, female, all
@@ -158,7 +250,7 @@ class OutreachEvent(db.Model):
     attendances = db.relationship('EventAttendance', backref='event', lazy=True, cascade='all, delete-orphan')
 
     def get_attendance_count(self):
-        return len(self.attendances)
+        return self.attendance_count or 0
 
     def is_full(self):
         if self.max_participants:
@@ -172,11 +264,32 @@ class EventAttendance(db.Model):
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'), nullable=False)
     
     attendance_date = db.Column(db.DateTime, default=datetime.utcnow)
-    services_received = db.Column(db.Text)  # JSON string of services
+    services_received = db.Column(db.Text)  # services as entered; structured copy in AttendanceService
     notes = db.Column(db.Text)
     recorded_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
     
+    county = db.Column(db.String(100))  # the event's target county; partition key, see partitioning.py
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    services = db.relationship('AttendanceService', backref='attendance', lazy=True, cascade='all, delete-orphan')
+
+    __table_args__ = (
+        db.Index('uq_event_attendance_event_patient', 'event_id', 'patient_id', unique=True),
+    )
+
+class AttendanceService(db.Model):
+    """One service received at an outreach event attendance (see attendance.parse_services)"""
+    id = db.Column(db.Integer, primary_key=True)
+    attendance_id = db.Column(db.Integer, db.ForeignKey('event_attendance.id'), nullable=False)
+    event_id = db.Column(db.Integer, db.ForeignKey('outreach_event.id'), nullable=False)  # denormalized for reporting
+    service = db.Column(db.String(100), nullable=False)  # normalized: lower case, single spaces
+    
+    # Campaign reports group by event or by service without touching event_attendance
+    __table_args__ = (
+        db.Index('uq_attendance_service', 'attendance_id', 'service', unique=True),
+        db.Index('ix_attendance_service_event', 'event_id', 'service'),
+        db.Index('ix_attendance_service_service', 'service', 'event_id'),
+    )
 
 class Payment(db.Model):
     """Payment transactions for patient fees and CHW allowances"""
@@ -184,7 +297,7 @@ class Payment(db.Model):
     
     # Payment identifiers
     payment_reference = db.Column(db.String(100), unique=True, nullable=False)
-    intasend_ref = db.Column(db.String(100))  # IntaSend transaction reference
+    intasend_ref = db.Column(db.String(100))  # IntaSend transaction reference (per payout, not per request)
     
     # Payment details
     amount = db.Column(db.Float, nullable=False)
@@ -196,6 +309,7 @@ class Payment(db.Model):
     paid_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # Who initiated the payment
     received_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))  # Who received the payment
     patient_id = db.Column(db.Integer, db.ForeignKey('patient.id'))  # Related patient (if applicable)
+    batch_id = db.Column(db.Integer, db.ForeignKey('payout_batch.id'))  # Bulk CHW allowance payout
     
     # Payment status
     status = db.Column(db.String(20), default='pending')  # pending, completed, failed, refunded
@@ -203,17 +317,44 @@ class Payment(db.Model):
     
     # IntaSend specific fields
     intasend_checkout_id = db.Column(db.String(100))
-    intasend_status = db.Column(db.String(50))
+    intasend_status = db.Column(db.String(50))  # payouts: submitted, rejected, unknown (outcome lost, pending lookup)
     phone_number = db.Column(db.String(20))  # For M-Pesa payments
     
     # Timestamps
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     completed_at = db.Column(db.DateTime)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    
+    __table_args__ = (
+        db.Index('ix_payment_batch_status', 'batch_id', 'status'),
+        db.Index('ix_payment_created', 'created_at', 'id'),
+        db.Index('ix_payment_updated', 'updated_at', 'id'),  # FHIR _since paging
+        db.Index('ix_payment_patient', 'patient_id', 'status'),  # patient pages and archiving
+        db.Index('ix_payment_intasend_ref', 'intasend_ref'),  # reconciliation lookups
+        db.Index('ix_payment_checkout', 'intasend_checkout_id'),
+    )
+
+class PayoutBatch(db.Model):
+    """Bulk disbursement of CHW allowances for a period"""
+    id = db.Column(db.Integer, primary_key=True)
+    period_start = db.Column(db.Date, nullable=False)
+    period_end = db.Column(db.Date, nullable=False)
+    county = db.Column(db.String(100))  # None for all counties
+    
+    # Progress
+    status = db.Column(db.String(20), nullable=False, default='draft')  # draft, submitting, submitted, failed
+    payment_count = db.Column(db.Integer, nullable=False, default=0)
+    total_amount = db.Column(db.Float, nullable=False, default=0)
+    submitted_count = db.Column(db.Integer, nullable=False, default=0)
+    failed_count = db.Column(db.Integer, nullable=False, default=0)
+    last_error = db.Column(db.Text)
     
-    def generate_reference(self):
-        """Generate unique payment reference"""
-        import uuid
-        self.payment_reference = f"CHS{datetime.utcnow().strftime('%Y%m%d')}{str(uuid.uuid4())[:8].upper()}"
+    created_by_id = db.Column(db.Integer, db.ForeignKey('user.id'))
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    submitted_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    
+    payments = db.relationship('Payment', backref='batch', lazy='dynamic')
 
 class AuditLog(db.Model):
     """Audit trail for security and compliance"""
@@ -226,3 +367,50 @@ class AuditLog(db.Model):
     ip_address = db.Column(db.String(45))
     user_agent = db.Column(db.Text)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+
+    # Serve "who touched X" and per-user history without scanning the log
+    __table_args__ = (
+        db.Index('ix_audit_log_created_at', 'created_at'),
+        db.Index('ix_audit_log_user_created', 'user_id', 'created_at'),
+        db.Index('ix_audit_log_resource_created', 'resource_type', 'resource_id', 'created_at'),
+    )
+
+class IdentifierSequence(db.Model):
+    """Counter behind identifiers.py; workers reserve blocks of values from it"""
+    name = db.Column(db.String(50), primary_key=True)
+    next_value = db.Column(db.BigInteger, nullable=False, default=1)
+
+class PartitionMigration(db.Model):
+    """Progress of moving one table into county partitions (PostgreSQL only)"""
+    table_name = db.Column(db.String(64), primary_key=True)
+    target_id = db.Column(db.Integer, nullable=False)  # max(id) when copying began; newer rows arrive via the mirror trigger
+    copied_up_to = db.Column(db.Integer, nullable=False, default=0)
+    started_at = db.Column(db.DateTime, default=datetime.utcnow)
+    swapped_at = db.Column(db.DateTime)
+
+class Job(db.Model):
+    """Durable background job queued for the worker"""
+    id = db.Column(db.Integer, primary_key=True)
+    name = db.Column(db.String(100), nullable=False)  # registered task name
+    payload = db.Column(db.Text)  # JSON string of keyword arguments
+    result = db.Column(db.Text)  # JSON string returned by the task
+    priority = db.Column(db.Integer, nullable=False, default=0)  # higher runs first
+
+    # Queue state
+    status = db.Column(db.String(20), nullable=False, default='queued')  # queued, running, completed, failed
+    attempts = db.Column(db.Integer, nullable=False, default=0)
+    max_attempts = db.Column(db.Integer, nullable=False, default=5)
+    run_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    locked_by = db.Column(db.String(100))
+    locked_at = db.Column(db.DateTime)
+    last_error = db.Column(db.Text)
+
+    # Timing metrics
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    started_at = db.Column(db.DateTime)
+    finished_at = db.Column(db.DateTime)
+    duration_ms = db.Column(db.Float)
+
+    __table_args__ = (
+        db.Index('ix_job_dequeue', 'status', 'priority', 'run_at'),
+    )
@@ -0,0 +1,418 @@
+"""County partitioning for patient, health_record and event_attendance
+
+On PostgreSQL, ``flask partitions migrate`` turns each table into a LIST
+partitioned table on its county column. There is one partition per county
+and a default partition for blank or unknown values. The move is online:
+a trigger mirrors writes into the new table while existing rows are copied
+in id batches, then the tables are swapped by renaming them. SQLite, and
+PostgreSQL before the migration, keep single tables. Everything below works
+the same on both.
+
+health_record.county is the patient's county and event_attendance.county
+the event's target county, so all of a patient's encounters, and all of an
+event's attendances, sit in one partition. A query is pruned to a single
+partition only when it filters on county. The routing helpers add that
+filter wherever the county is already known. A CHW's patient list is not
+routed: their patients can live in any county, and looking up which ones
+probes ix_patient_chw in every partition, as the list query does anyway.
+
+A partitioned table's primary key is (id, county), and county is NOT NULL
+there: unknown counties are stored as ''. PostgreSQL cannot point a foreign
+key at id alone, so the swap drops the foreign keys that referenced the old
+table. ``check_references`` (nightly, and ``flask partitions check``) reports
+rows whose referenced row is missing.
+"""
+import re
+import time
+import logging
+from datetime import datetime
+import click
+from sqlalchemy import select, insert, update, text, func, or_
+from sqlalchemy.dialects import postgresql
+from app import app, db
+from models import Patient, HealthRecord, EventAttendance, OutreachEvent, PartitionMigration
+from forms import PatientForm
+from jobs import job
+
+logger = logging.getLogger(__name__)
+
+# In migration order
+PARTITIONED = {
+    'patient': Patient,
+    'health_record': HealthRecord,
+    'event_attendance': EventAttendance,
+}
+
+def counties():
+    """County keys as stored by PatientForm"""
+    return [value for value, _ in PatientForm.county.kwargs['choices'] if value]
+
+# Routing helpers
+
+def same_county(column, county):
+    """``column = county``, so PostgreSQL can prune to one partition
+
+    No county matches NULL and '', which partitioned tables store instead.
+    """
+    if not county:
+        return or_(column.is_(None), column == '')
+    return column == county
+
+def patient_records(model, patient):
+    """WHERE clauses for one patient's rows in health_record"""
+    return model.patient_id == patient.id, same_county(model.county, patient.county)
+
+def event_attendances(event):
+    """WHERE clauses for one event's rows in event_attendance"""
+    return EventAttendance.event_id == event.id, same_county(EventAttendance.county, event.target_county)
+
+def patient_counties(patient_ids):
+    """{patient_id: county} for rows about to be written to health_record"""
+    ids = list(patient_ids)
+    found = {}
+    for start in range(0, len(ids), 500):
+        found.update(db.session.execute(
+            select(Patient.id, Patient.county).where(Patient.id.in_(ids[start:start + 500]))
+        ).all())
+    return found
+
+def move_patient(patient, old_county):
+    """Carry a patient's encounters to their new county; the caller commits"""
+    if patient.county == old_county:
+        return
+    db.session.execute(
+        update(HealthRecord)
+        .where(HealthRecord.patient_id == patient.id, same_county(HealthRecord.county, old_county))
+        .values(county=patient.county)
+        .execution_options(synchronize_session=False)
+    )
+
+def backfill_counties(batch_size=5000):
+    """Fill the county column on rows written before it existed, in id batches"""
+    sources = (
+        (HealthRecord, select(Patient.county)
+         .where(Patient.id == HealthRecord.patient_id).scalar_subquery()),
+        (EventAttendance, select(OutreachEvent.target_county)
+         .where(OutreachEvent.id == EventAttendance.event_id).scalar_subquery()),
+    )
+    updated = {}
+    for model, source in sources:
+        high = db.session.execute(select(func.max(model.id))).scalar() or 0
+        updated[model.__tablename__] = 0
+        for start in range(0, high, batch_size):
+            updated[model.__tablename__] += db.session.execute(
+                update(model)
+                .where(model.id > start, model.id <= start + batch_size, model.county.is_(None))
+                .values(county=source)
+                .execution_options(synchronize_session=False)
+            ).rowcount
+            db.session.commit()
+    return updated
+
+# Online migration (PostgreSQL)
+
+def _quote(name):
+    # PostgreSQL rules even for --dry-run on another database ("user" is reserved there)
+    return postgresql.dialect().identifier_preparer.quote(name)
+
+def _literal(value):
+    return "'" + value.replace("'", "''") + "'"
+
+def partition_name(table, county):
+    return f"{table}_county_{re.sub(r'[^a-z0-9]+', '_', county.lower()) if county else 'default'}"
+
+def is_partitioned(table):
+    if db.engine.dialect.name != 'postgresql':
+        return False
+    return db.session.execute(text(
+        "SELECT EXISTS (SELECT 1 FROM pg_partitioned_table p JOIN pg_class c ON c.oid = p.partrelid "
+        "WHERE c.relname = :table AND pg_table_is_visible(c.oid))"
+    ), {'table': table}).scalar()
+
+def prepare_statements(table):
+    """DDL for ``<table>_partitioned`` and the trigger that mirrors writes into it"""
+    q = _quote
+    columns = PARTITIONED[table].__table__
+    new = f'{table}_partitioned'
+    # The key must include the partition column, which makes county NOT NULL;
+    # rows without a county get '' from the trigger below (both land in the
+    # default partition, so no row changes partition)
+    normalize = q(f'{table}_blank_county')
+    statements = [
+        f'CREATE TABLE {q(new)} (LIKE {q(table)} INCLUDING DEFAULTS, PRIMARY KEY (id, county)) '
+        f'PARTITION BY LIST (county)',
+        f"ALTER TABLE {q(new)} ALTER COLUMN county SET DEFAULT ''",
+        f"""CREATE FUNCTION {normalize}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    NEW.county := COALESCE(NEW.county, '');
+    RETURN NEW;
+END $$""",
+        f'CREATE TRIGGER {normalize} BEFORE INSERT OR UPDATE ON {q(new)} FOR EACH ROW EXECUTE FUNCTION {normalize}()',
+    ]
+
+    bounds = [(partition_name(table, county), f'FOR VALUES IN ({_literal(county)})') for county in counties()]
+    bounds.append((partition_name(table, None), 'DEFAULT'))
+    # Per-partition unique indexes serve lookups by id and by the unique
+    # columns; they only enforce uniqueness within a partition. Ids stay
+    # unique overall through the shared sequence.
+    unique = [column.name for column in columns.columns if column.unique]
+    for name, bound in bounds:
+        statements.append(f'CREATE TABLE {q(name)} PARTITION OF {q(new)} {bound}')
+        statements += [f'CREATE UNIQUE INDEX {q(f"{name}_{column}_key")} ON {q(name)} ({q(column)})'
+                       for column in ['id'] + unique]
+
+    if unique:
+        # patient_number and national_id must be unique across counties, which
+        # no index on a county-partitioned table can enforce; a trigger keeps
+        # every value in one unpartitioned table whose key does
+        lookup, keeper = q(f'{table}_unique_value'), q(f'{table}_unique')
+        values = ', '.join(f'({_literal(column)}, NEW.{q(column)}::text)' for column in unique)
+        statements += [
+            f'CREATE TABLE {lookup} (column_name varchar(64) NOT NULL, value text NOT NULL, '
+            f'row_id integer NOT NULL, PRIMARY KEY (column_name, value))',
+            f'CREATE INDEX {q(f"{table}_unique_value_row_id")} ON {lookup} (row_id)',
+            f"""CREATE FUNCTION {keeper}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM {lookup} WHERE row_id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {lookup} (column_name, value, row_id)
+        SELECT unique_value.column_name, unique_value.value, NEW.id
+        FROM (VALUES {values}) AS unique_value (column_name, value)
+        WHERE unique_value.value IS NOT NULL;
+    END IF;
+    RETURN NULL;
+END $$""",
+            f'CREATE TRIGGER {keeper} AFTER INSERT OR UPDATE OF {", ".join(map(q, unique))} OR DELETE ON {q(new)} '
+            f'FOR EACH ROW EXECUTE FUNCTION {keeper}()',
+        ]
+
+    for index in columns.indexes:
+        names = [column.name for column in index.columns]
+        if index.unique and 'county' not in names:
+            # (event_id, patient_id) already fixes the county through the event
+            names.append('county')
+        statements.append(f'CREATE {"UNIQUE " if index.unique else ""}INDEX {q(index.name + "_partitioned")} '
+                          f'ON {q(new)} ({", ".join(map(q, names))})')
+
+    # Foreign keys into a partitioned table would need county in the key, so
+    # only references to unpartitioned tables are kept; check_references
+    # covers the rest
+    for key in columns.foreign_keys:
+        if key.column.table.name not in PARTITIONED:
+            statements.append(f'ALTER TABLE {q(new)} ADD FOREIGN KEY ({q(key.parent.name)}) '
+                              f'REFERENCES {q(key.column.table.name)} ({q(key.column.name)})')
+
+    mirror = q(f'{table}_mirror')
+    statements += [
+        f"""CREATE FUNCTION {mirror}() RETURNS trigger LANGUAGE plpgsql AS $$
+BEGIN
+    IF TG_OP IN ('UPDATE', 'DELETE') THEN
+        DELETE FROM {q(new)} WHERE id = OLD.id;
+    END IF;
+    IF TG_OP IN ('INSERT', 'UPDATE') THEN
+        INSERT INTO {q(new)} SELECT NEW.*;
+    END IF;
+    RETURN NULL;
+END $$""",
+        f'CREATE TRIGGER {mirror} AFTER INSERT OR UPDATE OR DELETE ON {q(table)} '
+        f'FOR EACH ROW EXECUTE FUNCTION {mirror}()',
+    ]
+    return statements
+
+def prepare(table):
+    """Create the partitioned copy and start mirroring writes into it"""
+    model = PARTITIONED[table]
+    with db.engine.begin() as conn:
+        for statement in prepare_statements(table):
+            conn.exec_driver_sql(statement)
+        # CREATE TRIGGER holds off writers until commit, so every row above
+        # this id reaches the new table through the trigger
+        target = conn.execute(select(func.max(model.id))).scalar() or 0
+        conn.execute(insert(PartitionMigration).values(table_name=table, target_id=target, copied_up_to=0))
+
+def copy_batch(table, batch_size):
+    """Copy the next id range into the partitioned table; returns rows copied, or None when done"""
+    q = _quote
+    with db.engine.begin() as conn:
+        migration = conn.execute(
+            select(PartitionMigration.copied_up_to, PartitionMigration.target_id)
+            .where(PartitionMigration.table_name == table)
+        ).one()
+        if migration.copied_up_to >= migration.target_id:
+            return None
+        end = min(migration.copied_up_to + batch_size, migration.target_id)
+        window = {'start': migration.copied_up_to, 'end': end}
+        # Writers wait for this batch; rows they changed earlier are replaced
+        # by the current version, and later changes go through the trigger
+        conn.exec_driver_sql(f'LOCK TABLE {q(table)} IN SHARE MODE')
+        conn.execute(text(f'DELETE FROM {q(table + "_partitioned")} WHERE id > :start AND id <= :end'), window)
+        copied = conn.execute(text(
+            f'INSERT INTO {q(table + "_partitioned")} SELECT * FROM {q(table)} WHERE id > :start AND id <= :end'
+        ), window).rowcount
+        conn.execute(update(PartitionMigration).where(PartitionMigration.table_name == table)
+                     .values(copied_up_to=end))
+    return copied
+
+def swap(table):
+    """Put the partitioned table in place; the old one is kept as ``<table>_unpartitioned``
+
+    Foreign keys referencing the table cannot follow it (PostgreSQL needs
+    county in the referenced key) and are dropped. Returns their
+    definitions, which are also logged; check_references then reports
+    rows that lose their referenced row.
+    """
+    q = _quote
+    model = PARTITIONED[table]
+    dropped = []
+    with db.engine.begin() as conn:
+        conn.exec_driver_sql(f'LOCK TABLE {q(table)} IN ACCESS EXCLUSIVE MODE')
+        conn.exec_driver_sql(f'DROP TRIGGER {q(table + "_mirror")} ON {q(table)}')
+        conn.exec_driver_sql(f'DROP FUNCTION {q(table + "_mirror")}()')
+        for referencing, constraint, definition in conn.execute(text(
+            "SELECT conrelid::regclass::text, conname, pg_get_constraintdef(oid) FROM pg_constraint "
+            "WHERE contype = 'f' AND confrelid = CAST(:table AS regclass)"
+        ), {'table': q(table)}).all():
+            conn.exec_driver_sql(f'ALTER TABLE {referencing} DROP CONSTRAINT {q(constraint)}')
+            dropped.append(f'{referencing}.{constraint}: {definition}')
+            logger.warning('Dropped foreign key %s on %s (%s) to swap in partitioned %s',
+                           constraint, referencing, definition, table)
+        sequence = conn.execute(text("SELECT pg_get_serial_sequence(:table, 'id')"), {'table': q(table)}).scalar()
+        for (index,) in conn.execute(text("SELECT indexname FROM pg_indexes WHERE tablename = :table"),
+                                     {'table': table}):
+            conn.exec_driver_sql(f'ALTER INDEX {q(index)} RENAME TO {q((index + "_unpartitioned")[:63])}')
+        conn.exec_driver_sql(f'ALTER TABLE {q(table)} RENAME TO {q(table + "_unpartitioned")}')
+        conn.exec_driver_sql(f'ALTER TABLE {q(table + "_partitioned")} RENAME TO {q(table)}')
+        for index in model.__table__.indexes:
+            conn.exec_driver_sql(f'ALTER INDEX {q(index.name + "_partitioned")} RENAME TO {q(index.name)}')
+        if sequence:
+            # Keep the id sequence alive when the old table is dropped
+            conn.exec_driver_sql(f'ALTER SEQUENCE {sequence} OWNED BY {q(table)}.id')
+        conn.execute(update(PartitionMigration).where(PartitionMigration.table_name == table)
+                     .values(swapped_at=datetime.utcnow()))
+    return dropped
+
+def references():
+    """(referencing table, column, partitioned table) for every declared foreign key into PARTITIONED"""
+    return [
+        (table, key.parent.name, key.column.table.name)
+        for table in db.metadata.sorted_tables
+        for key in table.foreign_keys
+        if key.column.table.name in PARTITIONED and key.column.name == 'id'
+    ]
+
+def check_references():
+    """Count rows whose foreign key points at a missing row in a partitioned table
+
+    Stands in for the foreign keys the swap drops. SQLite does not enforce
+    foreign keys by default either, so this runs on both.
+    """
+    orphans = {}
+    for table, column, target in references():
+        count = db.session.execute(
+            select(func.count()).select_from(table).where(
+                table.c[column].is_not(None),
+                ~select(PARTITIONED[target].id).where(PARTITIONED[target].id == table.c[column]).exists()
+            )
+        ).scalar()
+        orphans[f'{table.name}.{column}'] = count
+        if count:
+            logger.warning('%s rows in %s reference a missing %s (%s)', count, table.name, target, column)
+    return orphans
+
+@job('partitions.check_references', max_attempts=1, every=86400)
+def check_references_job():
+    """Nightly referential integrity check for the partitioned tables"""
+    return check_references()
+
+def migrate_table(table, batch_size=5000, pause=0.0, do_swap=True, echo=click.echo):
+    """Prepare, copy and swap one table; resumes where an earlier run stopped"""
+    if is_partitioned(table):
+        echo(f'{table}: already partitioned')
+        return
+    if db.session.get(PartitionMigration, table) is None:
+        prepare(table)
+        echo(f'{table}: partitioned copy created, mirroring writes')
+    db.session.rollback()
+
+    total = 0
+    while (copied := copy_batch(table, batch_size)) is not None:
+        total += copied
+        if pause:
+            # Leave room for the writers queued behind each batch
+            time.sleep(pause)
+    echo(f'{table}: {total} rows copied')
+    if do_swap:
+        dropped = swap(table)
+        echo(f'{table}: swapped; old rows kept in {table}_unpartitioned')
+        for definition in dropped:
+            echo(f'{table}: dropped foreign key {definition}; checked by `flask partitions check`')
+
+@app.cli.group('partitions')
+def partitions_cli():
+    """County partitioning of patient, health_record and event_attendance"""
+
+@partitions_cli.command('status')
+def status_command():
+    """Show which tables are partitioned and how far a migration has got"""
+    for table in PARTITIONED:
+        migration = db.session.get(PartitionMigration, table)
+        if is_partitioned(table):
+            state = 'partitioned'
+        elif migration:
+            state = f'copying, {migration.copied_up_to}/{migration.target_id}'
+        else:
+            state = 'single table'
+        click.echo(f'{table}: {state}')
+
+@partitions_cli.command('check')
+def check_command():
+    """Report rows referencing missing patients, encounters or attendances"""
+    orphans = check_references()
+    for reference, count in orphans.items():
+        click.echo(f'{reference}: {count} orphaned rows' if count else f'{reference}: ok')
+    if any(orphans.values()):
+        raise click.exceptions.Exit(1)
+
+@partitions_cli.command('backfill')
+@click.option('--batch-size', default=5000, show_default=True)
+def backfill_command(batch_size):
+    """Fill health_record.county and event_attendance.county"""
+    for table, count in backfill_counties(batch_size).items():
+        click.echo(f'{table}: {count} rows updated')
+
+@partitions_cli.command('migrate')
+@click.option('--table', 'tables', multiple=True, type=click.Choice(list(PARTITIONED)),
+              help='Tables to migrate (default: all).')
+@click.option('--batch-size', default=5000, show_default=True, help='Rows copied per locked batch.')
+@click.option('--pause', default=0.05, show_default=True, help='Seconds to sleep between batches.')
+@click.option('--swap/--no-swap', 'do_swap', default=True, help='Swap tables once copying finishes.')
+@click.option('--dry-run', is_flag=True, help='Print the DDL without running it.')
+def migrate_command(tables, batch_size, pause, do_swap, dry_run):
+    """Move existing rows into county partitions while the app keeps running"""
+    tables = tables or list(PARTITIONED)
+    if dry_run:
+        for table in tables:
+            for statement in prepare_statements(table):
+                click.echo(f'{statement};')
+        return
+    if db.engine.dialect.name != 'postgresql':
+        raise click.ClickException('County partitioning needs PostgreSQL; SQLite keeps single tables')
+
+    backfill_counties(batch_size)
+    for table in tables:
+        migrate_table(table, batch_size, pause, do_swap)
+
+@partitions_cli.command('drop-old')
+@click.option('--table', 'tables', multiple=True, type=click.Choice(list(PARTITIONED)))
+def drop_old_command(tables):
+    """Drop the pre-partitioning copies kept after a swap"""
+    for table in tables or PARTITIONED:
+        migration = db.session.get(PartitionMigration, table)
+        if migration is None or migration.swapped_at is None:
+            click.echo(f'{table}: not swapped, nothing to drop')
+            continue
+        with db.engine.begin() as conn:
+            conn.exec_driver_sql(f'DROP TABLE IF EXISTS {_quote(table + "_unpartitioned")}')
+        click.echo(f'{table}: dropped {table}_unpartitioned')
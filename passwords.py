@@ -0,0 +1,96 @@
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeout
+from werkzeug.security import generate_password_hash, check_password_hash
+from app import app
+
+class HashingBusy(Exception):
+    """Every hashing thread stayed busy past the wait timeout"""
+
+# hashlib's pbkdf2/scrypt release the GIL, so hashing runs on a small pool:
+# other request threads keep serving while a login storm is capped at
+# PASSWORD_HASH_THREADS cores per worker instead of all of them.
+_pool = ThreadPoolExecutor(max_workers=app.config['PASSWORD_HASH_THREADS'], thread_name_prefix='password-hash')
+_method_prefix = None
+
+def _run(func, *args):
+    future = _pool.submit(func, *args)
+    try:
+        return future.result(timeout=app.config['PASSWORD_HASH_TIMEOUT'])
+    except FutureTimeout:
+        future.cancel()
+        raise HashingBusy()
+
+def hash_password(password):
+    """Hash with the configured PASSWORD_HASH_METHOD (werkzeug method string)"""
+    return _run(generate_password_hash, password, app.config['PASSWORD_HASH_METHOD'])
+
+def verify_password(password_hash, password):
+    return _run(check_password_hash, password_hash, password)
+
+def needs_rehash(password_hash):
+    """True when the stored hash was made with a different algorithm or cost"""
+    global _method_prefix
+    if _method_prefix is None:
+        # werkzeug expands defaults (e.g. "scrypt" -> "scrypt:32768:8:1"); learn the full form once
+        _method_prefix = generate_password_hash('', app.config['PASSWORD_HASH_METHOD']).split('$', 1)[0]
+    return password_hash.split('$', 1)[0] != _method_prefix
+
+class TokenBucketThrottle:
+    """Per-key token buckets kept in memory
+
+    Each key may fail ``capacity`` times in a burst, regaining one attempt
+    every ``1 / rate`` seconds. Only failures spend tokens, so colleagues
+    logging in from one clinic IP are not penalized for succeeding.
+    """
+
+    def __init__(self, capacity, rate, max_keys=100000):
+        self.capacity = capacity
+        self.rate = rate
+        self.max_keys = max_keys
+        self.rejected = 0
+        self._buckets = {}  # key -> (tokens, updated)
+        self._lock = threading.Lock()
+
+    def _tokens(self, key, now):
+        tokens, updated = self._buckets.get(key, (self.capacity, now))
+        return min(self.capacity, tokens + (now - updated) * self.rate)
+
+    def allowed(self, key):
+        with self._lock:
+            if self._tokens(key, time.monotonic()) >= 1:
+                return True
+            self.rejected += 1
+            return False
+
+    def spend(self, key):
+        with self._lock:
+            now = time.monotonic()
+            self._buckets[key] = (max(self._tokens(key, now) - 1, 0), now)
+            if len(self._buckets) > self.max_keys:
+                self._prune(now)
+
+    def _prune(self, now):
+        # Buckets that have refilled carry no state worth keeping
+        for key in [k for k in self._buckets if self._tokens(k, now) >= self.capacity]:
+            del self._buckets[key]
+
+user_throttle = TokenBucketThrottle(*app.config['LOGIN_THROTTLE_USER'])
+ip_throttle = TokenBucketThrottle(*app.config['LOGIN_THROTTLE_IP'])
+
+def login_allowed(username, ip):
+    """Cheap check before any database or hashing work"""
+    return user_throttle.allowed(username.lower()) and ip_throttle.allowed(ip)
+
+def record_failed_login(username, ip):
+    user_throttle.spend(username.lower())
+    ip_throttle.spend(ip)
+
+def password_stats():
+    return {
+        'method': app.config['PASSWORD_HASH_METHOD'],
+        'hash_threads': app.config['PASSWORD_HASH_THREADS'],
+        'queued': _pool._work_queue.qsize(),
+        'throttled_users': user_throttle.rejected,
+        'throttled_ips': ip_throttle.rejected
+    }
@@ -0,0 +1,450 @@
+import os
+import json
+import time
+import uuid
+import random
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import select, insert, update, func, distinct, literal, bindparam
+from app import app, db
+from models import User, HealthRecord, EventAttendance, Payment, PayoutBatch, Job
+from utils import log_audit
+from jobs import job, enqueue
+from identifiers import payment_references
+
+logger = logging.getLogger(__name__)
+
+def compute_allowances(period_start, period_end, county=None):
+    """Allowance per active CHW for a period, from activity counted in SQL
+
+    Returns rows of (user_id, name, phone_number, patients, encounters,
+    attendances, amount). Patients served are distinct patients the CHW
+    recorded an encounter for.
+    """
+    start = datetime.combine(period_start, datetime.min.time())
+    end = datetime.combine(period_end + timedelta(days=1), datetime.min.time())
+
+    encounters = select(
+        HealthRecord.provider_id.label('user_id'),
+        func.count(HealthRecord.id).label('encounters'),
+        func.count(distinct(HealthRecord.patient_id)).label('patients')
+    ).where(
+        HealthRecord.encounter_date >= start, HealthRecord.encounter_date < end
+    ).group_by(HealthRecord.provider_id).subquery()
+
+    attendances = select(
+        EventAttendance.recorded_by_id.label('user_id'),
+        func.count(EventAttendance.id).label('attendances')
+    ).where(
+        EventAttendance.attendance_date >= start, EventAttendance.attendance_date < end
+    ).group_by(EventAttendance.recorded_by_id).subquery()
+
+    patients = func.coalesce(encounters.c.patients, 0)
+    encounter_count = func.coalesce(encounters.c.encounters, 0)
+    attendance_count = func.coalesce(attendances.c.attendances, 0)
+    amount = (
+        literal(app.config['ALLOWANCE_BASE'])
+        + patients * app.config['ALLOWANCE_PER_PATIENT']
+        + encounter_count * app.config['ALLOWANCE_PER_ENCOUNTER']
+        + attendance_count * app.config['ALLOWANCE_PER_ATTENDANCE']
+    )
+    query = select(
+        User.id,
+        (User.first_name + ' ' + User.last_name).label('name'),
+        User.phone_number,
+        patients.label('patients'),
+        encounter_count.label('encounters'),
+        attendance_count.label('attendances'),
+        amount.label('amount')
+    ).outerjoin(encounters, encounters.c.user_id == User.id).outerjoin(
+        attendances, attendances.c.user_id == User.id
+    ).where(User.role == 'chw', User.is_active.is_(True))
+    if county:
+        query = query.where(User.county == county)
+    return db.session.execute(query.order_by(User.id)).all()
+
+def create_batch(period_start, period_end, county=None, created_by_id=None):
+    """Create a draft payout batch with one pending Payment per payable CHW
+
+    CHWs without a phone number cannot receive M-Pesa payouts and are
+    skipped. Returns (batch, skipped user ids).
+    """
+    existing = PayoutBatch.query.filter(
+        PayoutBatch.period_start == period_start,
+        PayoutBatch.period_end == period_end,
+        PayoutBatch.county.is_(None) if county is None else PayoutBatch.county == county,
+        PayoutBatch.status != 'failed'
+    ).first()
+    if existing:
+        raise ValueError(f'Payout batch {existing.id} already covers this period')
+
+    allowances = compute_allowances(period_start, period_end, county)
+    payable = [row for row in allowances if row.phone_number and row.amount > 0]
+    skipped = [row.id for row in allowances if not row.phone_number]
+
+    # Reserved before the batch row is written: on SQLite the sequence
+    # update would otherwise wait on this session's write lock
+    references = payment_references(len(payable))
+    batch = PayoutBatch(
+        period_start=period_start,
+        period_end=period_end,
+        county=county,
+        payment_count=len(payable),
+        total_amount=sum(row.amount for row in payable),
+        created_by_id=created_by_id
+    )
+    db.session.add(batch)
+    db.session.flush()
+
+    now = datetime.utcnow()
+    if payable:
+        db.session.execute(insert(Payment), [{
+            'payment_reference': reference,
+            'amount': row.amount,
+            'currency': 'KES',
+            'payment_type': 'chw_allowance',
+            'description': (f'CHW allowance {period_start:%Y-%m-%d} to {period_end:%Y-%m-%d}: '
+                            f'{row.patients} patients, {row.encounters} encounters, '
+                            f'{row.attendances} attendances'),
+            'paid_by_id': created_by_id,
+            'received_by_id': row.id,
+            'phone_number': row.phone_number,
+            'payment_method': 'mpesa',
+            'status': 'pending',
+            'batch_id': batch.id,
+            'created_at': now
+        } for reference, row in zip(references, payable)])
+    db.session.commit()
+
+    log_audit('payout_batch_created', 'payout_batch', batch.id,
+             f'{batch.payment_count} CHW allowances totalling KES {batch.total_amount:,.2f} '
+             f'for {period_start} to {period_end} ({len(skipped)} skipped without phone number)')
+    return batch, skipped
+
+class RateLimiter:
+    """Thread-safe token bucket: at most ``rate`` acquisitions per second"""
+
+    def __init__(self, rate, burst=1):
+        self.rate = rate
+        self.capacity = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self._lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                wait = (1 - self.tokens) / self.rate
+            time.sleep(wait)
+
+class PayoutRejected(Exception):
+    """The provider refused a payout request outright, so nothing was sent"""
+
+class IntaSendPayoutClient:
+    """IntaSend send-money (M-Pesa B2C) bulk payout API"""
+
+    def __init__(self, base_url=None, api_secret=None):
+        self.base_url = base_url or os.environ.get('INTASEND_BASE_URL', 'https://sandbox.intasend.com/api/v1/')
+        self.api_secret = api_secret or os.environ.get('INTASEND_API_SECRET', 'ISSecKey_test_placeholder')
+        # Imported here so workers that never take payments skip loading it
+        import requests
+        self.session = requests.Session()
+        self.session.headers['Authorization'] = f'Bearer {self.api_secret}'
+
+    def _post(self, path, payload):
+        response = self.session.post(f'{self.base_url}{path}', json=payload, timeout=60)
+        # A 4xx other than timeout/throttling means the request was refused;
+        # anything else (5xx, timeouts, dropped connections) leaves the
+        # outcome unknown and propagates as is
+        if 400 <= response.status_code < 500 and response.status_code not in (408, 429):
+            raise PayoutRejected(f'{response.status_code}: {response.text[:200]}')
+        response.raise_for_status()
+        return response.json()
+
+    def send(self, transactions):
+        """Submit one payout request; returns {idempotency_key: transaction id}"""
+        data = self._post('send-money/initiate/',
+                          {'provider': 'MPESA-B2C', 'currency': 'KES', 'transactions': transactions})
+        return {t['idempotency_key']: t['transaction_id'] for t in data['transactions']}
+
+    def lookup(self, idempotency_keys):
+        """Transaction ids for keys the provider has accepted; unknown keys are omitted"""
+        data = self._post('send-money/status/', {'idempotency_keys': list(idempotency_keys)})
+        return {t['idempotency_key']: t['transaction_id'] for t in data['transactions']}
+
+class StubPayoutClient:
+    """Local stand-in for IntaSend that records calls, for development and load tests
+
+    ``failure_rate`` requests are rejected; ``timeout_rate`` requests are
+    accepted but the reply is lost, as with a timeout after the provider
+    has queued the payouts.
+    """
+
+    def __init__(self, latency=0.05, failure_rate=0.0, timeout_rate=0.0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.timeout_rate = timeout_rate
+        self.calls = []
+        self.transactions = {}  # idempotency key -> transaction id
+        self._lock = threading.Lock()
+
+    def send(self, transactions):
+        time.sleep(self.latency)
+        if random.random() < self.failure_rate:
+            raise PayoutRejected('Stub payout rejected')
+        with self._lock:
+            accepted = {t['idempotency_key']: self.transactions.setdefault(
+                t['idempotency_key'], f'STUB-{uuid.uuid4().hex[:12].upper()}') for t in transactions}
+            self.calls.append((len(transactions), time.monotonic()))
+        if random.random() < self.timeout_rate:
+            raise TimeoutError('Stub payout reply lost')
+        return accepted
+
+    def lookup(self, idempotency_keys):
+        with self._lock:
+            return {key: self.transactions[key] for key in idempotency_keys if key in self.transactions}
+
+def get_payout_client():
+    if app.config.get('PAYOUTS_STUB'):
+        return StubPayoutClient()
+    return IntaSendPayoutClient()
+
+def _unsubmitted_payments(batch_id):
+    """Pending payments in the batch that have not reached the provider yet"""
+    return db.session.execute(
+        select(Payment.id, Payment.payment_reference, Payment.amount, Payment.phone_number,
+               User.first_name, User.last_name)
+        .join(User, User.id == Payment.received_by_id)
+        .where(Payment.batch_id == batch_id, Payment.status == 'pending',
+               Payment.intasend_ref.is_(None), Payment.intasend_status.is_(None))
+        .order_by(Payment.id)
+    ).all()
+
+def _mark_submitted(batch, accepted):
+    """Store the provider's transaction id on each accepted payment"""
+    if accepted:
+        db.session.execute(
+            update(Payment.__table__).where(Payment.__table__.c.payment_reference == bindparam('reference')),
+            [{'reference': reference, 'intasend_ref': transaction_id, 'intasend_status': 'submitted'}
+             for reference, transaction_id in accepted.items()]
+        )
+        batch.submitted_count += len(accepted)
+
+def resolve_unknown(batch, client):
+    """Settle payments whose submission outcome was lost
+
+    The provider is asked which of them it accepted; those get their
+    transaction id and the rest are cleared for resending. Their
+    idempotency keys make a resend of an accepted payment a no-op, but the
+    lookup keeps the batch from relying on that alone. Returns how many
+    are still unknown because the lookup itself failed.
+    """
+    references = db.session.execute(
+        select(Payment.payment_reference)
+        .where(Payment.batch_id == batch.id, Payment.status == 'pending', Payment.intasend_status == 'unknown')
+    ).scalars().all()
+    if not references:
+        return 0
+    try:
+        accepted = client.lookup(references)
+    except Exception as e:
+        logger.warning('Payout status lookup for batch %s failed: %s', batch.id, e)
+        batch.last_error = str(e)
+        db.session.commit()
+        return len(references)
+
+    _mark_submitted(batch, {reference: accepted[reference] for reference in references if reference in accepted})
+    missing = [reference for reference in references if reference not in accepted]
+    if missing:
+        db.session.execute(
+            update(Payment).where(Payment.payment_reference.in_(missing)).values(intasend_status=None)
+        )
+    db.session.commit()
+    return 0
+
+def submit_batch(batch_id, client=None, chunk_size=None, concurrency=None, rate_limit=None):
+    """Send a batch's payments to the provider in chunks
+
+    HTTP calls run on a bounded thread pool behind a shared rate limiter;
+    results are written from this thread as each chunk completes, so
+    progress is visible while the batch is submitting. Every payment
+    carries its payment reference as the provider idempotency key.
+
+    Only an explicit rejection fails a chunk. A timeout or transport error
+    may have happened after the provider queued the payouts, so those
+    payments are marked ``unknown`` and settled by a status lookup at the
+    start of the next run. Safe to re-run: only payments the provider has
+    not accepted are sent.
+    """
+    batch = db.session.get(PayoutBatch, batch_id)
+    if batch is None:
+        raise LookupError(f'Payout batch {batch_id} not found')
+
+    client = client or get_payout_client()
+    chunk_size = chunk_size or app.config['PAYOUT_CHUNK_SIZE']
+    limiter = RateLimiter(rate_limit or app.config['PAYOUT_RATE_LIMIT'])
+
+    batch.status = 'submitting'
+    batch.submitted_at = batch.submitted_at or datetime.utcnow()
+    db.session.commit()
+
+    unresolved = resolve_unknown(batch, client)
+    payments = _unsubmitted_payments(batch_id)
+    chunks = [payments[start:start + chunk_size] for start in range(0, len(payments), chunk_size)]
+
+    def send(chunk):
+        limiter.acquire()
+        return client.send([{
+            'name': f'{p.first_name} {p.last_name}',
+            'account': p.phone_number,
+            'amount': p.amount,
+            'narrative': p.payment_reference,
+            'idempotency_key': p.payment_reference
+        } for p in chunk])
+
+    with ThreadPoolExecutor(max_workers=concurrency or app.config['PAYOUT_CONCURRENCY']) as pool:
+        futures = {pool.submit(send, chunk): chunk for chunk in chunks}
+        for future in as_completed(futures):
+            ids = [p.id for p in futures[future]]
+            try:
+                accepted = future.result()
+            except PayoutRejected as e:
+                logger.warning('Payout chunk for batch %s rejected: %s', batch_id, e)
+                db.session.execute(
+                    update(Payment).where(Payment.id.in_(ids)).values(status='failed', intasend_status='rejected')
+                )
+                batch.failed_count += len(ids)
+                batch.last_error = str(e)
+            except Exception as e:
+                logger.warning('Payout chunk for batch %s has an unknown outcome: %s', batch_id, e)
+                db.session.execute(
+                    update(Payment).where(Payment.id.in_(ids)).values(intasend_status='unknown')
+                )
+                unresolved += len(ids)
+                batch.last_error = str(e)
+            else:
+                _mark_submitted(batch, accepted)
+            db.session.commit()
+
+    # A batch only counts as failed when nothing in it can have been paid;
+    # create_batch allows a failed period to be paid again
+    if unresolved:
+        batch.status = 'submitting'
+    elif batch.failed_count and not batch.submitted_count:
+        batch.status = 'failed'
+    else:
+        batch.status = 'submitted'
+    batch.finished_at = None if unresolved else datetime.utcnow()
+    db.session.commit()
+
+    log_audit('payout_batch_submitted', 'payout_batch', batch.id,
+             f'{batch.submitted_count} payouts submitted, {batch.failed_count} failed, {unresolved} unknown')
+    progress = batch_progress(batch)
+    progress['unknown'] = unresolved
+    return progress
+
+def batch_status_counts_query(batch_id):
+    return select(Payment.status, func.count(Payment.id)).where(Payment.batch_id == batch_id).group_by(Payment.status)
+
+def batch_progress(batch, statuses=None):
+    """Progress counts for a batch, including provider-confirmed payments"""
+    if statuses is None:
+        statuses = dict(db.session.execute(batch_status_counts_query(batch.id)).all())
+    return {
+        'id': batch.id,
+        'status': batch.status,
+        'period_start': batch.period_start.isoformat(),
+        'period_end': batch.period_end.isoformat(),
+        'county': batch.county,
+        'payment_count': batch.payment_count,
+        'total_amount': batch.total_amount,
+        'submitted': batch.submitted_count,
+        'failed': batch.failed_count,
+        'payments_by_status': statuses,
+        'last_error': batch.last_error,
+        'created_at': batch.created_at.isoformat() if batch.created_at else None,
+        'submitted_at': batch.submitted_at.isoformat() if batch.submitted_at else None,
+        'finished_at': batch.finished_at.isoformat() if batch.finished_at else None
+    }
+
+@job('payouts.submit_batch', max_attempts=3)
+def submit_batch_job(batch_id):
+    """Submit a payout batch from the worker
+
+    Raises while any outcome is unknown, so the job's retry backoff
+    schedules the status lookup; batches still unknown once the retries
+    run out are picked up by resume_submitting_job.
+    """
+    progress = submit_batch(batch_id)
+    if progress['unknown']:
+        raise RuntimeError(f'{progress["unknown"]} payouts in batch {batch_id} have an unknown outcome')
+    return progress
+
+def stalled_batch_ids():
+    """Batches left submitting with no submission job queued or running"""
+    active = {json.loads(payload or '{}').get('batch_id') for payload in db.session.execute(
+        select(Job.payload).where(Job.name == 'payouts.submit_batch', Job.status.in_(['queued', 'running']))
+    ).scalars()}
+    return [batch_id for batch_id in db.session.execute(
+        select(PayoutBatch.id).where(PayoutBatch.status == 'submitting').order_by(PayoutBatch.id)
+    ).scalars() if batch_id not in active]
+
+@job('payouts.resume_submitting', max_attempts=1, every=900)
+def resume_submitting_job():
+    """Resubmit batches whose submission job gave up with outcomes still unknown"""
+    resumed = {}
+    for batch_id in stalled_batch_ids():
+        progress = submit_batch(batch_id)
+        resumed[batch_id] = progress['unknown']
+        if progress['unknown']:
+            logger.warning('Payout batch %s still has %s unknown outcomes', batch_id, progress['unknown'])
+    return resumed
+
+@app.cli.group('payouts')
+def payouts_cli():
+    """CHW allowance payout commands"""
+
+@payouts_cli.command('create')
+@click.option('--start', 'period_start', required=True, type=click.DateTime(['%Y-%m-%d']))
+@click.option('--end', 'period_end', required=True, type=click.DateTime(['%Y-%m-%d']))
+@click.option('--county', help='Only pay CHWs in this county.')
+@click.option('--submit/--no-submit', default=False, help='Queue the batch for submission.')
+def create_command(period_start, period_end, county, submit):
+    """Compute allowances and create a payout batch"""
+    try:
+        batch, skipped = create_batch(period_start.date(), period_end.date(), county)
+    except ValueError as e:
+        raise click.ClickException(str(e))
+    click.echo(f'Created batch {batch.id}: {batch.payment_count} payments, KES {batch.total_amount:,.2f}'
+               + (f', {len(skipped)} CHWs skipped without phone number' if skipped else ''))
+    if submit:
+        enqueue('payouts.submit_batch', batch_id=batch.id)
+        click.echo('Queued for submission')
+
+@payouts_cli.command('status')
+@click.argument('batch_id', type=int)
+def status_command(batch_id):
+    """Show a payout batch's progress"""
+    batch = db.session.get(PayoutBatch, batch_id)
+    if batch is None:
+        raise click.ClickException(f'Payout batch {batch_id} not found')
+    click.echo(json.dumps(batch_progress(batch), indent=2))
+
+@payouts_cli.command('submit')
+@click.argument('batch_id', type=int)
+def submit_command(batch_id):
+    """Submit or resume a payout batch in this process"""
+    try:
+        progress = submit_batch(batch_id)
+    except LookupError as e:
+        raise click.ClickException(str(e))
+    click.echo(json.dumps(progress, indent=2))
@@ -0,0 +1,87 @@
+from enum import IntFlag
+from flask import g, flash, redirect, url_for, jsonify, abort
+from flask_login import current_user
+from sqlalchemy import select, exists, true, false
+from app import db
+from models import Patient, Payment, OutreachEvent
+
+class Permission(IntFlag):
+    VIEW_ALL_PATIENTS = 1
+    VIEW_ASSIGNED_PATIENTS = 2
+    MANAGE_PATIENTS = 4
+    VIEW_ALL_EVENTS = 8
+    VIEW_ALL_PAYMENTS = 16
+    ADMIN = 32
+
+ROLE_PERMISSIONS = {
+    'admin': Permission(sum(Permission)),
+    'doctor': Permission.VIEW_ALL_PATIENTS | Permission.MANAGE_PATIENTS | Permission.VIEW_ALL_EVENTS,
+    'chw': Permission.VIEW_ASSIGNED_PATIENTS | Permission.MANAGE_PATIENTS,
+}
+
+NO_PERMISSIONS = Permission(0)
+
+def permissions():
+    """The current user's permission bits, resolved once per request"""
+    resolved = g.get('permissions')
+    if resolved is None:
+        if current_user.is_authenticated and current_user.is_active:
+            resolved = role_permissions(current_user.role)
+        else:
+            resolved = NO_PERMISSIONS
+        g.permissions = resolved
+    return resolved
+
+def can(permission):
+    return permission in permissions()
+
+def role_permissions(role):
+    return ROLE_PERMISSIONS.get(role, NO_PERMISSIONS)
+
+def patient_scope(granted, user_id):
+    """WHERE clause for patients visible with the given permissions (no request context needed)"""
+    if Permission.VIEW_ALL_PATIENTS in granted:
+        return true()
+    if Permission.VIEW_ASSIGNED_PATIENTS in granted:
+        return Patient.assigned_chw_id == user_id
+    return false()
+
+def payment_scope(granted, user_id):
+    if Permission.VIEW_ALL_PAYMENTS in granted:
+        return true()
+    return (Payment.paid_by_id == user_id) | (Payment.received_by_id == user_id)
+
+def patient_filter():
+    """WHERE clause limiting patients to those the current user may see"""
+    return patient_scope(permissions(), current_user.id if current_user.is_authenticated else None)
+
+def payment_filter():
+    """WHERE clause limiting payments to those the current user may see"""
+    return payment_scope(permissions(), current_user.id if current_user.is_authenticated else None)
+
+def event_filter():
+    """WHERE clause limiting outreach events to those the current user may see"""
+    if can(Permission.VIEW_ALL_EVENTS):
+        return true()
+    return OutreachEvent.organizer_id == current_user.id
+
+def can_access_patient(patient_id):
+    """EXISTS check against the caller's scope, answered from the (assigned_chw_id, id) index"""
+    return db.session.execute(
+        select(exists().where(Patient.id == patient_id, patient_filter()))
+    ).scalar()
+
+def deny_patient_access(patient_id, api=False):
+    """Return the response for a patient the caller may not open, or None if allowed
+
+    Call at the top of a view, before loading the patient.
+    """
+    if can_access_patient(patient_id):
+        return None
+    # Only the failure path pays for telling "missing" from "forbidden"
+    if not db.session.execute(select(exists().where(Patient.id == patient_id))).scalar():
+        abort(404)
+    if api:
+        return jsonify({'error': 'Access denied'}), 403
+    flash('Access denied.', 'error')
+    return redirect(url_for('patients'))
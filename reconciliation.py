@@ -0,0 +1,327 @@
+import os
+import csv
+import json
+import logging
+from itertools import islice
+from datetime import datetime, timedelta
+import click
+from sqlalchemy import select, update, or_, bindparam
+from app import app, db
+from models import Payment
+from utils import log_audit
+from jobs import job
+
+logger = logging.getLogger(__name__)
+
+STATEMENT_CHUNK_SIZE = 5000
+UPDATE_CHUNK_SIZE = 5000
+
+# Provider statement states -> Payment.status; anything else is still in flight
+STATUS_MAP = {
+    'complete': 'completed',
+    'completed': 'completed',
+    'successful': 'completed',
+    'failed': 'failed',
+    'cancelled': 'failed',
+    'canceled': 'failed',
+    'rejected': 'failed',
+}
+
+# Accepted column names in provider exports
+REFERENCE_FIELDS = ('api_ref', 'payment_reference', 'reference', 'narrative')
+PROVIDER_REF_FIELDS = ('invoice_id', 'tracking_id', 'intasend_ref', 'transaction_id')
+STATE_FIELDS = ('state', 'status')
+AMOUNT_FIELDS = ('value', 'amount')
+
+REPORT_FIELDS = ['kind', 'payment_id', 'payment_reference', 'provider_ref',
+                 'local_status', 'statement_status', 'local_amount', 'statement_amount', 'detail']
+
+def _pick(record, fields):
+    for field in fields:
+        value = record.get(field)
+        if value not in (None, ''):
+            return str(value).strip()
+    return None
+
+def _json_records(fh, chunk_size=1 << 16):
+    """Objects from a JSON-array export or NDJSON, without loading the file
+
+    Array elements are decoded one at a time from a sliding buffer. Invalid
+    NDJSON lines are yielded as the ValueError that rejected them, so one
+    bad line does not end the run; a malformed array cannot be resynced and
+    raises.
+    """
+    first = fh.read(1)
+    while first.isspace():
+        first = fh.read(1)
+    if first != '[':
+        yield _json_line(first + fh.readline())
+        for line in fh:
+            yield _json_line(line)
+        return
+
+    decoder = json.JSONDecoder()
+    buffer = fh.read(chunk_size)
+    position, eof = 0, False
+    while True:
+        while position < len(buffer) and buffer[position] in ' \t\r\n,':
+            position += 1
+        if position < len(buffer) and buffer[position] == ']':
+            return
+        try:
+            record, end = decoder.raw_decode(buffer, position)
+        except ValueError:
+            if eof:
+                raise ValueError('Malformed JSON array in statement')
+            chunk = fh.read(chunk_size)
+            eof = not chunk
+            buffer = buffer[position:] + chunk
+            position = 0
+            continue
+        # A number or literal cut off at the chunk boundary decodes short
+        if end == len(buffer) and not eof:
+            chunk = fh.read(chunk_size)
+            if chunk:
+                buffer, position = buffer[position:] + chunk, 0
+                continue
+            eof = True
+        yield record
+        position = end
+
+def _json_line(line):
+    if not line.strip():
+        return None
+    try:
+        return json.loads(line)
+    except ValueError as e:
+        return e
+
+def _parse_amount(value):
+    """Statement amount as a float; raises ValueError for anything else"""
+    if value is None:
+        return None
+    amount = float(value)
+    if amount != amount or amount in (float('inf'), float('-inf')):
+        raise ValueError(f'not a finite amount: {value}')
+    return amount
+
+def read_statement(path, fmt=None):
+    """Stream a provider statement as (reference, provider_ref, state, amount, error) tuples
+
+    CSV files need a header row; JSON exports may be one array or one
+    object per line. Lines that cannot be read come back with ``error``
+    set and whatever fields could be picked out, instead of raising.
+    """
+    fmt = fmt or ('csv' if path.lower().endswith('.csv') else 'json')
+    with open(path, newline='', encoding='utf-8') as fh:
+        records = csv.DictReader(fh) if fmt == 'csv' else _json_records(fh)
+        for number, record in enumerate(records, start=1):
+            if record is None:
+                continue
+            if not isinstance(record, dict):
+                error = record if isinstance(record, ValueError) else f'expected an object, got {type(record).__name__}'
+                yield None, None, None, None, f'line {number}: {error}'
+                continue
+            reference = _pick(record, REFERENCE_FIELDS)
+            provider_ref = _pick(record, PROVIDER_REF_FIELDS)
+            state = (_pick(record, STATE_FIELDS) or '').lower()
+            raw_amount = _pick(record, AMOUNT_FIELDS)
+            try:
+                amount = _parse_amount(raw_amount)
+            except ValueError:
+                yield reference, provider_ref, state, raw_amount, f'line {number}: unparseable amount'
+                continue
+            yield reference, provider_ref, state, amount, None
+
+def load_candidates(references, provider_refs, since):
+    """Hash tables of the pending and recent payments one statement chunk refers to
+
+    Our references are unique, so ``by_reference`` maps to one entry.
+    Provider references map to a list: payouts submitted before
+    per-transaction ids were stored share their request's tracking id.
+    Only the chunk's own references are looked up, so memory follows the
+    chunk size rather than the payments table.
+    """
+    references, provider_refs = list(references), list(provider_refs)
+    by_reference, by_provider_ref = {}, {}
+    if not references and not provider_refs:
+        return by_reference, by_provider_ref
+    rows = db.session.execute(
+        select(Payment.id, Payment.payment_reference, Payment.intasend_ref,
+               Payment.intasend_checkout_id, Payment.status, Payment.amount)
+        .where(or_(Payment.payment_reference.in_(references),
+                   Payment.intasend_ref.in_(provider_refs),
+                   Payment.intasend_checkout_id.in_(provider_refs)),
+               or_(Payment.status == 'pending', Payment.created_at >= since))
+    ).all()
+    for payment_id, reference, intasend_ref, checkout_id, status, amount in rows:
+        entry = (payment_id, reference, status, amount)
+        by_reference[reference] = entry
+        for provider_ref in {intasend_ref, checkout_id}:
+            if provider_ref:
+                by_provider_ref.setdefault(provider_ref, []).append(entry)
+    return by_reference, by_provider_ref
+
+def pending_payments():
+    """(id, reference, status, amount) of every pending payment, keyset-paged"""
+    last_id = 0
+    while True:
+        rows = db.session.execute(
+            select(Payment.id, Payment.payment_reference, Payment.status, Payment.amount)
+            .where(Payment.id > last_id, Payment.status == 'pending')
+            .order_by(Payment.id)
+            .limit(STATEMENT_CHUNK_SIZE)
+        ).all()
+        if not rows:
+            return
+        yield from rows
+        last_id = rows[-1][0]
+
+def match_provider_ref(entries, amount, seen):
+    """The one payment a provider reference can mean, or None if it is ambiguous
+
+    Several payments sharing a reference are narrowed down to those not
+    matched yet whose amount agrees with the statement line.
+    """
+    if len(entries) == 1:
+        return entries[0]
+    entries = [entry for entry in entries if entry[0] not in seen
+               and amount is not None and entry[3] is not None and abs(amount - entry[3]) < 0.01]
+    return entries[0] if len(entries) == 1 else None
+
+class _BulkUpdater:
+    """Buffers status corrections and applies them as executemany UPDATEs by primary key
+
+    Each UPDATE only touches payments that are still pending, so a webhook
+    or another reconciliation settling one since the candidates were loaded
+    is not overwritten; ``applied`` counts the rows actually changed.
+    """
+
+    def __init__(self):
+        self.pending = []
+        self.applied = 0
+
+    def add(self, payment_id, status, provider_state):
+        row = {'payment_id': payment_id, 'status': status, 'intasend_status': provider_state}
+        if status == 'completed':
+            row['completed_at'] = datetime.utcnow()
+        self.pending.append(row)
+        if len(self.pending) >= UPDATE_CHUNK_SIZE:
+            self.flush()
+
+    def flush(self):
+        table = Payment.__table__
+        statement = update(table).where(table.c.id == bindparam('payment_id'), table.c.status == 'pending')
+        # Rows must share a key set to batch into one executemany
+        for keys in ({'payment_id', 'status', 'intasend_status', 'completed_at'},
+                     {'payment_id', 'status', 'intasend_status'}):
+            rows = [row for row in self.pending if row.keys() == keys]
+            if rows:
+                self.applied += db.session.execute(statement, rows).rowcount
+        db.session.commit()
+        self.pending = []
+
+def reconcile(path, fmt=None, window_days=30, report_path=None):
+    """Match a provider statement against pending/recent payments and fix statuses
+
+    Pending payments the provider settled are marked completed or failed.
+    Anything else that disagrees (amounts, settled payments the provider
+    failed, references we do not know, pending payments missing from the
+    statement, lines that cannot be parsed) is written to a CSV discrepancy
+    report for review.
+
+    The statement is read in chunks of STATEMENT_CHUNK_SIZE lines, each
+    joined against just the payments it references; only the ids of
+    matched payments are kept across chunks.
+    """
+    started = datetime.utcnow()
+    since = started - timedelta(days=window_days)
+
+    report_dir = app.config['RECONCILIATION_DIR']
+    os.makedirs(report_dir, exist_ok=True)
+    report_path = report_path or os.path.join(report_dir, f'discrepancies-{started:%Y%m%d%H%M%S}.csv')
+
+    updater = _BulkUpdater()
+    seen = set()
+    counts = {'lines': 0, 'matched': 0, 'discrepancies': 0}
+
+    with open(report_path, 'w', newline='') as report_fh:
+        writer = csv.writer(report_fh)
+        writer.writerow(REPORT_FIELDS)
+
+        def discrepancy(kind, entry, provider_ref, state, amount, detail=None):
+            counts['discrepancies'] += 1
+            counts[kind] = counts.get(kind, 0) + 1
+            payment_id, reference, status, local_amount = entry or (None, None, None, None)
+            writer.writerow([kind, payment_id, reference, provider_ref, status, state, local_amount, amount, detail])
+
+        lines = read_statement(path, fmt)
+        while True:
+            chunk = list(islice(lines, STATEMENT_CHUNK_SIZE))
+            if not chunk:
+                break
+            by_reference, by_provider_ref = load_candidates(
+                {line[0] for line in chunk if line[0] and not line[4]},
+                {line[1] for line in chunk if line[1] and not line[4]},
+                since
+            )
+            for reference, provider_ref, state, amount, error in chunk:
+                counts['lines'] += 1
+                if error:
+                    discrepancy('bad_line', (None, reference, None, None), provider_ref, state, amount, error)
+                    continue
+                entry = by_reference.get(reference)
+                if entry is None and provider_ref in by_provider_ref:
+                    entry = match_provider_ref(by_provider_ref[provider_ref], amount, seen)
+                    if entry is None:
+                        discrepancy('ambiguous_provider_ref', (None, reference, None, None), provider_ref, state, amount)
+                        continue
+                if entry is None:
+                    discrepancy('unknown_reference', (None, reference, None, None), provider_ref, state, amount)
+                    continue
+
+                counts['matched'] += 1
+                payment_id, _, status, local_amount = entry
+                seen.add(payment_id)
+                target = STATUS_MAP.get(state)
+
+                if amount is not None and local_amount is not None and abs(amount - local_amount) >= 0.01:
+                    discrepancy('amount_mismatch', entry, provider_ref, state, amount)
+                elif target is None or target == status:
+                    continue
+                elif status == 'pending':
+                    updater.add(payment_id, target, state)
+                else:
+                    discrepancy('status_conflict', entry, provider_ref, state, amount)
+
+        updater.flush()
+
+        # Payments that never reached the provider stay pending forever otherwise
+        for entry in pending_payments():
+            if entry[0] not in seen:
+                discrepancy('missing_from_statement', tuple(entry), None, None, None)
+
+    result = dict(counts, updated=updater.applied, report=report_path,
+                  seconds=round((datetime.utcnow() - started).total_seconds(), 2))
+    log_audit('payments_reconciled', 'payment', None,
+             f"Reconciled {result['lines']} statement lines: {result['updated']} payments updated, "
+             f"{result['discrepancies']} discrepancies ({os.path.basename(report_path)})")
+    return result
+
+@job('payments.reconcile', max_attempts=2)
+def reconcile_job(path, fmt=None, window_days=30):
+    """Reconcile an uploaded statement from the worker"""
+    return reconcile(path, fmt=fmt, window_days=window_days)
+
+@app.cli.group('payments')
+def payments_cli():
+    """Payment commands"""
+
+@payments_cli.command('reconcile')
+@click.argument('path', type=click.Path(exists=True, dir_okay=False))
+@click.option('--format', 'fmt', type=click.Choice(['csv', 'json', 'ndjson']), help='Defaults to the file extension.')
+@click.option('--window-days', default=30, show_default=True, help='Also match settled payments this recent.')
+@click.option('--report', type=click.Path(), help='Discrepancy report path.')
+def reconcile_command(path, fmt, window_days, report):
+    """Reconcile payments against a provider statement export"""
+    click.echo(json.dumps(reconcile(path, fmt, window_days, report), indent=2))
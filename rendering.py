@@ -0,0 +1,189 @@
+import os
+import gzip
+import json
+import time
+import shutil
+import hashlib
+import logging
+import mimetypes
+import threading
+import click
+from flask import url_for, request, send_from_directory, before_render_template, template_rendered
+from jinja2 import FileSystemBytecodeCache, nodes
+from jinja2.ext import Extension
+from app import app
+from cache import cache
+from utils import BMI_CATEGORIES
+
+try:
+    import brotli
+except ImportError:  # Optional: gzip is always produced
+    brotli = None
+
+logger = logging.getLogger(__name__)
+
+DIST_DIR = 'dist'
+MANIFEST_NAME = 'manifest.json'
+COMPRESSIBLE = {'.css', '.js', '.svg', '.json', '.txt', '.html', '.map'}
+
+class FragmentCacheExtension(Extension):
+    """``{% cache key, ... %}...{% endcache %}`` caches a rendered block
+
+    Keys must include everything the block depends on (user, role, ...).
+    Never cache blocks containing CSRF tokens or flashed messages.
+    """
+    tags = {'cache'}
+    ttl = 300
+
+    def __init__(self, environment):
+        super().__init__(environment)
+        environment.extend(fragment_cache=cache)
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        key_parts = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            key_parts.append(parser.parse_expression())
+        body = parser.parse_statements(['name:endcache'], drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_cache_support', [nodes.List(key_parts)]), [], [], body
+        ).set_lineno(lineno)
+
+    def _cache_support(self, key_parts, caller):
+        key = 'fragment:' + '|'.join(str(part) for part in key_parts)
+        return self.environment.fragment_cache.get_or_set(key, caller, ttl=self.ttl, tags=['fragments'])
+
+# Asset manifest: original path -> fingerprinted path under static/dist
+_manifest = None
+
+def load_manifest():
+    global _manifest
+    if _manifest is None:
+        path = os.path.join(app.static_folder, DIST_DIR, MANIFEST_NAME)
+        try:
+            with open(path) as fh:
+                _manifest = json.load(fh)
+        except (OSError, ValueError):
+            _manifest = {}
+    return _manifest
+
+def asset_url(filename):
+    """URL for a static asset, fingerprinted when a build exists"""
+    hashed = load_manifest().get(filename)
+    if hashed:
+        return url_for('static', filename=f'{DIST_DIR}/{hashed}')
+    return url_for('static', filename=filename)
+
+def build_assets():
+    """Copy static files to static/dist with content hashes and precompress them"""
+    static_root = app.static_folder
+    dist_root = os.path.join(static_root, DIST_DIR)
+    shutil.rmtree(dist_root, ignore_errors=True)
+    os.makedirs(dist_root)
+
+    manifest = {}
+    for root, dirs, files in os.walk(static_root):
+        if os.path.abspath(root).startswith(os.path.abspath(dist_root)):
+            continue
+        for name in sorted(files):
+            source = os.path.join(root, name)
+            relative = os.path.relpath(source, static_root).replace(os.sep, '/')
+            with open(source, 'rb') as fh:
+                content = fh.read()
+
+            digest = hashlib.sha256(content).hexdigest()[:12]
+            stem, ext = os.path.splitext(relative)
+            hashed = f'{stem}.{digest}{ext}'
+            target = os.path.join(dist_root, hashed)
+            os.makedirs(os.path.dirname(target), exist_ok=True)
+            with open(target, 'wb') as fh:
+                fh.write(content)
+
+            if ext in COMPRESSIBLE:
+                with open(target + '.gz', 'wb') as fh:
+                    fh.write(gzip.compress(content, compresslevel=9, mtime=0))
+                if brotli is not None:
+                    with open(target + '.br', 'wb') as fh:
+                        fh.write(brotli.compress(content, quality=11))
+            manifest[relative] = hashed
+
+    with open(os.path.join(dist_root, MANIFEST_NAME), 'w') as fh:
+        json.dump(manifest, fh, indent=2, sort_keys=True)
+
+    global _manifest
+    _manifest = manifest
+    return manifest
+
+def compile_templates():
+    """Compile every template into the bytecode cache; returns ms per template"""
+    timings = {}
+    env = app.jinja_env
+    for name in env.list_templates(filter_func=lambda n: n.endswith('.html')):
+        started = time.perf_counter()
+        env.get_template(name)
+        timings[name] = (time.perf_counter() - started) * 1000
+    return timings
+
+def serve_static(filename):
+    """Static files; fingerprinted assets get precompressed bodies and long caching"""
+    if not filename.startswith(f'{DIST_DIR}/'):
+        return app.send_static_file(filename)
+
+    directory = app.static_folder
+    accepted = request.headers.get('Accept-Encoding', '')
+    for encoding, suffix in (('br', '.br'), ('gzip', '.gz')):
+        if encoding in accepted and os.path.isfile(os.path.join(directory, filename + suffix)):
+            response = send_from_directory(directory, filename + suffix, max_age=31536000)
+            response.headers['Content-Encoding'] = encoding
+            response.mimetype = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+            break
+    else:
+        response = send_from_directory(directory, filename, max_age=31536000)
+
+    response.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    response.vary.add('Accept-Encoding')
+    return response
+
+# Time of each template's first render in this worker (cold caches)
+render_timings = {}
+_render_started = threading.local()
+
+def _on_before_render(sender, template, context, **extra):
+    if template.name not in render_timings:
+        _render_started.value = (template.name, time.perf_counter())
+
+def _on_rendered(sender, template, context, **extra):
+    started = getattr(_render_started, 'value', None)
+    if started and started[0] == template.name and template.name not in render_timings:
+        render_timings[template.name] = (time.perf_counter() - started[1]) * 1000
+        logger.info('First render of %s took %.1fms', template.name, render_timings[template.name])
+    _render_started.value = None
+
+def init_app(app):
+    cache_dir = app.config['TEMPLATE_CACHE_DIR']
+    os.makedirs(cache_dir, exist_ok=True)
+    app.jinja_env.bytecode_cache = FileSystemBytecodeCache(cache_dir)
+    app.jinja_env.add_extension(FragmentCacheExtension)
+    app.jinja_env.globals['asset_url'] = asset_url
+    app.jinja_env.globals['bmi_categories'] = BMI_CATEGORIES
+    app.view_functions['static'] = serve_static
+    before_render_template.connect(_on_before_render, app)
+    template_rendered.connect(_on_rendered, app)
+
+init_app(app)
+
+@app.cli.group('assets')
+def assets_cli():
+    """Static asset and template build commands"""
+
+@assets_cli.command('build')
+def build_command():
+    """Fingerprint and precompress static files, and precompile templates"""
+    manifest = build_assets()
+    click.echo(f'Fingerprinted {len(manifest)} assets'
+               + ('' if brotli else ' (install brotli for .br files)'))
+
+    timings = compile_templates()
+    for name, ms in sorted(timings.items(), key=lambda item: -item[1]):
+        click.echo(f'{name:30} {ms:8.1f}ms')
+    click.echo(f'Compiled {len(timings)} templates in {sum(timings.values()):.1f}ms')
@@ -0,0 +1,236 @@
+import logging
+import operator
+import importlib
+import multiprocessing
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime, date
+import click
+from sqlalchemy import select, update, func, exists
+from sqlalchemy.orm import aliased
+from app import app, db
+from models import Patient, HealthRecord, RiskFlag
+from utils import calculate_bmi_bulk, bmi_upper_bound
+from jobs import job
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 5000
+SEVERITIES = ('critical', 'high', 'medium')
+
+Rule = namedtuple('Rule', 'name severity column op threshold message')
+
+# Declarative rules: each compares one column of a record batch to a threshold.
+# "bmi" and "days_overdue" are derived columns, see load_batch().
+RULES = [
+    Rule('hypertensive_crisis', 'critical', 'systolic', '>=', 180, 'Systolic BP {value:.0f} mmHg'),
+    Rule('high_fever', 'high', 'temperature', '>', 39, 'Temperature {value:.1f} °C'),
+    Rule('severe_underweight', 'high', 'bmi', '<', bmi_upper_bound('Severely Underweight'),
+         'BMI {value:.1f} (Severely Underweight)'),
+    Rule('missed_follow_up', 'medium', 'days_overdue', '>', 0, 'Follow-up overdue by {value:.0f} days'),
+]
+
+OPERATORS = {
+    '>': operator.gt, '>=': operator.ge, '<': operator.lt, '<=': operator.le, '==': operator.eq,
+}
+
+def compile_rules(rules=RULES):
+    """Turn rules into (rule, column, comparison) triples
+
+    The comparisons are the ``operator`` functions, which numpy applies
+    element-wise to a whole column; NaN (missing) never fires.
+    """
+    return [(rule, rule.column, OPERATORS[rule.op]) for rule in rules]
+
+COMPILED_RULES = compile_rules()
+
+def load_batch(record_ids=None, id_range=None, today=None):
+    """Load records as numpy columns for rule evaluation
+
+    ``days_overdue`` is positive when a follow-up date has passed with no
+    later encounter for the patient.
+    """
+    import numpy as np
+    
+    today = today or date.today()
+    later = aliased(HealthRecord)
+    has_later_visit = exists().where(
+        later.patient_id == HealthRecord.patient_id,
+        later.encounter_date > HealthRecord.encounter_date
+    )
+    query = select(
+        HealthRecord.id,
+        HealthRecord.patient_id,
+        HealthRecord.weight,
+        HealthRecord.height,
+        HealthRecord.temperature,
+        HealthRecord.blood_pressure_systolic,
+        HealthRecord.follow_up_date,
+        has_later_visit
+    )
+    if record_ids is not None:
+        query = query.where(HealthRecord.id.in_(record_ids))
+    if id_range is not None:
+        query = query.where(HealthRecord.id >= id_range[0], HealthRecord.id < id_range[1])
+    rows = db.session.execute(query.order_by(HealthRecord.id)).all()
+
+    def column(index):
+        return np.array([np.nan if row[index] is None else row[index] for row in rows], dtype=float)
+
+    overdue = np.array([
+        (today - row.follow_up_date).days if row.follow_up_date and not row[7] else np.nan
+        for row in rows
+    ], dtype=float)
+    return {
+        'id': np.array([row.id for row in rows], dtype=np.int64),
+        'patient_id': np.array([row.patient_id for row in rows], dtype=np.int64),
+        'temperature': column(4),
+        'systolic': column(5),
+        'bmi': calculate_bmi_bulk(column(2), column(3)),
+        'days_overdue': overdue,
+    }
+
+def evaluate(batch, compiled=COMPILED_RULES):
+    """Evaluate every rule over a batch; returns flag dicts for the rows that fire"""
+    import numpy as np
+    
+    flags = []
+    with np.errstate(invalid='ignore'):
+        for rule, column, compare in compiled:
+            values = batch[column]
+            fired = np.flatnonzero(compare(values, rule.threshold) & ~np.isnan(values))
+            for i in fired:
+                value = float(values[i])
+                flags.append({
+                    'patient_id': int(batch['patient_id'][i]),
+                    'health_record_id': int(batch['id'][i]),
+                    'rule': rule.name,
+                    'severity': rule.severity,
+                    'value': value,
+                    'message': rule.message.format(value=value),
+                })
+    return flags
+
+def _insert_ignoring_existing():
+    """INSERT ... ON CONFLICT (health_record_id, rule) DO NOTHING"""
+    if db.engine.dialect.name == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    else:
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    return dialect_insert(RiskFlag).on_conflict_do_nothing(index_elements=['health_record_id', 'rule'])
+
+def store_flags(batch, flags):
+    """Insert new flags and resolve open flags in the batch that no longer fire"""
+    now = datetime.utcnow()
+    if flags:
+        db.session.execute(_insert_ignoring_existing(), [
+            dict(flag, status='open', created_at=now) for flag in flags
+        ])
+
+    fired = {(flag['health_record_id'], flag['rule']) for flag in flags}
+    record_ids = batch['id'].tolist()
+    for start in range(0, len(record_ids), 500):
+        chunk = record_ids[start:start + 500]
+        open_flags = db.session.execute(
+            select(RiskFlag.id, RiskFlag.health_record_id, RiskFlag.rule).where(
+                RiskFlag.health_record_id.in_(chunk),
+                RiskFlag.status == 'open'
+            )
+        ).all()
+        stale = [flag_id for flag_id, record_id, rule in open_flags if (record_id, rule) not in fired]
+        if stale:
+            db.session.execute(
+                update(RiskFlag).where(RiskFlag.id.in_(stale)).values(status='resolved', resolved_at=now)
+            )
+    db.session.commit()
+    return len(flags)
+
+def evaluate_records(record_ids):
+    """Evaluate and store flags for specific records; returns the flags that fired"""
+    batch = load_batch(record_ids=record_ids)
+    flags = evaluate(batch)
+    store_flags(batch, flags)
+    return flags
+
+def resolve_follow_ups(patient_id, before):
+    """A new encounter satisfies the patient's earlier missed follow-ups"""
+    resolve_follow_ups_many([patient_id], before)
+
+def resolve_follow_ups_many(patient_ids, before):
+    """Resolve missed follow-ups for patients seen in one batch of encounters"""
+    patient_ids = list(patient_ids)
+    for start in range(0, len(patient_ids), 500):
+        chunk = patient_ids[start:start + 500]
+        earlier = select(HealthRecord.id).where(
+            HealthRecord.patient_id.in_(chunk),
+            HealthRecord.encounter_date < before
+        )
+        db.session.execute(
+            update(RiskFlag).where(
+                RiskFlag.patient_id.in_(chunk),
+                RiskFlag.rule == 'missed_follow_up',
+                RiskFlag.status == 'open',
+                RiskFlag.health_record_id.in_(earlier)
+            ).values(status='resolved', resolved_at=datetime.utcnow())
+        )
+    db.session.commit()
+
+def _evaluate_range(id_range):
+    """Process-pool entry point: evaluate one id range in its own connection"""
+    with app.app_context():
+        try:
+            batch = load_batch(id_range=id_range)
+            return len(batch['id']), store_flags(batch, evaluate(batch))
+        finally:
+            db.session.remove()
+
+def evaluate_all(processes=4, chunk_size=CHUNK_SIZE):
+    """Evaluate every health record in id-range chunks across worker processes"""
+    low, high = db.session.execute(select(func.min(HealthRecord.id), func.max(HealthRecord.id))).one()
+    if low is None:
+        return {'records': 0, 'flags': 0, 'chunks': 0}
+    ranges = [(start, start + chunk_size) for start in range(low, high + 1, chunk_size)]
+    db.session.remove()
+
+    if processes <= 1:
+        results = list(map(_evaluate_range, ranges))
+    else:
+        # Spawn, not fork: the caller is a threaded worker with a live log
+        # listener and connection pool that a forked child would inherit.
+        # Workers import the app through main, as gunicorn does, so the
+        # routes -> risk import cycle resolves before _evaluate_range loads.
+        with ProcessPoolExecutor(max_workers=processes, mp_context=multiprocessing.get_context('spawn'),
+                                 initializer=importlib.import_module, initargs=('main',)) as pool:
+            results = list(pool.map(_evaluate_range, ranges))
+    records = sum(chunk_records for chunk_records, _ in results)
+    flags = sum(chunk_flags for _, chunk_flags in results)
+    return {'records': records, 'flags': flags, 'chunks': len(ranges)}
+
+def worklist(chw_id=None, severity=None, status='open', before_id=None, limit=50):
+    """Flags for a CHW or doctor worklist, newest first, keyset-paged on id"""
+    query = select(RiskFlag).where(RiskFlag.status == status)
+    if severity:
+        query = query.where(RiskFlag.severity == severity)
+    if chw_id is not None:
+        query = query.join(Patient, Patient.id == RiskFlag.patient_id).where(Patient.assigned_chw_id == chw_id)
+    if before_id is not None:
+        query = query.where(RiskFlag.id < before_id)
+    return db.session.execute(query.order_by(RiskFlag.id.desc()).limit(limit)).scalars().all()
+
+@job('risk.evaluate_all', max_attempts=3, every=86400)
+def nightly_risk_evaluation():
+    """Re-evaluate every health record, e.g. to raise newly missed follow-ups"""
+    return evaluate_all(processes=app.config.get('RISK_PROCESSES', 4))
+
+@app.cli.group('risk')
+def risk_cli():
+    """Clinical risk flag commands"""
+
+@risk_cli.command('evaluate')
+@click.option('--processes', default=4, show_default=True, help='Worker processes.')
+@click.option('--chunk-size', default=CHUNK_SIZE, show_default=True, help='Health records per chunk.')
+def evaluate_command(processes, chunk_size):
+    """Evaluate the risk rules over every health record"""
+    result = evaluate_all(processes=processes, chunk_size=chunk_size)
+    click.echo(f"Evaluated {result['records']} records in {result['chunks']} chunks, "
+               f"{result['flags']} flags fired")
@@ -1,12 +1,31 @@
 import os
+import json
 import uuid
 from datetime import datetime, timedelta
-from flask import render_template, redirect, url_for, flash, request, session, jsonify
+from flask import render_template, redirect, url_for, flash, request, session, jsonify, abort, send_from_directory
 from flask_login import login_user, logout_user, login_required, current_user
 from app import app, db
-from models import User, Patient, HealthRecord, OutreachEvent, EventAttendance, Payment, AuditLog
-from forms import LoginForm, RegistrationForm, PatientForm, HealthRecordForm, OutreachEventForm, PaymentForm
-from utils import log_audit, generate_patient_number, create_intasend_checkout
+from models import User, Patient, HealthRecord, OutreachEvent, EventAttendance, Payment, AuditLog, PayoutBatch, Job
+from forms import LoginForm, RegistrationForm, PatientForm, HealthRecordForm, ScreeningSessionForm, OutreachEventForm, PaymentForm
+from utils import log_audit, create_intasend_checkout
+from identifiers import next_patient_number, next_payment_reference
+from jobs import enqueue, job_stats
+from middleware import not_modified
+from cache import cache
+from passwords import HashingBusy, login_allowed, record_failed_login, password_stats
+from attendance import record_attendances, parse_patient_numbers, service_counts, SERVICE_GROUPINGS
+from audit import search_audit
+from risk import evaluate_records, resolve_follow_ups, worklist, SEVERITIES
+from payouts import create_batch, batch_progress
+from geo import county_totals, county_slice
+from coding import code_patient, code_health_record, resolve_code, cohort_query
+from fhir import RESOURCE_TYPES, search as fhir_search_page, bundle, fhir_response, operation_outcome, parse_instant, export_dir
+from screening import record_screening, field_rules, VITALS
+from logs import log_stats
+from permissions import Permission, can, patient_filter, payment_filter, event_filter, deny_patient_access, can_access_patient
+from partitioning import patient_records, event_attendances, move_patient
+from caseloads import caseload_report, balance as balance_caseloads
+from archive import restore_for_viewer, archived_rows, archive_stats
 from functools import wraps
 
 def role_required(role):
@@ -25,7 +44,7 @@ def admin_required(f):
     """Decorator to require admin role"""
     @wraps(f)
     def decorated_function(*args, **kwargs):
-        if not current_user.is_authenticated or not current_user.can_access_admin():
+        if not can(Permission.ADMIN):
             flash('Access denied. Admin privileges required.', 'error')
             return redirect(url_for('dashboard'))
         return f(*args, **kwargs)
@@ -46,8 +65,20 @@ def login():
     
     form = LoginForm()
     if form.validate_on_submit():
+        # Reject brute-force attempts before touching the database or hashing
+        if not login_allowed(form.username.data, request.remote_addr):
+            flash('Too many failed login attempts. Please wait and try again.', 'error')
+            return render_template('login.html', form=form), 429
+        
         user = User.query.filter_by(username=form.username.data).first()
-        if user and user.check_password(form.password.data) and user.is_active:
+        try:
+            authenticated = user and user.check_password(form.password.data) and user.is_active
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('login.html', form=form), 503
+        
+        if authenticated:
+            # Commits a rehashed password along with last_login
             user.last_login = datetime.utcnow()
             db.session.commit()
             login_user(user)
@@ -55,6 +86,7 @@ def login():
             flash(f'Welcome back, {user.get_full_name()}!', 'success')
             return redirect(url_for('dashboard'))
         else:
+            record_failed_login(form.username.data, request.remote_addr)
             flash('Invalid username, password, or account inactive.', 'error')
             log_audit('failed_login', 'user', None, f'Failed login attempt for username: {form.username.data}')
     
@@ -88,7 +120,11 @@ def register():
             facility_name=form.facility_name.data,
             license_number=form.license_number.data
         )
-        user.set_password(form.password.data)
+        try:
+            user.set_password(form.password.data)
+        except HashingBusy:
+            flash('The server is busy. Please try again in a moment.', 'error')
+            return render_template('register.html', form=form), 503
         
         db.session.add(user)
         db.session.commit()
@@ -145,18 +181,14 @@ def dashboard():
 @login_required
 def patients():
     """Patient list"""
-    if not current_user.can_manage_patients():
+    if not can(Permission.MANAGE_PATIENTS):
         flash('Access denied.', 'error')
         return redirect(url_for('dashboard'))
     
     page = request.args.get('page', 1, type=int)
     search = request.args.get('search', '')
     
-    query = Patient.query.filter_by(status='active')
-    
-    # Role-based filtering
-    if current_user.role == 'chw':
-        query = query.filter_by(assigned_chw_id=current_user.id)
+    query = Patient.query.filter_by(status='active').filter(patient_filter())
     
     # Search functionality
     if search:
@@ -171,20 +203,24 @@ def patients():
         page=page, per_page=20, error_out=False
     )
     
+    cached = not_modified([(p.id, p.updated_at) for p in patients.items], patients.total)
+    if cached:
+        return cached
+    
     return render_template('patients.html', patients=patients, search=search)
 
 @app.route('/patients/new', methods=['GET', 'POST'])
 @login_required
 def new_patient():
     """Create new patient"""
-    if not current_user.can_manage_patients():
+    if not can(Permission.MANAGE_PATIENTS):
         flash('Access denied.', 'error')
         return redirect(url_for('dashboard'))
     
     form = PatientForm()
     if form.validate_on_submit():
         patient = Patient(
-            patient_number=generate_patient_number(),
+            patient_number=next_patient_number(),
             first_name=form.first_name.data,
             last_name=form.last_name.data,
             national_id=form.national_id.data,
@@ -203,11 +239,12 @@ def new_patient():
             chronic_conditions=form.chronic_conditions.data,
             emergency_contact_name=form.emergency_contact_name.data,
             emergency_contact_phone=form.emergency_contact_phone.data,
-            assigned_chw_id=current_user.id if current_user.role == 'chw' else None
+            assigned_chw_id=current_user.id if not can(Permission.VIEW_ALL_PATIENTS) else None
         )
         
         db.session.add(patient)
         db.session.commit()
+        code_patient(patient)
         
         log_audit('patient_created', 'patient', patient.id, f'New patient created: {patient.get_full_name()}')
         flash(f'Patient {patient.get_full_name()} has been registered successfully.', 'success')
@@ -219,22 +256,34 @@ def new_patient():
 @login_required
 def patient_detail(id):
     """Patient detail view"""
-    patient = Patient.query.get_or_404(id)
-    
-    # Role-based access control
-    if current_user.role == 'chw' and patient.assigned_chw_id != current_user.id:
-        flash('Access denied.', 'error')
-        return redirect(url_for('patients'))
+    if not can_access_patient(id):
+        # Archived patients move back to the hot tables when opened
+        restore_for_viewer(id)
+        denied = deny_patient_access(id)
+        if denied:
+            return denied
+    patient = db.session.get(Patient, id)
     
-    # Get patient's health records
-    health_records = HealthRecord.query.filter_by(patient_id=patient.id).order_by(
+    # Get patient's health records, older ones from the archive
+    health_records = HealthRecord.query.filter(*patient_records(HealthRecord, patient)).order_by(
         HealthRecord.encounter_date.desc()
     ).limit(10).all()
+    health_records += archived_rows(HealthRecord, patient.id, 'encounter_date', 10 - len(health_records))
     
     # Get recent payments
     payments = Payment.query.filter_by(patient_id=patient.id).order_by(
         Payment.created_at.desc()
     ).limit(5).all()
+    payments += archived_rows(Payment, patient.id, 'created_at', 5 - len(payments))
+    
+    cached = not_modified(
+        patient.updated_at,
+        [r.id for r in health_records],
+        [(p.id, p.status) for p in payments],
+        last_modified=patient.updated_at
+    )
+    if cached:
+        return cached
     
     return render_template('patient_detail.html', patient=patient, health_records=health_records, payments=payments)
 
@@ -242,20 +291,22 @@ def patient_detail(id):
 @login_required
 def edit_patient(id):
     """Edit patient information"""
-    patient = Patient.query.get_or_404(id)
-    
-    # Role-based access control
-    if current_user.role == 'chw' and patient.assigned_chw_id != current_user.id:
-        flash('Access denied.', 'error')
-        return redirect(url_for('patients'))
+    denied = deny_patient_access(id)
+    if denied:
+        return denied
+    patient = db.session.get(Patient, id)
     
     form = PatientForm(obj=patient)
     if form.validate_on_submit():
+        old_county = patient.county
         form.populate_obj(patient)
         patient.updated_at = datetime.utcnow()
+        move_patient(patient, old_county)
         db.session.commit()
+        code_patient(patient)
         
         log_audit('patient_updated', 'patient', patient.id, f'Patient updated: {patient.get_full_name()}')
+        cache.invalidate(f'patient:{patient.id}')
         flash('Patient information updated successfully.', 'success')
         return redirect(url_for('patient_detail', id=patient.id))
     
@@ -265,17 +316,16 @@ def edit_patient(id):
 @login_required
 def new_health_record(id):
     """Create new health record for patient"""
-    patient = Patient.query.get_or_404(id)
-    
-    # Role-based access control
-    if current_user.role == 'chw' and patient.assigned_chw_id != current_user.id:
-        flash('Access denied.', 'error')
-        return redirect(url_for('patients'))
+    denied = deny_patient_access(id)
+    if denied:
+        return denied
+    patient = db.session.get(Patient, id)
     
     form = HealthRecordForm()
     if form.validate_on_submit():
         health_record = HealthRecord(
             patient_id=patient.id,
+            county=patient.county,
             encounter_type=form.encounter_type.data,
             weight=form.weight.data,
             height=form.height.data,
@@ -294,14 +344,81 @@ def new_health_record(id):
         
         db.session.add(health_record)
         db.session.commit()
+        code_health_record(health_record)
         
         log_audit('health_record_created', 'health_record', health_record.id, 
                  f'Health record created for patient: {patient.get_full_name()}')
         flash('Health record added successfully.', 'success')
+        
+        cache.invalidate(f'patient:{patient.id}')
+        
+        # Flag dangerous readings now rather than at the nightly run
+        resolve_follow_ups(patient.id, health_record.encounter_date)
+        for flag in evaluate_records([health_record.id]):
+            flash(f"Risk flag: {flag['message']}", 'error' if flag['severity'] == 'critical' else 'warning')
         return redirect(url_for('patient_detail', id=patient.id))
     
     return render_template('patient_detail.html', form=form, patient=patient, add_record=True)
 
+@app.route('/screening', methods=['GET', 'POST'])
+@login_required
+def screening_session():
+    """Grid entry of vitals for many patients during a screening campaign"""
+    if not can(Permission.MANAGE_PATIENTS):
+        flash('Access denied.', 'error')
+        return redirect(url_for('dashboard'))
+    
+    form = ScreeningSessionForm()
+    if not form.facility_name.data and request.method == 'GET':
+        form.facility_name.data = current_user.facility_name
+    row_count = min(request.args.get('rows', 20, type=int), app.config['SCREENING_MAX_ROWS'])
+    rows, errors = [], {}
+    
+    if form.validate_on_submit():
+        fields = ('patient_number',) + VITALS + ('notes',)
+        columns = {name: request.form.getlist(name) for name in fields}
+        submitted = [dict(zip(fields, values)) for values in zip(*columns.values())]
+        rows = [row for row in submitted if any(value.strip() for value in row.values())]
+        if len(rows) > app.config['SCREENING_MAX_ROWS']:
+            flash(f"Submit at most {app.config['SCREENING_MAX_ROWS']} rows at a time.", 'error')
+        elif rows:
+            result = record_screening(rows, form.encounter_type.data, form.facility_name.data, current_user.id)
+            if result['recorded']:
+                flash(f"{len(result['recorded'])} records saved.", 'success')
+            for flag in result['flags']:
+                flash(f"Risk flag: {flag['message']}", 'error' if flag['severity'] == 'critical' else 'warning')
+            # Keep only the rejected rows in the grid for correction
+            failed = {entry['index']: entry['errors'] for entry in result['errors']}
+            rows = [row for index, row in enumerate(rows) if index in failed]
+            errors = {position: failed[index] for position, index in enumerate(sorted(failed))}
+            if errors:
+                flash(f'{len(errors)} rows need correcting.', 'warning')
+            row_count = max(len(rows), 5)
+    
+    return render_template('screening.html', form=form, rows=rows, errors=errors, row_count=row_count,
+                           vitals=field_rules()['vitals'])
+
+@app.route('/api/screening', methods=['POST'])
+@login_required
+def api_screening_session():
+    """API endpoint to record vitals for many patients in one batch"""
+    if not can(Permission.MANAGE_PATIENTS):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    rows = data.get('rows')
+    if not isinstance(rows, list) or not rows or not all(isinstance(row, dict) for row in rows):
+        return jsonify({'error': 'rows must be a non-empty list of objects'}), 400
+    if len(rows) > app.config['SCREENING_MAX_ROWS']:
+        return jsonify({'error': f"At most {app.config['SCREENING_MAX_ROWS']} rows per batch"}), 400
+    
+    try:
+        result = record_screening(rows, data.get('encounter_type', 'screening'),
+                                  data.get('facility_name') or current_user.facility_name, current_user.id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    return jsonify(result), 201 if result['recorded'] else 200
+
 @app.route('/outreach')
 @login_required
 def outreach():
@@ -309,11 +426,7 @@ def outreach():
     page = request.args.get('page', 1, type=int)
     status_filter = request.args.get('status', 'all')
     
-    query = OutreachEvent.query
-    
-    # Role-based filtering
-    if current_user.role == 'chw':
-        query = query.filter_by(organizer_id=current_user.id)
+    query = OutreachEvent.query.filter(event_filter())
     
     # Status filtering
     if status_filter != 'all':
@@ -323,6 +436,10 @@ def outreach():
         page=page, per_page=10, error_out=False
     )
     
+    cached = not_modified([(e.id, e.updated_at, e.attendance_count) for e in events.items], events.total)
+    if cached:
+        return cached
+    
     return render_template('outreach.html', events=events, status_filter=status_filter)
 
 @app.route('/outreach/new', methods=['GET', 'POST'])
@@ -364,7 +481,11 @@ def outreach_detail(id):
     event = OutreachEvent.query.get_or_404(id)
     
     # Get attendances
-    attendances = EventAttendance.query.filter_by(event_id=event.id).all()
+    attendances = EventAttendance.query.filter(*event_attendances(event)).all()
+    
+    cached = not_modified(event.updated_at, event.attendance_count, [a.id for a in attendances], last_modified=event.updated_at)
+    if cached:
+        return cached
     
     return render_template('outreach_detail.html', event=event, attendances=attendances)
 
@@ -383,28 +504,83 @@ def record_attendance(id):
     
     patient = Patient.query.get_or_404(patient_id)
     
-    # Check if already attended
-    existing = EventAttendance.query.filter_by(event_id=event.id, patient_id=patient_id).first()
-    if existing:
-        flash('Patient has already been recorded for this event.', 'warning')
-        return redirect(url_for('outreach_detail', id=id))
-    
-    attendance = EventAttendance(
-        event_id=event.id,
-        patient_id=patient_id,
-        services_received=services,
+    # Seat reservation and the unique (event, patient) index make this
+    # safe when several CHWs record at the same time
+    result = record_attendances(
+        event.id,
+        patient_ids=[patient.id],
+        services=services,
         notes=notes,
-        recorded_by_id=current_user.id
+        recorded_by_id=current_user.id,
+        audit=False
     )
     
-    db.session.add(attendance)
-    db.session.commit()
+    if result['duplicates']:
+        flash('Patient has already been recorded for this event.', 'warning')
+        return redirect(url_for('outreach_detail', id=id))
+    if result['over_capacity']:
+        flash('This event is full.', 'warning')
+        return redirect(url_for('outreach_detail', id=id))
     
-    log_audit('event_attendance_recorded', 'event_attendance', attendance.id, 
+    log_audit('event_attendance_recorded', 'event_attendance', result['attendance_ids'][0], 
              f'Attendance recorded for {patient.get_full_name()} at {event.title}')
     flash(f'Attendance recorded for {patient.get_full_name()}.', 'success')
     return redirect(url_for('outreach_detail', id=id))
 
+@app.route('/outreach/<int:id>/attend/bulk', methods=['POST'])
+@login_required
+def record_bulk_attendance(id):
+    """Record many patients at an outreach event (form or JSON)"""
+    if request.is_json:
+        data = request.get_json(silent=True) or {}
+        patient_numbers = data.get('patient_numbers', [])
+        if isinstance(patient_numbers, str):
+            # Scanned or pasted input, as in the form
+            patient_numbers = parse_patient_numbers(patient_numbers)
+        elif isinstance(patient_numbers, list):
+            patient_numbers = [str(n).strip().upper() for n in patient_numbers]
+        else:
+            return jsonify({'error': 'patient_numbers must be a list or a string'}), 400
+        patient_ids = data.get('patient_ids', [])
+        services = data.get('services', '')
+        notes = data.get('notes', '')
+    else:
+        patient_numbers = parse_patient_numbers(request.form.get('patient_numbers'))
+        patient_ids = request.form.getlist('patient_id')
+        services = request.form.get('services', '')
+        notes = request.form.get('notes', '')
+    
+    try:
+        result = record_attendances(
+            id,
+            patient_ids=patient_ids,
+            patient_numbers=patient_numbers,
+            services=services,
+            notes=notes,
+            recorded_by_id=current_user.id
+        )
+    except LookupError:
+        if request.is_json:
+            return jsonify({'error': 'Event not found'}), 404
+        abort(404)
+    except (TypeError, ValueError):
+        if request.is_json:
+            return jsonify({'error': 'patient_ids must be integers'}), 400
+        flash('Invalid patient selection.', 'error')
+        return redirect(url_for('outreach_detail', id=id))
+    
+    if request.is_json:
+        return jsonify(result)
+    
+    flash(f"Attendance recorded for {len(result['recorded'])} patients.", 'success')
+    if result['duplicates']:
+        flash(f"{len(result['duplicates'])} patients were already recorded.", 'warning')
+    if result['over_capacity']:
+        flash(f"{len(result['over_capacity'])} patients not recorded: event is full.", 'warning')
+    if result['unknown']:
+        flash(f"Unknown patient numbers: {', '.join(str(u) for u in result['unknown'][:20])}", 'error')
+    return redirect(url_for('outreach_detail', id=id))
+
 @app.route('/payments')
 @login_required
 def payments():
@@ -413,19 +589,7 @@ def payments():
     payment_type = request.args.get('type', 'all')
     status_filter = request.args.get('status', 'all')
     
-    query = Payment.query
-    
-    # Role-based filtering
-    if current_user.role == 'chw':
-        query = query.filter(
-            (Payment.paid_by_id == current_user.id) | 
-            (Payment.received_by_id == current_user.id)
-        )
-    elif current_user.role == 'doctor':
-        query = query.filter(
-            (Payment.paid_by_id == current_user.id) | 
-            (Payment.received_by_id == current_user.id)
-        )
+    query = Payment.query.filter(payment_filter())
     
     # Type filtering
     if payment_type != 'all':
@@ -439,6 +603,10 @@ def payments():
         page=page, per_page=20, error_out=False
     )
     
+    cached = not_modified([(p.id, p.status) for p in payments.items], payments.total)
+    if cached:
+        return cached
+    
     return render_template('payments.html', payments=payments, 
                          payment_type=payment_type, status_filter=status_filter)
 
@@ -462,7 +630,7 @@ def new_payment():
             paid_by_id=current_user.id,
             patient_id=patient.id if patient else None
         )
-        payment.generate_reference()
+        payment.payment_reference = next_payment_reference()
         
         # Create IntaSend checkout (this would integrate with actual IntaSend API)
         checkout_url = create_intasend_checkout(payment)
@@ -516,24 +684,16 @@ def toggle_user_status(id):
 @login_required
 def api_patients_search():
     """API endpoint for patient search (for AJAX)"""
-    if not current_user.can_manage_patients():
+    if not can(Permission.MANAGE_PATIENTS):
         return jsonify({'error': 'Access denied'}), 403
     
     query = request.args.get('q', '')
     if len(query) < 2:
         return jsonify([])
     
-    patients_query = Patient.query.filter_by(status='active')
-    
-    # Role-based filtering
-    if current_user.role == 'chw':
-        patients_query = patients_query.filter_by(assigned_chw_id=current_user.id)
+    patients_query = Patient.query.filter_by(status='active').filter(patient_filter())
     
-    patients = patients_query.filter(
-        (Patient.first_name.contains(query)) |
-        (Patient.last_name.contains(query)) |
-        (Patient.patient_number.contains(query))
-    ).limit(10).all()
+    patients = patients_query.filter(Patient.search_clause(query)).limit(10).all()
     
     return jsonify([{
         'id': p.id,
@@ -542,6 +702,453 @@ def api_patients_search():
         'age': p.get_age()
     } for p in patients])
 
+@app.route('/api/patients/<int:id>/vitals')
+@login_required
+def api_patient_vitals(id):
+    """API endpoint for a patient's vitals timeline as columnar series"""
+    # numpy is only needed here; keep it out of app startup
+    from vitals import vitals_timeline, DOWNSAMPLE_METHODS
+    
+    denied = deny_patient_access(id, api=True)
+    if denied:
+        return denied
+    patient = db.session.get(Patient, id)
+    
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = datetime.fromisoformat(start) if start else None
+        end = datetime.fromisoformat(end) if end else None
+    except ValueError:
+        return jsonify({'error': 'Invalid date'}), 400
+    
+    method = request.args.get('method', 'lttb')
+    if method not in DOWNSAMPLE_METHODS:
+        return jsonify({'error': f'method must be one of {", ".join(DOWNSAMPLE_METHODS)}'}), 400
+    points = request.args.get('points', type=int)
+    if points is not None:
+        points = min(max(points, 3), 5000)
+    
+    timeline, version = vitals_timeline(patient.id, start, end, points, method)
+    cached = not_modified(version)
+    if cached:
+        return cached
+    
+    return jsonify(dict(timeline, patient_id=patient.id, start=start and start.isoformat(),
+                        end=end and end.isoformat(), points=points, method=method))
+
+@app.route('/api/risk/worklist')
+@login_required
+def api_risk_worklist():
+    """API endpoint for open risk flags; CHWs see their own patients"""
+    severity = request.args.get('severity')
+    if severity and severity not in SEVERITIES:
+        return jsonify({'error': f'severity must be one of {", ".join(SEVERITIES)}'}), 400
+    status = request.args.get('status', 'open')
+    if status not in ('open', 'resolved'):
+        return jsonify({'error': 'status must be open or resolved'}), 400
+    
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    flags = worklist(
+        chw_id=None if can(Permission.VIEW_ALL_PATIENTS) else current_user.id,
+        severity=severity,
+        status=status,
+        before_id=request.args.get('before', type=int),
+        limit=limit
+    )
+    
+    return jsonify({
+        'results': [{
+            'id': f.id,
+            'patient_id': f.patient_id,
+            'patient_name': f.patient.get_full_name(),
+            'health_record_id': f.health_record_id,
+            'rule': f.rule,
+            'severity': f.severity,
+            'value': f.value,
+            'message': f.message,
+            'status': f.status,
+            'created_at': f.created_at.isoformat() if f.created_at else None
+        } for f in flags],
+        'next': flags[-1].id if len(flags) == limit else None
+    })
+
+@app.route('/api/cohorts')
+@login_required
+def api_cohort():
+    """API endpoint for patients with every given condition, medication and allergy
+
+    Each filter takes a code ("I10") or a name ("hypertension") and may repeat.
+    """
+    filters = {}
+    for param, kind in (('condition', 'condition'), ('medication', 'medication'), ('allergy', 'allergy')):
+        filters[param] = []
+        for term in request.args.getlist(param):
+            code_id = resolve_code(kind, term)
+            if code_id is None:
+                return jsonify({'error': f'Unknown {kind}: {term}'}), 400
+            filters[param].append(code_id)
+    if not any(filters.values()):
+        return jsonify({'error': 'Give at least one condition, medication or allergy'}), 400
+    
+    limit = min(request.args.get('limit', 100, type=int), 500)
+    cohort = cohort_query(
+        conditions=filters['condition'],
+        medications=filters['medication'],
+        allergies=filters['allergy'],
+        county=request.args.get('county')
+    ).where(patient_filter()).subquery()
+    query = Patient.query.filter(Patient.id.in_(db.select(cohort.c.id)))
+    
+    after = request.args.get('after', type=int)
+    if after:
+        query = query.filter(Patient.id > after)
+    patients = query.order_by(Patient.id).limit(limit).all()
+    
+    return jsonify({
+        'results': [{
+            'id': p.id,
+            'patient_number': p.patient_number,
+            'name': p.get_full_name(),
+            'county': p.county,
+            'ward': p.ward
+        } for p in patients],
+        'next': patients[-1].id if len(patients) == limit else None
+    })
+
+@app.route('/api/payouts/batches', methods=['POST'])
+@login_required
+def api_create_payout_batch():
+    """API endpoint to create and queue a CHW allowance payout batch (admin only)"""
+    if not can(Permission.ADMIN):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        period_start = datetime.strptime(data['period_start'], '%Y-%m-%d').date()
+        period_end = datetime.strptime(data['period_end'], '%Y-%m-%d').date()
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'period_start and period_end (YYYY-MM-DD) are required'}), 400
+    
+    try:
+        batch, skipped = create_batch(period_start, period_end, data.get('county'), current_user.id)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 409
+    
+    if batch.payment_count:
+        enqueue('payouts.submit_batch', batch_id=batch.id)
+    return jsonify(dict(batch_progress(batch), skipped_chw_ids=skipped)), 202
+
+@app.route('/api/payouts/batches/<int:id>')
+@login_required
+def api_payout_batch(id):
+    """API endpoint for payout batch progress (admin only)"""
+    if not can(Permission.ADMIN):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    batch = PayoutBatch.query.get_or_404(id)
+    return jsonify(batch_progress(batch))
+
+@app.route('/api/payments/reconcile', methods=['POST'])
+@login_required
+def api_reconcile_payments():
+    """API endpoint to upload a provider statement for reconciliation (admin only)"""
+    if not can(Permission.ADMIN):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    statement = request.files.get('statement')
+    if not statement or not statement.filename:
+        return jsonify({'error': 'Upload the statement as the "statement" file field'}), 400
+    fmt = 'csv' if statement.filename.lower().endswith('.csv') else 'json'
+    
+    upload_dir = os.path.join(app.config['RECONCILIATION_DIR'], 'uploads')
+    os.makedirs(upload_dir, exist_ok=True)
+    path = os.path.join(upload_dir, f'{uuid.uuid4().hex}.{fmt}')
+    statement.save(path)
+    
+    queued = enqueue('payments.reconcile', path=path, fmt=fmt,
+                     window_days=request.form.get('window_days', 30, type=int))
+    return jsonify({'job_id': queued.id, 'status': queued.status}), 202
+
+@app.route('/api/caseloads')
+@login_required
+def api_caseloads():
+    """API endpoint for active patients per CHW and patients without an active CHW (admin only)"""
+    if not can(Permission.ADMIN):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    return jsonify(caseload_report(request.args.get('county') or None))
+
+@app.route('/api/caseloads/balance', methods=['POST'])
+@login_required
+def api_balance_caseloads():
+    """API endpoint to assign patients without an active CHW and even out caseloads (admin only)"""
+    if not can(Permission.ADMIN):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    data = request.get_json(silent=True) or {}
+    try:
+        tolerance = int(data.get('tolerance', 0))
+    except (TypeError, ValueError):
+        return jsonify({'error': 'tolerance must be a whole number'}), 400
+    if tolerance < 0:
+        return jsonify({'error': 'tolerance must be a whole number'}), 400
+    
+    summary = balance_caseloads(data.get('county') or None, bool(data.get('rebalance')), tolerance,
+                                bool(data.get('dry_run')))
+    return jsonify(summary)
+
+@app.route('/api/outreach/services')
+@login_required
+def api_outreach_services():
+    """API endpoint for attendance counts per service, by service, event or ward"""
+    group_by = request.args.get('group_by', 'service')
+    if group_by not in SERVICE_GROUPINGS:
+        return jsonify({'error': f'group_by must be one of {", ".join(SERVICE_GROUPINGS)}'}), 400
+    try:
+        start = request.args.get('start')
+        end = request.args.get('end')
+        start = datetime.fromisoformat(start) if start else None
+        end = datetime.fromisoformat(end) if end else None
+    except ValueError:
+        return jsonify({'error': 'Invalid date'}), 400
+    
+    results = service_counts(
+        group_by=group_by,
+        event_id=request.args.get('event_id', type=int),
+        service=request.args.get('service'),
+        county=request.args.get('county'),
+        ward=request.args.get('ward'),
+        start=start,
+        end=end,
+        where=[event_filter()]
+    )
+    return jsonify({'group_by': group_by, 'results': results})
+
+@app.route('/api/geo/counties')
+@login_required
+def api_geo_counties():
+    """API endpoint for county-level coverage totals from the latest snapshot"""
+    version, data = county_totals()
+    if data is None:
+        return jsonify({'error': 'No coverage snapshot yet; run flask geo refresh'}), 503
+    
+    cached = not_modified(version)
+    if cached:
+        return cached
+    return jsonify(data)
+
+@app.route('/api/geo/counties/<county>')
+@login_required
+def api_geo_county(county):
+    """API endpoint for ward-level coverage in one county from the latest snapshot"""
+    version, data = county_slice(county)
+    if data is None:
+        return jsonify({'error': 'No coverage snapshot yet; run flask geo refresh'}), 503
+    
+    cached = not_modified(version)
+    if cached:
+        return cached
+    return jsonify(data)
+
+@app.route('/api/audit')
+@login_required
+def api_audit_search():
+    """API endpoint for audit log search (admin only)"""
+    if not can(Permission.ADMIN):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    try:
+        since = request.args.get('since')
+        until = request.args.get('until')
+        since = datetime.fromisoformat(since) if since else None
+        until = datetime.fromisoformat(until) if until else None
+        
+        # Keyset cursor: "<created_at ISO>|<id>" from the previous page
+        before = request.args.get('before')
+        if before:
+            created_at, entry_id = before.rsplit('|', 1)
+            before = (datetime.fromisoformat(created_at), int(entry_id))
+    except ValueError:
+        return jsonify({'error': 'Invalid date or cursor'}), 400
+    
+    limit = min(request.args.get('limit', 50, type=int), 200)
+    entries = search_audit(
+        user_id=request.args.get('user_id', type=int),
+        resource_type=request.args.get('resource_type'),
+        resource_id=request.args.get('resource_id', type=int),
+        action=request.args.get('action'),
+        since=since,
+        until=until,
+        before=before,
+        limit=limit
+    )
+    
+    next_cursor = None
+    if len(entries) == limit and entries[-1]['created_at']:
+        next_cursor = f"{entries[-1]['created_at'].isoformat()}|{entries[-1]['id']}"
+    
+    return jsonify({
+        'results': [{
+            'id': e['id'],
+            'user_id': e['user_id'],
+            'action': e['action'],
+            'resource_type': e['resource_type'],
+            'resource_id': e['resource_id'],
+            'details': e['details'],
+            'ip_address': e['ip_address'],
+            'created_at': e['created_at'].isoformat() if e['created_at'] else None
+        } for e in entries],
+        'next': next_cursor
+    })
+
+@app.route('/api/admin/metrics')
+@login_required
+def api_admin_metrics():
+    """API endpoint for operational metrics (admin only)"""
+    if not can(Permission.ADMIN):
+        return jsonify({'error': 'Access denied'}), 403
+    
+    return jsonify({
+        'compression': app.wsgi_app.metrics.snapshot(),
+        'cache': cache.stats(),
+        'passwords': password_stats(),
+        'jobs': job_stats(),
+        'logging': log_stats(),
+        'archive': archive_stats()
+    })
+
+def _fhir_scope(resource_type):
+    """WHERE clauses limiting a FHIR resource type to what the current user may see"""
+    if resource_type == 'Patient':
+        return [patient_filter()]
+    if resource_type == 'Encounter':
+        if can(Permission.VIEW_ALL_PATIENTS):
+            return []
+        return [HealthRecord.patient_id.in_(db.select(Patient.id).where(patient_filter()))]
+    return [payment_filter()]
+
+@app.route('/fhir/<resource_type>')
+@login_required
+def fhir_search(resource_type):
+    """FHIR search: _count and _since paging in (lastUpdated, id) order"""
+    if resource_type not in RESOURCE_TYPES:
+        return operation_outcome(f'Unsupported resource type: {resource_type}', 404, 'not-supported')
+    kind = RESOURCE_TYPES[resource_type]
+    
+    where = _fhir_scope(resource_type)
+    try:
+        since = parse_instant(request.args['_since']) if request.args.get('_since') else None
+        if request.args.get('patient'):
+            patient_id = int(request.args['patient'].rsplit('/', 1)[-1])
+            if resource_type == 'Patient':
+                return operation_outcome('Use _id to search Patient by id', 400)
+            where.append(kind.model.patient_id == patient_id)
+    except ValueError:
+        return operation_outcome('Invalid _since or patient parameter', 400)
+    if request.args.get('_id'):
+        where.append(kind.model.id.in_([int(v) for v in request.args['_id'].split(',') if v.isdigit()]))
+    if resource_type == 'Patient' and request.args.get('identifier'):
+        where.append(Patient.patient_number == request.args['identifier'].rsplit('|', 1)[-1])
+    
+    count = max(1, min(request.args.get('_count', 50, type=int), app.config['FHIR_MAX_COUNT']))
+    try:
+        resources, cursor = fhir_search_page(kind, where=where, since=since,
+                                             cursor=request.args.get('_cursor'), count=count)
+    except ValueError:
+        return operation_outcome('Invalid _cursor', 400)
+    
+    args = request.args.to_dict()
+    next_url = url_for('fhir_search', resource_type=resource_type, **dict(args, _cursor=cursor, _count=count),
+                       _external=True) if cursor else None
+    resource_url = url_for('fhir_search', resource_type=resource_type, _external=True)
+    return fhir_response(bundle(resources, resource_url, request.url, next_url))
+
+@app.route('/fhir/<resource_type>/<int:id>')
+@login_required
+def fhir_read(resource_type, id):
+    """FHIR read of a single Patient, Encounter or PaymentNotice"""
+    if resource_type not in RESOURCE_TYPES:
+        return operation_outcome(f'Unsupported resource type: {resource_type}', 404, 'not-supported')
+    kind = RESOURCE_TYPES[resource_type]
+    
+    query = db.select(*kind.columns).where(kind.model.id == id, *_fhir_scope(resource_type))
+    row = db.session.execute(query).first()
+    if row is None:
+        return operation_outcome(f'{resource_type}/{id} not found', 404, 'not-found')
+    
+    resource = kind.serialize(row)
+    cached = not_modified(resource)
+    if cached:
+        return cached
+    return fhir_response(resource)
+
+@app.route('/fhir/$export')
+@login_required
+def fhir_export():
+    """FHIR bulk data kick-off: queue NDJSON files per resource type (admin only)"""
+    if not can(Permission.ADMIN):
+        return operation_outcome('Bulk export requires admin access', 403, 'forbidden')
+    
+    types = [t for t in request.args.get('_type', '').split(',') if t] or list(RESOURCE_TYPES)
+    unknown = [t for t in types if t not in RESOURCE_TYPES]
+    if unknown:
+        return operation_outcome(f'Unsupported _type: {", ".join(unknown)}', 400)
+    try:
+        since = parse_instant(request.args['_since']) if request.args.get('_since') else None
+    except ValueError:
+        return operation_outcome('Invalid _since', 400)
+    
+    queued = enqueue('fhir.export', export_id=uuid.uuid4().hex, types=types, since=since and since.isoformat())
+    log_audit('fhir_export', 'job', queued.id, f'FHIR bulk export queued: {", ".join(types)}')
+    response = app.response_class(status=202)
+    response.headers['Content-Location'] = url_for('fhir_export_status', job_id=queued.id, _external=True)
+    return response
+
+@app.route('/fhir/$export-status/<int:job_id>')
+@login_required
+def fhir_export_status(job_id):
+    """FHIR bulk data status: 202 while running, then the manifest of NDJSON files"""
+    if not can(Permission.ADMIN):
+        return operation_outcome('Bulk export requires admin access', 403, 'forbidden')
+    export = db.session.get(Job, job_id)
+    if export is None or export.name != 'fhir.export':
+        return operation_outcome(f'Unknown export {job_id}', 404, 'not-found')
+    
+    if export.status in ('queued', 'running'):
+        response = app.response_class(status=202)
+        response.headers['X-Progress'] = export.status
+        response.headers['Retry-After'] = '5'
+        return response
+    if export.status == 'failed':
+        return operation_outcome('Export failed; see the job log', 500, 'exception')
+    
+    manifest = json.loads(export.result)
+    return jsonify({
+        'transactionTime': manifest['transactionTime'],
+        'request': url_for('fhir_export', _external=True),
+        'requiresAccessToken': True,
+        'output': [{
+            'type': entry['type'],
+            'url': url_for('fhir_export_file', job_id=job_id, filename=entry['file'], _external=True),
+            'count': entry['count']
+        } for entry in manifest['output']],
+        'error': []
+    })
+
+@app.route('/fhir/$export-file/<int:job_id>/<filename>')
+@login_required
+def fhir_export_file(job_id, filename):
+    """Download one NDJSON file of a finished export (admin only)"""
+    if not can(Permission.ADMIN):
+        return operation_outcome('Bulk export requires admin access', 403, 'forbidden')
+    export = db.session.get(Job, job_id)
+    if export is None or export.name != 'fhir.export' or export.status != 'completed':
+        return operation_outcome(f'Unknown export {job_id}', 404, 'not-found')
+    
+    directory = export_dir(json.loads(export.result)['export_id'])
+    return send_from_directory(directory, filename, mimetype='application/fhir+ndjson')
+
 @app.route('/webhooks/intasend', methods=['POST'])
 def intasend_webhook():
     """IntaSend webhook handler"""
@@ -553,23 +1160,12 @@ def intasend_webhook():
         status = data.get('state')
         
         if invoice_id and status:
-            payment = Payment.query.filter_by(intasend_checkout_id=invoice_id).first()
-            if payment:
-                payment.intasend_status = status
-                if status.lower() == 'complete':
-                    payment.status = 'completed'
-                    payment.completed_at = datetime.utcnow()
-                elif status.lower() == 'failed':
-                    payment.status = 'failed'
-                
-                db.session.commit()
-                
-                log_audit('payment_webhook', 'payment', payment.id, 
-                         f'Payment webhook received: {status}')
+            # Acknowledge immediately; the job worker applies the update
+            enqueue('payments.intasend_webhook', invoice_id=invoice_id, status=status)
         
         return jsonify({'status': 'success'}), 200
-    except Exception as e:
-        app.logger.error(f'Webhook error: {str(e)}')
+    except Exception:
+        app.logger.exception('IntaSend webhook error')
         return jsonify({'status': 'error'}), 400
 
 @app.errorhandler(404)
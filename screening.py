@@ -0,0 +1,187 @@
+import math
+from datetime import datetime
+from sqlalchemy import select, insert, or_
+from wtforms import IntegerField
+from wtforms.validators import NumberRange, Length
+from app import db
+from models import Patient, HealthRecord
+from forms import HealthRecordForm
+from permissions import patient_filter
+from cache import cache
+from risk import evaluate_records, resolve_follow_ups_many
+from utils import log_audit
+from identifiers import is_valid, sequence_of
+from partitioning import patient_counties
+
+VITALS = ('weight', 'height', 'temperature', 'blood_pressure_systolic', 'blood_pressure_diastolic', 'pulse_rate')
+
+# Keep IN (...) lists well under SQLite's bound-parameter limit
+CHUNK_SIZE = 500
+
+_rules = None
+
+def field_rules():
+    """Validation rules read from HealthRecordForm, so both entry paths accept the same values
+
+    Returns {'vitals': {field: (min, max, integer, label)}, 'encounter_types': [...],
+    'facility_max': n}.
+    """
+    global _rules
+    if _rules is None:
+        vitals = {}
+        for name in VITALS:
+            unbound = getattr(HealthRecordForm, name)
+            bounds = next(v for v in unbound.kwargs.get('validators', []) if isinstance(v, NumberRange))
+            vitals[name] = (bounds.min, bounds.max, issubclass(unbound.field_class, IntegerField), unbound.args[0])
+        facility = HealthRecordForm.facility_name.kwargs.get('validators', [])
+        _rules = {
+            'vitals': vitals,
+            'encounter_types': [value for value, _ in HealthRecordForm.encounter_type.kwargs['choices']],
+            'facility_max': next((v.max for v in facility if isinstance(v, Length)), None),
+        }
+    return _rules
+
+def validate_vitals(rows):
+    """Check every row's vitals column by column; returns (columns, errors)
+
+    ``columns`` maps each vital to a float array with NaN for blanks and
+    ``errors`` holds one {field: message} dict per row, using WTForms'
+    messages so the grid reads like the single-record form.
+    """
+    import numpy as np
+
+    count = len(rows)
+    errors = [{} for _ in range(count)]
+    columns = {}
+    for name, (low, high, integer, _) in field_rules()['vitals'].items():
+        invalid = 'Not a valid integer value.' if integer else 'Not a valid float value.'
+        values = np.full(count, np.nan)
+        for index, row in enumerate(rows):
+            raw = row.get(name)
+            if raw is None or raw == '':
+                continue
+            try:
+                value = float(raw)
+            except (TypeError, ValueError):
+                errors[index][name] = invalid
+                continue
+            # 'nan' would otherwise pass as a blank vital, 'inf' as out of range
+            if not math.isfinite(value):
+                errors[index][name] = invalid
+                continue
+            values[index] = value
+
+        present = ~np.isnan(values)
+        if integer:
+            for index in np.flatnonzero(present & (values != np.round(values))):
+                errors[index][name] = invalid
+        for index in np.flatnonzero(present & ((values < low) | (values > high))):
+            errors[index].setdefault(name, f'Number must be between {low:g} and {high:g}.')
+        columns[name] = values
+
+    blank = ~np.any(np.stack([~np.isnan(values) for values in columns.values()]), axis=0)
+    for index in np.flatnonzero(blank):
+        # A row whose only vitals were rejected already says why
+        if not errors[index]:
+            errors[index]['vitals'] = 'Enter at least one vital sign.'
+    return columns, errors
+
+def resolve_rows(rows, errors):
+    """Patient id for each row (by patient_id or patient_number) within the caller's scope"""
+    ids = {int(row['patient_id']) for row in rows if str(row.get('patient_id') or '').isdigit()}
+    numbers = {str(row['patient_number']).strip().upper() for row in rows if row.get('patient_number')}
+    by_id, by_number = set(), {}
+    id_list, number_list = list(ids), list(numbers)
+    for start in range(0, max(len(id_list), len(number_list)), CHUNK_SIZE):
+        for patient_id, number in db.session.execute(
+            select(Patient.id, Patient.patient_number).where(
+                or_(Patient.id.in_(id_list[start:start + CHUNK_SIZE]),
+                    Patient.patient_number.in_(number_list[start:start + CHUNK_SIZE])),
+                patient_filter()
+            )
+        ):
+            by_id.add(patient_id)
+            by_number[number.upper()] = patient_id
+
+    patient_ids, first_row = [], {}
+    for index, row in enumerate(rows):
+        raw_id = str(row.get('patient_id') or '')
+        if raw_id.isdigit():
+            patient_id = int(raw_id) if int(raw_id) in by_id else None
+        elif row.get('patient_number'):
+            patient_id = by_number.get(str(row['patient_number']).strip().upper())
+        else:
+            errors[index]['patient'] = 'Enter a patient number.'
+            patient_ids.append(None)
+            continue
+        if patient_id is None and sequence_of(row.get('patient_number')) == 'payment_reference':
+            errors[index]['patient'] = 'This is a payment reference, not a patient number.'
+        elif patient_id is None and is_valid(row.get('patient_number')) is False:
+            errors[index]['patient'] = 'Patient number check digit does not match; check for a typo.'
+        elif patient_id is None:
+            errors[index]['patient'] = 'Unknown patient or access denied.'
+        elif patient_id in first_row:
+            errors[index]['patient'] = f'Patient already entered in row {first_row[patient_id] + 1}.'
+        else:
+            first_row[patient_id] = index
+        patient_ids.append(patient_id)
+    return patient_ids
+
+def record_screening(rows, encounter_type='screening', facility_name=None, provider_id=None):
+    """Validate and store a screening session; bad rows are reported, the rest are saved
+
+    All valid rows go in as one multi-row INSERT, risk rules run once over
+    the new records, and a single audit entry summarizes the session.
+    """
+    rules = field_rules()
+    if encounter_type not in rules['encounter_types']:
+        raise ValueError(f'encounter_type must be one of {", ".join(rules["encounter_types"])}')
+    if facility_name and rules['facility_max'] and len(facility_name) > rules['facility_max']:
+        raise ValueError(f'facility_name must be at most {rules["facility_max"]} characters')
+
+    columns, errors = validate_vitals(rows)
+    patient_ids = resolve_rows(rows, errors)
+
+    now = datetime.utcnow()
+    accepted = [index for index, row_errors in enumerate(errors) if not row_errors]
+    counties = patient_counties(patient_ids[index] for index in accepted)
+    values = []
+    for index in accepted:
+        record = {
+            'patient_id': patient_ids[index],
+            'county': counties.get(patient_ids[index]),
+            'encounter_date': now,
+            'encounter_type': encounter_type,
+            'chief_complaint': rows[index].get('notes') or None,
+            'provider_id': provider_id,
+            'facility_name': facility_name or None,
+            'created_at': now,
+        }
+        for name, (_, _, integer, _) in rules['vitals'].items():
+            value = columns[name][index]
+            record[name] = None if value != value else (int(value) if integer else float(value))
+        values.append(record)
+
+    record_ids = []
+    if values:
+        record_ids = db.session.execute(
+            insert(HealthRecord).returning(HealthRecord.id, sort_by_parameter_order=True), values
+        ).scalars().all()
+        db.session.commit()
+
+    flags = []
+    if record_ids:
+        seen = [patient_ids[index] for index in accepted]
+        resolve_follow_ups_many(seen, now)
+        flags = evaluate_records(record_ids)
+        cache.invalidate(*(f'patient:{patient_id}' for patient_id in seen))
+        log_audit('screening_session_recorded', 'health_record', record_ids[0],
+                  f'{len(record_ids)} {encounter_type} records saved '
+                  f'({len(rows) - len(record_ids)} rows rejected, {len(flags)} risk flags)')
+
+    return {
+        'recorded': [{'index': index, 'patient_id': patient_ids[index], 'health_record_id': record_id}
+                     for index, record_id in zip(accepted, record_ids)],
+        'errors': [{'index': index, 'errors': row_errors} for index, row_errors in enumerate(errors) if row_errors],
+        'flags': flags
+    }
@@ -561,14 +561,24 @@ function calculateBMI(weight, height) {
 
 /**
  * Get BMI category
- */
+ *
+ * Bands come from utils.BMI_CATEGORIES (set in base.html); the fallback
+ * copy is only for pages rendered without it.
+ */
+const BMI_CATEGORIES = window.BMI_CATEGORIES || [
+    [16, 'Severely Underweight'],
+    [18.5, 'Underweight'],
+    [25, 'Normal'],
+    [30, 'Overweight'],
+    [null, 'Obese']
+];
+
 function getBMICategory(bmi) {
     if (!bmi) return 'Unknown';
     
-    if (bmi < 18.5) return 'Underweight';
-    if (bmi < 25) return 'Normal';
-    if (bmi < 30) return 'Overweight';
-    return 'Obese';
+    for (const [bound, label] of BMI_CATEGORIES) {
+        if (bound === null || bmi < bound) return label;
+    }
 }
 
 /**
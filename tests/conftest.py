@@ -0,0 +1,12 @@
+import os
+import tempfile
+
+# The app reads its configuration at import time
+_instance = tempfile.mkdtemp(prefix='chs-tests-')
+os.environ.setdefault('DATABASE_URL', f'sqlite:///{os.path.join(_instance, "test.db")}')
+os.environ.setdefault('SESSION_SECRET', 'test')
+os.environ.setdefault('LOG_LEVEL', 'WARNING')
+
+# Import through main first, as gunicorn does, so the app -> routes ->
+# module import cycle resolves before tests import individual modules
+import main  # noqa: E402,F401
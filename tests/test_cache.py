@@ -0,0 +1,221 @@
+import fnmatch
+import threading
+import time
+
+import pytest
+
+from cache import Cache, MemoryBackend, SQLiteBackend, RedisBackend
+
+class FakeRedis:
+    """Just enough of redis-py for RedisBackend, kept in a dict"""
+
+    def __init__(self):
+        self.values = {}
+        self.expires = {}  # key -> absolute expiry time
+        self.commands = []
+
+    def _live(self, key):
+        if key in self.expires and self.expires[key] <= time.time():
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+        return key in self.values
+
+    def get(self, key):
+        return self.values[key] if self._live(key) else None
+
+    def set(self, key, value, px=None, nx=False):
+        if nx and self._live(key):
+            return None
+        self.values[key] = value if isinstance(value, bytes) else str(value).encode()
+        self.expires.pop(key, None)
+        if px is not None:
+            self.expires[key] = time.time() + px / 1000
+        return True
+
+    def sadd(self, key, *members):
+        self._live(key)
+        self.values.setdefault(key, set()).update(m.encode() for m in members)
+
+    def smembers(self, key):
+        return set(self.values[key]) if self._live(key) else set()
+
+    def ttl(self, key):
+        if not self._live(key):
+            return -2
+        return int(self.expires[key] - time.time()) if key in self.expires else -1
+
+    def expire(self, key, seconds):
+        self.commands.append(('EXPIRE', key, seconds))
+        if self._live(key):
+            self.expires[key] = time.time() + seconds
+
+    def delete(self, *keys):
+        removed = sum(1 for key in keys if self._live(key))
+        for key in keys:
+            self.values.pop(key, None)
+            self.expires.pop(key, None)
+        return removed
+
+    def scan_iter(self, pattern):
+        return [key for key in list(self.values) if fnmatch.fnmatch(key, pattern)]
+
+    def pipeline(self):
+        # Commands run as they are queued; nothing here interleaves
+        return FakePipeline(self)
+
+    def register_script(self, source):
+        def extend_ttl(keys, args, client=None):
+            if self.ttl(keys[0]) < int(args[0]):
+                self.expire(keys[0], int(args[0]))
+
+        def release_lock(keys, args, client=None):
+            if self.get(keys[0]) == args[0].encode():
+                return self.delete(keys[0])
+            return 0
+
+        return {RedisBackend.EXTEND_TTL: extend_ttl, RedisBackend.RELEASE_LOCK: release_lock}[source]
+
+class FakePipeline:
+    def __init__(self, client):
+        self.client = client
+
+    def __getattr__(self, name):
+        return getattr(self.client, name)
+
+    def execute(self):
+        return []
+
+@pytest.fixture(params=['memory', 'sqlite', 'redis'])
+def backend(request, tmp_path):
+    if request.param == 'memory':
+        return MemoryBackend(max_entries=100)
+    if request.param == 'sqlite':
+        return SQLiteBackend(str(tmp_path / 'cache.sqlite3'), max_entries=100)
+    return RedisBackend(client=FakeRedis())
+
+def test_get_set_and_expiry(backend):
+    cache = Cache(backend)
+    assert cache.get('missing', 'default') == 'default'
+    cache.set('key', {'a': [1, 2]})
+    assert cache.get('key') == {'a': [1, 2]}
+
+    cache.set('short', 1, ttl=0.05)
+    time.sleep(0.1)
+    assert cache.get('short') is None
+    assert cache.metrics.snapshot()['hits'] == 1
+
+def test_invalidate_by_tag(backend):
+    cache = Cache(backend)
+    cache.set('patient:1:summary', 'one', tags=('patient:1', 'county:kisumu'))
+    cache.set('patient:2:summary', 'two', tags=('patient:2', 'county:kisumu'))
+    cache.set('patient:3:summary', 'three', tags=('patient:3',))
+
+    assert cache.invalidate('patient:1') == 1
+    assert cache.get('patient:1:summary') is None
+    assert cache.get('patient:2:summary') == 'two'
+
+    assert cache.invalidate('county:kisumu') == 1
+    assert cache.get('patient:2:summary') is None
+    assert cache.get('patient:3:summary') == 'three'
+    assert cache.invalidate() == 0
+
+def test_overwrite_keeps_new_tags(backend):
+    cache = Cache(backend)
+    cache.set('key', 'old', tags=('a',))
+    cache.set('key', 'new', tags=('b',))
+    assert cache.get('key') == 'new'
+    # Redis leaves the key in the old tag set too, which only over-invalidates
+    cache.invalidate('b')
+    assert cache.get('key') is None
+
+def test_get_or_set_is_single_flight(backend):
+    cache = Cache(backend)
+    calls = []
+    started = threading.Barrier(8)
+
+    def producer():
+        calls.append(1)
+        time.sleep(0.2)
+        return 'value'
+
+    results = []
+
+    def worker():
+        started.wait()
+        results.append(cache.get_or_set('slow', producer, tags=('t',)))
+
+    threads = [threading.Thread(target=worker) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert results == ['value'] * 8
+    assert len(calls) == 1
+    assert cache.get_or_set('slow', producer) == 'value'
+    assert len(calls) == 1
+
+def test_get_or_set_releases_lock_when_producer_fails(backend):
+    cache = Cache(backend, lock_timeout=5)
+
+    def broken():
+        raise ValueError('boom')
+
+    with pytest.raises(ValueError):
+        cache.get_or_set('key', broken)
+    assert cache.get_or_set('key', lambda: 'recovered') == 'recovered'
+
+@pytest.mark.parametrize('kind', ['sqlite', 'redis'])
+def test_timed_out_waiter_keeps_other_owners_lock(kind, tmp_path):
+    if kind == 'sqlite':
+        backend = SQLiteBackend(str(tmp_path / 'cache.sqlite3'))
+    else:
+        backend = RedisBackend(client=FakeRedis())
+    holder = backend.acquire_lock('key', 5)
+    assert holder
+
+    # The waiter gives up, computes the value itself and must not free the lock
+    cache = Cache(backend, lock_timeout=0.1)
+    assert cache.get_or_set('key', lambda: 'computed') == 'computed'
+    assert not backend.acquire_lock('key', 5)
+
+    # Releasing with someone else's token is a no-op too
+    backend.release_lock('key', 'not-the-owner')
+    assert not backend.acquire_lock('key', 5)
+    backend.release_lock('key', holder)
+    assert backend.acquire_lock('key', 5)
+
+def test_sqlite_backend_is_shared_between_instances(tmp_path):
+    path = str(tmp_path / 'shared.sqlite3')
+    first, second = Cache(SQLiteBackend(path)), Cache(SQLiteBackend(path))
+    first.set('key', 'value', tags=('t',))
+    assert second.get('key') == 'value'
+    token = first.backend.acquire_lock('fill', 5)
+    assert token
+    assert not second.backend.acquire_lock('fill', 5)
+    first.backend.release_lock('fill', token)
+    assert second.backend.acquire_lock('fill', 5)
+    second.invalidate('t')
+    assert first.get('key') is None
+
+def test_memory_backend_evicts_least_recently_used():
+    backend = MemoryBackend(max_entries=2)
+    cache = Cache(backend)
+    cache.set('a', 1)
+    cache.set('b', 2)
+    cache.get('a')
+    cache.set('c', 3)
+    assert cache.get('b') is None
+    assert cache.get('a') == 1 and cache.get('c') == 3
+    assert cache.metrics.snapshot()['evictions'] == 1
+
+def test_redis_tag_ttl_is_only_extended():
+    client = FakeRedis()
+    cache = Cache(RedisBackend(client=client, prefix='t:'))
+    cache.set('long', 1, ttl=3600, tags=('shared',))
+    cache.set('short', 2, ttl=10, tags=('shared',))
+
+    # The short write must not cut the tag set's lifetime below the long key's
+    assert client.ttl('t:tag:shared') > 3600
+    assert [c for c in client.commands if c[1] == 't:tag:shared'] == [('EXPIRE', 't:tag:shared', 3660)]
+    assert cache.invalidate('shared') == 2
@@ -0,0 +1,28 @@
+import pytest
+
+from coding import extract_codes
+
+@pytest.mark.parametrize('kind, text', [
+    ('condition', 'HIV negative'),
+    ('condition', 'No history of diabetes or hypertension'),
+    ('condition', 'Review by Dr. Sam, TB screening negative'),
+    ('allergy', 'No known allergies; denies penicillin allergy'),
+    ('condition', 'Malaria RDT -ve'),
+    ('condition', 'non-diabetic'),
+    ('medication', 'Seen with Otieno et al'),
+])
+def test_negated_or_ambiguous_mentions_are_not_coded(kind, text):
+    assert extract_codes(kind, text) == []
+
+@pytest.mark.parametrize('kind, text, codes', [
+    ('condition', 'Known hypertensive, DM on metformin', ['I10', 'E11']),
+    ('condition', 'HIV positive, TB ruled out', ['B20']),
+    ('condition', 'TB, HIV neg', ['A15']),
+    ('condition', 'No fever but known asthmatic', ['J45']),
+    ('condition', 'Denies cough. Diabetic.', ['E11']),
+    ('condition', 'SAM, referred for OTP', ['E43']),
+    ('medication', 'Given ORS and zinc; AL for malaria', ['A07CA', 'A12CB01', 'P01BF01']),
+    ('allergy', 'Penicillin; eggs', ['PEN', 'EGG']),
+])
+def test_affirmed_mentions_are_coded(kind, text, codes):
+    assert extract_codes(kind, text) == codes
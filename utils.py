@@ -1,36 +1,33 @@
 import os
-import uuid
-import requests
+import logging
 from datetime import datetime
-from flask import request
+from flask import request, has_request_context
 from flask_login import current_user
 from app import db
-from models import AuditLog
+from models import AuditLog, Payment
+from jobs import job
+
+logger = logging.getLogger(__name__)
 
 def log_audit(action, resource_type, resource_id, details):
     """Log audit trail"""
     try:
+        # Background jobs have no request or logged-in user
+        in_request = has_request_context()
         audit_log = AuditLog(
-            user_id=current_user.id if current_user.is_authenticated else None,
+            user_id=current_user.id if in_request and current_user.is_authenticated else None,
             action=action,
             resource_type=resource_type,
             resource_id=resource_id,
             details=details,
-            ip_address=request.remote_addr,
-            user_agent=request.headers.get('User-Agent')
+            ip_address=request.remote_addr if in_request else None,
+            user_agent=request.headers.get('User-Agent') if in_request else None
         )
         db.session.add(audit_log)
         db.session.commit()
-    except Exception as e:
+    except Exception:
         # Don't let audit logging break the main functionality
-        print(f"Audit logging error: {str(e)}")
-
-def generate_patient_number():
-    """Generate unique patient number"""
-    prefix = "CHS"
-    date_part = datetime.utcnow().strftime("%Y%m%d")
-    random_part = str(uuid.uuid4())[:8].upper()
-    return f"{prefix}{date_part}{random_part}"
+        logger.exception('Audit logging failed for %s %s %s', action, resource_type, resource_id)
 
 def create_intasend_checkout(payment):
     """Create IntaSend checkout session"""
@@ -57,6 +54,9 @@ def create_intasend_checkout(payment):
             'X-IntaSend-Public-Key-Id': api_key
         }
         
+        # Imported here so workers that never take payments skip loading it
+        import requests
+        
         # Make API request to IntaSend
         response = requests.post(
             f'{base_url}payment/collection/',
@@ -69,14 +69,35 @@ def create_intasend_checkout(payment):
             result = response.json()
             return result.get('url')  # Return checkout URL
         else:
-            print(f"IntaSend API error: {response.status_code} - {response.text}")
+            logger.error('IntaSend checkout for %s failed: %s %s',
+                         payment.payment_reference, response.status_code, response.text[:500])
             return None
             
-    except Exception as e:
-        print(f"IntaSend checkout error: {str(e)}")
+    except Exception:
+        logger.exception('IntaSend checkout error for %s', payment.payment_reference)
         # For development, return a mock URL
         return f"/payments?mock_payment={payment.payment_reference}"
 
+@job('payments.intasend_webhook', max_attempts=8, priority=10)
+def process_intasend_webhook(invoice_id, status):
+    """Apply an IntaSend payment status update"""
+    payment = Payment.query.filter_by(intasend_checkout_id=invoice_id).first()
+    if not payment:
+        return {'matched': False}
+
+    payment.intasend_status = status
+    if status.lower() == 'complete':
+        payment.status = 'completed'
+        payment.completed_at = datetime.utcnow()
+    elif status.lower() == 'failed':
+        payment.status = 'failed'
+
+    db.session.commit()
+
+    log_audit('payment_webhook', 'payment', payment.id,
+             f'Payment webhook received: {status}')
+    return {'matched': True, 'payment_id': payment.id}
+
 def format_kenyan_phone(phone_number):
     """Format phone number to Kenyan standard"""
     if not phone_number:
@@ -104,19 +125,42 @@ def calculate_bmi(weight, height):
     bmi = weight / (height_m ** 2)
     return round(bmi, 1)
 
+def calculate_bmi_bulk(weights, heights):
+    """Vectorized calculate_bmi over arrays of weight (kg) and height (cm)
+
+    Returns a float array rounded to one decimal, NaN where either value
+    is missing or zero.
+    """
+    import numpy as np
+    
+    weights = np.asarray(weights, dtype=float)
+    heights = np.asarray(heights, dtype=float)
+    valid = (weights > 0) & (heights > 0)
+    bmi = np.full(weights.shape, np.nan)
+    height_m = heights[valid] / 100  # Convert cm to meters
+    bmi[valid] = np.round(weights[valid] / (height_m ** 2), 1)
+    return bmi
+
+# Exclusive upper bound and label of each BMI band, lowest first. risk.py
+# flags the first band and main.js reads the list from base.html, so all
+# three classify the same way.
+BMI_CATEGORIES = [
+    (16, 'Severely Underweight'),
+    (18.5, 'Underweight'),
+    (25, 'Normal'),
+    (30, 'Overweight'),
+    (None, 'Obese'),
+]
+
+def bmi_upper_bound(category):
+    return next(bound for bound, label in BMI_CATEGORIES if label == category)
+
 def get_bmi_category(bmi):
     """Get BMI category"""
     if not bmi:
         return "Unknown"
     
-    if bmi < 18.5:
-        return "Underweight"
-    elif bmi < 25:
-        return "Normal"
-    elif bmi < 30:
-        return "Overweight"
-    else:
-        return "Obese"
+    return next(label for bound, label in BMI_CATEGORIES if bound is None or bmi < bound)
 
 def format_currency(amount):
     """Format amount as Kenyan Shillings"""
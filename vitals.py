@@ -0,0 +1,123 @@
+from datetime import timezone
+import numpy as np
+from sqlalchemy import select, func
+from app import db
+from models import HealthRecord
+from cache import cache
+from utils import calculate_bmi_bulk
+
+SERIES = {
+    'weight': HealthRecord.weight,
+    'height': HealthRecord.height,
+    'temperature': HealthRecord.temperature,
+    'bp_systolic': HealthRecord.blood_pressure_systolic,
+    'bp_diastolic': HealthRecord.blood_pressure_diastolic,
+    'pulse': HealthRecord.pulse_rate,
+}
+DOWNSAMPLE_METHODS = ('lttb', 'minmax')
+
+TIMELINE_TTL = 3600
+
+def latest_record_version(patient_id):
+    """(max record id, record count) for a patient; changes when records are added or removed"""
+    return tuple(db.session.execute(
+        select(func.max(HealthRecord.id), func.count(HealthRecord.id))
+        .where(HealthRecord.patient_id == patient_id)
+    ).one())
+
+def load_vitals(patient_id, start=None, end=None):
+    """Vitals for a patient as columns: epoch-second timestamps plus one float array per series
+
+    Missing readings are NaN. Only the vitals columns are selected, using
+    the (patient_id, encounter_date) index.
+    """
+    query = select(HealthRecord.encounter_date, *SERIES.values()).where(HealthRecord.patient_id == patient_id)
+    if start is not None:
+        query = query.where(HealthRecord.encounter_date >= start)
+    if end is not None:
+        query = query.where(HealthRecord.encounter_date <= end)
+    rows = db.session.execute(query.order_by(HealthRecord.encounter_date, HealthRecord.id)).all()
+
+    # encounter_date is naive UTC; a bare timestamp() would read it as local time
+    timestamps = np.array([row[0].replace(tzinfo=timezone.utc).timestamp() for row in rows], dtype=float)
+    columns = {
+        name: np.array([np.nan if row[i] is None else row[i] for row in rows], dtype=float)
+        for i, name in enumerate(SERIES, start=1)
+    }
+    columns['bmi'] = calculate_bmi_bulk(columns['weight'], columns['height'])
+    return timestamps, columns
+
+def lttb(t, v, threshold):
+    """Largest-Triangle-Three-Buckets: keep ``threshold`` points that preserve the shape of the line"""
+    n = len(t)
+    if threshold >= n or threshold < 3:
+        return np.arange(n)
+
+    edges = np.linspace(1, n - 1, threshold - 1).astype(int)
+    keep = np.empty(threshold, dtype=int)
+    keep[0], keep[-1] = 0, n - 1
+    previous = 0
+    for i in range(threshold - 2):
+        lo, hi = edges[i], edges[i + 1]
+        # Average of the next bucket (or the last point) is the third vertex
+        if i + 2 < len(edges):
+            next_lo, next_hi = edges[i + 1], edges[i + 2]
+            avg_t, avg_v = t[next_lo:next_hi].mean(), v[next_lo:next_hi].mean()
+        else:
+            avg_t, avg_v = t[-1], v[-1]
+        area = np.abs(
+            (t[previous] - avg_t) * (v[lo:hi] - v[previous])
+            - (t[previous] - t[lo:hi]) * (avg_v - v[previous])
+        )
+        previous = lo + int(np.argmax(area))
+        keep[i + 1] = previous
+    return keep
+
+def minmax(t, v, threshold):
+    """Keep the minimum and maximum of each time bucket, so spikes are never dropped"""
+    n = len(t)
+    if threshold >= n or threshold < 2:
+        return np.arange(n)
+
+    buckets = max(threshold // 2, 1)
+    edges = np.linspace(0, n, buckets + 1).astype(int)
+    keep = []
+    for lo, hi in zip(edges[:-1], edges[1:]):
+        if hi > lo:
+            keep.extend((lo + int(np.argmin(v[lo:hi])), lo + int(np.argmax(v[lo:hi]))))
+    return np.unique(keep)
+
+def downsample(t, v, threshold, method='lttb'):
+    """Indices of the points to keep for one series"""
+    if method == 'minmax':
+        return minmax(t, v, threshold)
+    return lttb(t, v, threshold)
+
+def build_timeline(patient_id, start=None, end=None, points=None, method='lttb'):
+    """Per-series {t: [...], v: [...]} arrays, downsampled to at most ``points`` each"""
+    timestamps, columns = load_vitals(patient_id, start, end)
+    series = {}
+    for name, values in columns.items():
+        present = ~np.isnan(values)
+        t, v = timestamps[present], values[present]
+        total = len(t)
+        if points:
+            keep = downsample(t, v, points, method)
+            t, v = t[keep], v[keep]
+        series[name] = {
+            't': t.astype(np.int64).tolist(),
+            'v': v.round(1).tolist(),
+            'count': total,
+        }
+    return {'records': len(timestamps), 'series': series}
+
+def vitals_timeline(patient_id, start=None, end=None, points=None, method='lttb'):
+    """Cached build_timeline; returns (timeline, version)"""
+    # Keyed on the patient's latest record, so new encounters miss the cache
+    version = latest_record_version(patient_id)
+    key = f'vitals:{patient_id}:{version}:{start}:{end}:{points}:{method}'
+    timeline = cache.get_or_set(
+        key, lambda: build_timeline(patient_id, start, end, points, method),
+        ttl=TIMELINE_TTL, tags=[f'patient:{patient_id}']
+    )
+    return timeline, version